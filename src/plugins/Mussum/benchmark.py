@@ -0,0 +1,654 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+from db import DataBase
+from machinemanager import MachineManager
+
+import argparse
+import cStringIO
+import json
+import os
+import random
+import re
+import readwiki
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+DEFAULT_CELLS = 1000
+DEFAULT_FLEETS = '1000,10000,100000'
+DEFAULT_OPERATIONS = 1000
+DEFAULT_ROWS = 50000
+DEFAULT_TABLE_ROWS = 100
+DEFAULT_THREADS = 8
+GROUP_SIZE = 50
+GROUPS_PER_USER = 3
+MACHINES_PER_USER = 10
+PERCENTILES = (50, 95, 99)
+
+# cell parser replaced by readwiki.splitCells and readwiki.parseCell, kept
+# for comparison
+LEGACY_ENTRY = re.compile('(<.*>)*(.*)')
+
+# synthetic table row cells, by shape: regular ones and pathological ones
+# (unclosed attributes and markup, separators inside markup)
+ROW_SHAPES = (
+    ('plain', 'lpar000001'),
+    ('attributes', '<bgcolor="#ffffff"><:><-2> lpar000001'),
+    ('unclosedAttribute', '<<<<<<<<<<'),
+    ('unclosedMarkup', '{{{[[<<'),
+    ('markup', '{{{a||b}}} [[Page|text]]'),
+)
+
+# operations run by the multi-threaded mix and how often, reads dominate
+MIX = (
+    ('getInfo', 40),
+    ('listAvailable', 10),
+    ('listUsers', 10),
+    ('reserve', 20),
+    ('release', 20),
+)
+
+
+#
+# CODE
+#
+class Fleet(object):
+    """
+    A synthetic set of machines, users and group permissions stored in a
+    temporary database file
+    """
+
+    def __init__(self, size, users = None):
+        """
+        Constructor. Creates the database and fills it.
+
+        @type  size: int
+        @param size: number of machines
+
+        @type  users: int
+        @param users: number of users, by default one for every
+                      MACHINES_PER_USER machines
+
+        @rtype: None
+        @returns: nothing
+        """
+        if users == None:
+            users = max(size / MACHINES_PER_USER, 1)
+
+        self.size = size
+        self.directory = tempfile.mkdtemp(prefix = 'mussum-benchmark-')
+        self.path = os.path.join(self.directory, 'mussum.db')
+
+        # machine names, users and groups
+        self.machines = ['lpar%06d' % i for i in range(size)]
+        self.users = ['user%05d' % i for i in range(users)]
+        self.groups = ['group%04d' % i for i in range(size / GROUP_SIZE + 1)]
+
+        # every other machine belongs to a group
+        db = DataBase(self.path)
+        db.addMany([(name, '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255,
+                     i & 255), i % 16, self.__group(i))
+                    for i, name in enumerate(self.machines)])
+
+        # every user may use a few groups, the first group is open to all so
+        # any user can reserve the grouped machines in it
+        permissions = set()
+
+        for user in self.users:
+            permissions.add((user, self.groups[0]))
+
+            for group in random.sample(self.groups,
+                                       min(GROUPS_PER_USER, len(self.groups))):
+                permissions.add((user, group))
+
+        conn = sqlite3.connect(self.path)
+        conn.executemany('INSERT INTO Permissions (user, grp) VALUES (?, ?)',
+                         permissions)
+        conn.commit()
+        conn.close()
+
+        self.permissions = len(permissions)
+    # __init__()
+
+    def __group(self, index):
+        """
+        Returns the group of the machine with the passed index
+
+        @type  index: int
+        @param index: machine index
+
+        @rtype: basestring or None
+        @returns: group name, None for machines without group
+        """
+        if index % 2 == 0:
+            return None
+
+        return self.groups[index / GROUP_SIZE]
+    # __group()
+
+    def destroy(self):
+        """
+        Removes the database files
+
+        @rtype: None
+        @returns: nothing
+        """
+        shutil.rmtree(self.directory, True)
+    # destroy()
+
+# Fleet
+
+
+class Recorder(object):
+    """
+    Collects latencies of operations, thread safe
+    """
+
+    def __init__(self):
+        """
+        Constructor
+
+        @rtype: None
+        @returns: nothing
+        """
+        self.__lock = threading.Lock()
+        self.__latencies = {}
+    # __init__()
+
+    def record(self, operation, latency):
+        """
+        Records the latency of one execution of the passed operation
+
+        @type  operation: basestring
+        @param operation: operation name
+
+        @type  latency: float
+        @param latency: latency in seconds
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__lock:
+            self.__latencies.setdefault(operation, []).append(latency)
+    # record()
+
+    def report(self, elapsed):
+        """
+        Returns the count, throughput and latency percentiles in milliseconds
+        of each operation recorded
+
+        @type  elapsed: float
+        @param elapsed: wall clock time the operations took, in seconds
+
+        @rtype: dict
+        @returns: mapping of operation names to their statistics
+        """
+        report = {}
+
+        for operation, latencies in self.__latencies.iteritems():
+            latencies = sorted(latencies)
+            stats = {
+                'count': len(latencies),
+                'throughput': len(latencies) / elapsed,
+                'mean': 1000.0 * sum(latencies) / len(latencies),
+            }
+
+            for percentile in PERCENTILES:
+                stats['p%d' % percentile] = 1000.0 * percentileOf(latencies,
+                                                                  percentile)
+
+            report[operation] = stats
+
+        return report
+    # report()
+
+# Recorder
+
+
+def syntheticPage(rows, tableRows):
+    """
+    Returns a machines wiki page with the passed number of machine rows, split
+    in tables separated by some text, like the real page
+
+    @type  rows: int
+    @param rows: number of machine rows
+
+    @type  tableRows: int
+    @param tableRows: number of machine rows per table
+
+    @rtype: basestring
+    @returns: page contents
+    """
+    lines = []
+
+    for i in range(rows):
+
+        # start a new table
+        if i % tableRows == 0:
+            lines.append('')
+            lines.append('== Machines %d ==' % (i / tableRows))
+            lines.append('Some text about the machines below.')
+            lines.append('||Name||Ip||Id||Group||Notes||')
+
+        lines.append('||<style="color: red">lpar%06d||10.%d.%d.%d||%d||'
+                     'group%d||some <b>notes</b>||' % (i, i >> 16 & 255,
+                     i >> 8 & 255, i & 255, i % 16, i / GROUP_SIZE))
+
+    return '\n'.join(lines) + '\n'
+# syntheticPage()
+
+def syntheticRow(cell, cells):
+    """
+    Returns a table row with the passed cell repeated the passed number of
+    times
+
+    @type  cell: basestring
+    @param cell: cell text
+
+    @type  cells: int
+    @param cells: number of cells
+
+    @rtype: basestring
+    @returns: table row
+    """
+    return '||' + '||'.join([cell] * cells) + '||'
+# syntheticRow()
+
+def legacyParseLine(headers, line):
+    """
+    Parses the passed table row the way readwiki did before splitCells
+
+    @type  headers: list
+    @param headers: headers to be used
+
+    @type  line: basestring
+    @param line: line to be parsed
+
+    @rtype: dict
+    @returns: mapping of headers to columns
+    """
+    columns = [LEGACY_ENTRY.match(column).groups()[1].strip() or None
+               for column in line.split('||')[1:-1]]
+
+    return dict(zip(headers, columns))
+# legacyParseLine()
+
+def percentileOf(values, percentile):
+    """
+    Returns the passed percentile of the passed sorted values, using the
+    nearest rank method
+
+    @type  values: list
+    @param values: sorted values
+
+    @type  percentile: int
+    @param percentile: percentile, from 1 to 100
+
+    @rtype: float
+    @returns: value at the percentile
+    """
+    rank = int(round(percentile / 100.0 * len(values) + 0.5))
+    return values[min(max(rank, 1), len(values)) - 1]
+# percentileOf()
+
+def runOperation(manager, fleet, operation, recorder):
+    """
+    Runs the passed operation once on a random machine or user and records
+    its latency
+
+    @type  manager: MachineManager
+    @param manager: manager to run the operation on
+
+    @type  fleet: Fleet
+    @param fleet: fleet the manager contains
+
+    @type  operation: basestring
+    @param operation: operation name, one of the MachineManager methods
+
+    @type  recorder: Recorder
+    @param recorder: where to record the latency
+
+    @rtype: None
+    @returns: nothing
+    """
+    # pick arguments
+    machine = random.choice(fleet.machines)
+    user = random.choice(fleet.users)
+
+    if operation == 'add':
+        args = ('new%08d' % random.randint(0, 99999999),)
+    elif operation == 'reserve':
+        args = (machine, user)
+    elif operation in ('getInfo', 'release'):
+        args = (machine,)
+    elif operation == 'match':
+        args = (machine[:-2] + '*',)
+    else:
+        args = ()
+
+    # run and time it
+    method = getattr(manager, operation)
+    start = time.time()
+    method(*args)
+    recorder.record(operation, time.time() - start)
+# runOperation()
+
+def benchmarkSingle(manager, fleet, operations):
+    """
+    Runs every operation alone, one at a time, in the current thread
+
+    @type  manager: MachineManager
+    @param manager: manager to run the operations on
+
+    @type  fleet: Fleet
+    @param fleet: fleet the manager contains
+
+    @type  operations: int
+    @param operations: how many times each operation is run
+
+    @rtype: dict
+    @returns: statistics per operation, as returned by Recorder.report
+    """
+    report = {}
+
+    for operation in ('add', 'reserve', 'release', 'getInfo', 'listAvailable',
+                      'listUsers', 'match'):
+        recorder = Recorder()
+        start = time.time()
+
+        for i in range(operations):
+            runOperation(manager, fleet, operation, recorder)
+
+        report.update(recorder.report(time.time() - start))
+
+    return report
+# benchmarkSingle()
+
+def benchmarkMixed(manager, fleet, operations, threads):
+    """
+    Runs a mix of reads and writes from several threads at once
+
+    @type  manager: MachineManager
+    @param manager: manager to run the operations on
+
+    @type  fleet: Fleet
+    @param fleet: fleet the manager contains
+
+    @type  operations: int
+    @param operations: how many operations each thread runs
+
+    @type  threads: int
+    @param threads: number of threads
+
+    @rtype: dict
+    @returns: statistics per operation plus 'total', as returned by
+              Recorder.report
+    """
+    recorder = Recorder()
+    totals = Recorder()
+    choices = [operation for operation, weight in MIX
+               for i in range(weight)]
+
+    def work():
+        for i in range(operations):
+            start = time.time()
+            runOperation(manager, fleet, random.choice(choices), recorder)
+            totals.record('total', time.time() - start)
+
+    workers = [threading.Thread(target = work) for i in range(threads)]
+    start = time.time()
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    elapsed = time.time() - start
+    report = recorder.report(elapsed)
+    report.update(totals.report(elapsed))
+
+    return report
+# benchmarkMixed()
+
+def benchmarkFleet(size, operations, threads):
+    """
+    Builds a fleet of the passed size and benchmarks it
+
+    @type  size: int
+    @param size: number of machines
+
+    @type  operations: int
+    @param operations: how many times each operation is run
+
+    @type  threads: int
+    @param threads: number of threads for the mixed benchmark
+
+    @rtype: dict
+    @returns: fleet description and statistics
+    """
+    start = time.time()
+    fleet = Fleet(size)
+
+    try:
+        setup = time.time() - start
+
+        # time loading the index
+        start = time.time()
+        manager = MachineManager(DataBase(fleet.path))
+        load = time.time() - start
+
+        return {
+            'machines': fleet.size,
+            'users': len(fleet.users),
+            'groups': len(fleet.groups),
+            'permissions': fleet.permissions,
+            'setup': setup,
+            'load': load,
+            'single': benchmarkSingle(manager, fleet, operations),
+            'mixed': benchmarkMixed(manager, fleet, operations, threads),
+        }
+
+    finally:
+        fleet.destroy()
+# benchmarkFleet()
+
+def benchmarkWiki(rows, tableRows):
+    """
+    Parses synthetic machines wiki pages with up to the passed number of rows,
+    split in tables, and times it. Pages of a fifth, half and all the rows are
+    parsed, so the per row cost shows whether parsing is linear.
+
+    @type  rows: int
+    @param rows: number of machine rows in the biggest page
+
+    @type  tableRows: int
+    @param tableRows: number of machine rows per table
+
+    @rtype: list
+    @returns: page description and statistics, one per page
+    """
+    results = []
+
+    for count in (rows / 5, rows / 2, rows):
+
+        # parse the page from memory, as if it were being downloaded
+        page = cStringIO.StringIO(syntheticPage(count, tableRows))
+        start = time.time()
+        parsed = sum(1 for machine in readwiki.iterMachinesTable(page))
+        elapsed = time.time() - start
+
+        results.append({
+            'rows': parsed,
+            'tables': (count + tableRows - 1) / tableRows,
+            'bytes': len(page.getvalue()),
+            'seconds': elapsed,
+            'rowsPerSecond': parsed / elapsed,
+            'microsecondsPerRow': 1000000.0 * elapsed / parsed,
+        })
+
+    return results
+# benchmarkWiki()
+
+def benchmarkTokenizer(cells, operations):
+    """
+    Parses synthetic table rows of each shape in ROW_SHAPES, with a tenth,
+    half and all the passed number of cells, with readwiki.parseLine and with
+    the legacy regular expression, and times it. The per byte cost shows
+    whether parsing is linear in the row length.
+
+    @type  cells: int
+    @param cells: number of cells in the longest row
+
+    @type  operations: int
+    @param operations: how many times each row is parsed
+
+    @rtype: list
+    @returns: row description and statistics, one per row
+    """
+    results = []
+
+    for shape, cell in ROW_SHAPES:
+        for count in (cells / 10, cells / 2, cells):
+            line = syntheticRow(cell, count)
+            headers = ['column%d' % i for i in range(count)]
+            result = {
+                'shape': shape,
+                'cells': count,
+                'bytes': len(line),
+            }
+
+            # time both parsers on the same row
+            for name, parse in (('tokenizer', readwiki.parseLine),
+                                ('legacy', legacyParseLine)):
+                start = time.time()
+
+                for i in range(operations):
+                    parse(headers, line)
+
+                elapsed = (time.time() - start) / operations
+                result[name] = {
+                    'microsecondsPerRow': 1000000.0 * elapsed,
+                    'nanosecondsPerByte': 1000000000.0 * elapsed / len(line),
+                }
+
+            results.append(result)
+
+    return results
+# benchmarkTokenizer()
+
+def main():
+    """
+    Runs the benchmarks and prints the results as JSON
+
+    @rtype: None
+    @returns: nothing
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmarks the Mussum '
+                                     'machine manager on synthetic fleets '
+                                     '(fleet suite) or the machines wiki '
+                                     'parser on synthetic pages (wiki suite) '
+                                     'and rows (tokenizer suite). '
+                                     'Throughput is reported in operations '
+                                     'per second and latencies in '
+                                     'milliseconds.')
+    parser.add_argument('--suite', choices = ('fleet', 'wiki', 'tokenizer'),
+                        default = 'fleet',
+                        help = 'benchmarks to run (default: fleet)')
+    parser.add_argument('--fleets', default = DEFAULT_FLEETS,
+                        help = 'comma separated fleet sizes (default: %s)' %
+                        DEFAULT_FLEETS)
+    parser.add_argument('--operations', type = int,
+                        default = DEFAULT_OPERATIONS,
+                        help = 'runs of each operation, per thread in the '
+                        'mixed benchmark (default: %s)' % DEFAULT_OPERATIONS)
+    parser.add_argument('--threads', type = int, default = DEFAULT_THREADS,
+                        help = 'threads in the mixed benchmark (default: %s)'
+                        % DEFAULT_THREADS)
+    parser.add_argument('--rows', type = int, default = DEFAULT_ROWS,
+                        help = 'rows in the biggest wiki page (default: %s)' %
+                        DEFAULT_ROWS)
+    parser.add_argument('--table-rows', type = int,
+                        default = DEFAULT_TABLE_ROWS,
+                        help = 'rows per wiki table (default: %s)' %
+                        DEFAULT_TABLE_ROWS)
+    parser.add_argument('--cells', type = int, default = DEFAULT_CELLS,
+                        help = 'cells in the longest tokenizer row (default: '
+                        '%s)' % DEFAULT_CELLS)
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'random seed (default: 0)')
+    parser.add_argument('--output', default = None,
+                        help = 'file to write the results to (default: '
+                        'standard output)')
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+
+    # run benchmarks
+    results = {
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'suite': options.suite,
+    }
+
+    if options.suite == 'fleet':
+        results['threads'] = options.threads
+        results['operations'] = options.operations
+        results['fleets'] = [benchmarkFleet(int(size), options.operations,
+                                            options.threads)
+                             for size in options.fleets.split(',')]
+
+    elif options.suite == 'wiki':
+        results['pages'] = benchmarkWiki(options.rows, options.table_rows)
+
+    elif options.suite == 'tokenizer':
+        results['operations'] = options.operations
+        results['rows'] = benchmarkTokenizer(options.cells, options.operations)
+
+    # write results
+    output = sys.stdout
+
+    if options.output != None:
+        output = open(options.output, 'w')
+
+    json.dump(results, output, indent = 2, sort_keys = True)
+    output.write('\n')
+
+    if output != sys.stdout:
+        output.close()
+# main()
+
+
+if __name__ == '__main__':
+    main()
+
+
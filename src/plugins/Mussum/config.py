@@ -22,6 +22,7 @@
 #
 # IMPORTS
 #
+import readwiki
 import supybot.conf as conf
 import supybot.registry as registry
 
@@ -41,3 +42,133 @@ def configure(advanced):
 Mussum = conf.registerPlugin('Mussum')
 
 
+
+conf.registerGroup(Mussum, 'database')
+
+conf.registerGlobalValue(Mussum.database, 'path',
+    registry.String('', """Determines the file the machines database is kept
+    in. If empty, mussum.db in the plugin directory is used. Takes effect
+    when the plugin is loaded."""))
+
+conf.registerGlobalValue(Mussum.database, 'poolSize',
+    registry.PositiveInteger(4, """Determines how many connections to the
+    machines database are kept open and shared by the command threads."""))
+
+conf.registerGlobalValue(Mussum.database, 'timeout',
+    registry.PositiveFloat(5.0, """Determines how many seconds a command waits
+    for a free database connection or for a lock held by another writer."""))
+
+conf.registerGroup(Mussum, 'history')
+
+conf.registerGlobalValue(Mussum.history, 'retention',
+    registry.NonNegativeInteger(90, """Determines for how many days the
+    reservation history is kept. Older entries are deleted once a day. If set
+    to 0, the history is kept forever."""))
+
+conf.registerGroup(Mussum, 'leases')
+
+conf.registerGlobalValue(Mussum.leases, 'default',
+    registry.String('', """Determines for how long reservations last when
+    the reserve command does not tell (e.g. 8h, 3d, 2w). When they expire,
+    machines are released and handed to the first user waiting for them. If
+    empty, reservations never expire."""))
+
+conf.registerGlobalValue(Mussum.leases, 'groups',
+    registry.SpaceSeparatedListOfStrings([], """Determines for how long
+    reservations of the machines in some groups last instead of the default,
+    as <group>:<time> entries (e.g. pp:8h)."""))
+
+conf.registerGlobalValue(Mussum.leases, 'warning',
+    registry.NonNegativeInteger(900, """Determines how many seconds before a
+    reservation expires its holder is warned in private. If set to 0, no
+    warning is sent."""))
+
+
+class MetricsFormat(registry.OnlySomeStrings):
+    """Valid values are 'json' and 'prometheus'."""
+    validStrings = ('json', 'prometheus')
+
+conf.registerGroup(Mussum, 'metrics')
+
+conf.registerGlobalValue(Mussum.metrics, 'file',
+    registry.String('', """Determines the file 'stats export' writes the
+    command and database query metrics to. If empty, metrics are not
+    exported."""))
+
+conf.registerGlobalValue(Mussum.metrics, 'format',
+    MetricsFormat('prometheus', """Determines the format metrics are exported
+    in: json or prometheus (text exposition format)."""))
+
+
+
+conf.registerGroup(Mussum, 'replies')
+
+conf.registerGlobalValue(Mussum.replies, 'rate',
+    registry.PositiveFloat(1.0, """Determines how many messages per second
+    bulk output (e.g. info on many machines) is sent at. Short replies to
+    commands are not paced and go ahead of bulk output."""))
+
+conf.registerGlobalValue(Mussum.replies, 'limit',
+    registry.NonNegativeInteger(20, """Determines the most lines of bulk
+    output a single command sends; the remaining ones are summarized in a
+    single line. info --verbose only sends whole machines within it. If set
+    to 0, there is no limit."""))
+
+conf.registerGroup(Mussum, 'sync')
+
+conf.registerGlobalValue(Mussum.sync, 'interval',
+    registry.NonNegativeInteger(0, """Determines how many seconds the bot
+    waits between background updates of the machines from the wiki (e.g.
+    3600). If set to 0, machines are only updated by the update command."""))
+
+conf.registerGlobalValue(Mussum.sync, 'jitter',
+    registry.NonNegativeInteger(300, """Determines up to how many seconds are
+    randomly added to each wait between background updates, so several bots
+    do not hit the wiki at the same time."""))
+
+conf.registerGlobalValue(Mussum.sync, 'timeout',
+    registry.PositiveFloat(60.0, """Determines how many seconds a background
+    update waits for the wiki before giving up. Failed updates are retried
+    after 1 minute, doubling the wait after each new failure up to the
+    interval."""))
+
+conf.registerGlobalValue(Mussum.sync, 'channels',
+    registry.SpaceSeparatedListOfStrings([], """Determines the channels a one
+    line summary is posted to when a background update changes the
+    machines."""))
+
+conf.registerGlobalValue(Mussum.sync, 'sources',
+    registry.SpaceSeparatedListOfStrings(['wiki:' + readwiki.MACHINES_URL],
+    """Determines where machines are listed, as <kind>:<location> entries.
+    Kinds are wiki (raw MoinMoin page URL), csv and json (local file paths)
+    and http-json (URL). When a machine is listed in more than one source,
+    each of its fields is taken from the first source that has it."""))
+
+conf.registerGlobalValue(Mussum.sync, 'workers',
+    registry.PositiveInteger(4, """Determines how many sources are fetched
+    at the same time."""))
+
+conf.registerGlobalValue(Mussum.sync, 'maxRemoved',
+    registry.Probability(0.1, """Determines the largest fraction of the
+    registered machines an update may remove at once. If more would be
+    removed, or if the sources list no machine at all (e.g. a login or
+    maintenance page was served instead), none is removed until update --force
+    is run."""))
+
+conf.registerGroup(Mussum, 'workers')
+
+conf.registerGlobalValue(Mussum.workers, 'reads',
+    registry.PositiveInteger(4, """Determines how many threads run commands
+    which only read machines (e.g. show, info, users)."""))
+
+conf.registerGlobalValue(Mussum.workers, 'writes',
+    registry.PositiveInteger(2, """Determines how many threads run commands
+    which change machines (add, free, reserve and update), apart from the
+    ones which only read them."""))
+
+conf.registerGlobalValue(Mussum.workers, 'queueSize',
+    registry.PositiveInteger(32, """Determines how many commands of each
+    kind (reads or writes) may wait for a thread. Further commands are
+    answered with a busy message."""))
+
+
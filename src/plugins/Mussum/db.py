@@ -22,8 +22,14 @@
 #
 # IMPORTS
 #
+from metrics import Metrics
+
+import contextlib
 import os
+import Queue
+import re
 import sqlite3
+import threading
 import time
 
 
@@ -32,46 +38,291 @@ import time
 #
 _PATH_DB = os.path.join(os.path.dirname(__file__), 'mussum.db')
 
+# glob pattern special characters
+_GLOB = re.compile('[*?[]')
+
+_PRAGMA_BUSY_TIMEOUT = 'PRAGMA busy_timeout=%d'
+_PRAGMA_JOURNAL_MODE = 'PRAGMA journal_mode=WAL'
+_PRAGMA_SET_USER_VERSION = 'PRAGMA user_version=%d'
+_PRAGMA_SYNCHRONOUS = 'PRAGMA synchronous=NORMAL'
+_PRAGMA_USER_VERSION = 'PRAGMA user_version'
+
 _QUERY_ADD = 'INSERT INTO Machines (name, ip, id, grp, user, start) VALUES (?, ?, ?, ?, NULL, ?)'
+_QUERY_ADD_COLUMN_EXPIRES = 'ALTER TABLE Machines ADD COLUMN expires INT'
 _QUERY_ASSOCIATE = 'INSERT INTO Permissions (user, grp) VALUES (?, ?)'
 _QUERY_CREATE_MACHINES = 'CREATE TABLE IF NOT EXISTS Machines (name VARCHAR PRIMARY KEY, ip CHAR(15), id SMALLINT, grp VARCHAR, user VARCHAR, start INT)'
+_QUERY_CREATE_INDEX_MACHINES_GROUP = 'CREATE INDEX IF NOT EXISTS MachinesGroup ON Machines (grp)'
+_QUERY_CREATE_INDEX_MACHINES_START = 'CREATE INDEX IF NOT EXISTS MachinesStart ON Machines (start)'
+_QUERY_CREATE_INDEX_MACHINES_USER = 'CREATE INDEX IF NOT EXISTS MachinesUser ON Machines (user, name)'
+_QUERY_CREATE_INDEX_PERMISSIONS_GROUP = 'CREATE INDEX IF NOT EXISTS PermissionsGroup ON Permissions (grp, user)'
+_QUERY_CREATE_INDEX_RESERVATIONS_NAME = 'CREATE INDEX IF NOT EXISTS ReservationsName ON Reservations (name, time)'
+_QUERY_CREATE_INDEX_RESERVATIONS_TIME = 'CREATE INDEX IF NOT EXISTS ReservationsTime ON Reservations (time)'
+_QUERY_CREATE_INDEX_RESERVATIONS_USER = 'CREATE INDEX IF NOT EXISTS ReservationsUser ON Reservations (user, time)'
+_QUERY_CREATE_INDEX_WAITERS_USER = 'CREATE INDEX IF NOT EXISTS WaitersUser ON Waiters (user, time)'
 _QUERY_CREATE_PERMISSIONS = 'CREATE TABLE IF NOT EXISTS Permissions (user VARCHAR, grp VARCHAR, PRIMARY KEY(user, grp))'
+_QUERY_CREATE_RESERVATIONS = 'CREATE TABLE IF NOT EXISTS Reservations (name VARCHAR, user VARCHAR, action VARCHAR, time INT)'
+_QUERY_CREATE_WAITERS = 'CREATE TABLE IF NOT EXISTS Waiters (name VARCHAR, user VARCHAR, time INT, PRIMARY KEY(name, user))'
+_QUERY_DELETE_HISTORY = 'DELETE FROM Reservations WHERE time<?'
+_QUERY_DELETE_ORPHAN_WAITERS = 'DELETE FROM Waiters WHERE name NOT IN (SELECT name FROM Machines)'
+_QUERY_DEQUEUE = 'DELETE FROM Waiters WHERE name=? AND user=?'
+_QUERY_ENQUEUE = 'INSERT OR IGNORE INTO Waiters (name, user, time) SELECT name, ?, ? FROM Machines WHERE name=? AND user IS NOT NULL AND user!=? AND (grp IS NULL OR EXISTS (SELECT 1 FROM Permissions WHERE Permissions.grp=Machines.grp AND Permissions.user=?))'
+_QUERY_GET_ALL = 'SELECT name, ip, id, grp, user, start, expires FROM Machines'
 _QUERY_GET_AVAILABLE = 'SELECT name FROM Machines WHERE user is NULL ORDER BY name ASC'
 _QUERY_GET_BY_USER = 'SELECT name FROM Machines WHERE user=? ORDER BY name ASC'
-_QUERY_GET_INFO = 'SELECT name, ip, id, grp, user, start FROM Machines where name=?'
+_QUERY_GET_HISTORY = 'SELECT time, rowid, name, user, action FROM Reservations WHERE name=? AND time>=? UNION SELECT time, rowid, name, user, action FROM Reservations WHERE user=? AND time>=? ORDER BY time ASC, rowid ASC'
+_QUERY_GET_INFO = 'SELECT name, ip, id, grp, user, start, expires FROM Machines where name=?'
 _QUERY_GET_MACHINES = 'SELECT name FROM Machines ORDER BY name ASC'
 _QUERY_GET_RESERVED = 'SELECT name FROM Machines WHERE user is not NULL ORDER BY name ASC'
 _QUERY_GET_USERS = 'SELECT DISTINCT user from Machines WHERE user is not NULL ORDER BY user ASC'
 _QUERY_GET_USERS_BY_GROUP = 'SELECT user FROM Permissions WHERE grp=?'
+_QUERY_GET_WAITERS = 'SELECT user FROM Waiters WHERE name=? ORDER BY time ASC, rowid ASC'
+_QUERY_GET_WAITING = 'SELECT name FROM Waiters WHERE user=? ORDER BY time ASC, rowid ASC'
+_QUERY_IS_WAITING = 'SELECT 1 FROM Waiters WHERE name=? AND user=?'
+_QUERY_LOG_RELEASE = "INSERT INTO Reservations (name, user, action, time) SELECT name, user, 'release', ? FROM Machines WHERE name=? AND user IS NOT NULL"
+_QUERY_LOG_RESERVE = "INSERT INTO Reservations (name, user, action, time) VALUES (?, ?, 'reserve', ?)"
 _QUERY_REMOVE = 'DELETE FROM Machines WHERE name=?'
-_QUERY_RESERVE = 'UPDATE Machines SET user=?, start=? WHERE name=?'
+_QUERY_REMOVE_IF_FREE = 'DELETE FROM Machines WHERE name=? AND user IS NULL'
+_QUERY_RESERVE = 'UPDATE Machines SET user=?, start=?, expires=? WHERE name=?'
+_QUERY_RESERVE_IF_FREE = 'UPDATE Machines SET user=?, start=?, expires=? WHERE name=? AND user IS NULL AND (grp IS NULL OR EXISTS (SELECT 1 FROM Permissions WHERE Permissions.grp=Machines.grp AND Permissions.user=?))'
 _QUERY_UNASSOCIATE = 'DELETE FROM Permissions Where user=? AND grp=?'
+_QUERY_UPDATE_INFO = 'UPDATE Machines SET ip=?, id=?, grp=? WHERE name=?'
+
+# query names used in metrics, e.g. 'GET_AVAILABLE', so each query must
+# be unique
+_QUERY_NAMES = dict([(value, key[len('_QUERY_'):])
+                     for key, value in globals().items()
+                     if key.startswith('_QUERY_')])
+
+# Machines columns filter terms and sort keys refer to, see DataBase.find
+_FIND_COLUMNS = {
+    'group': 'grp',
+    'held': 'start',
+    'id': 'id',
+    'ip': 'ip',
+    'name': 'name',
+    'user': 'user',
+}
+
+# schema migrations: the database user_version tells how many of them were
+# already applied, new ones must always be appended at the end
+_MIGRATIONS = [
+    # 1: base tables
+    (
+        _QUERY_CREATE_MACHINES,
+        _QUERY_CREATE_PERMISSIONS,
+    ),
+    # 2: secondary indexes for lookups by state, user and group
+    (
+        _QUERY_CREATE_INDEX_MACHINES_USER,
+        _QUERY_CREATE_INDEX_MACHINES_GROUP,
+        _QUERY_CREATE_INDEX_PERMISSIONS_GROUP,
+    ),
+    # 3: append-only reservation history
+    (
+        _QUERY_CREATE_RESERVATIONS,
+        _QUERY_CREATE_INDEX_RESERVATIONS_NAME,
+        _QUERY_CREATE_INDEX_RESERVATIONS_USER,
+        _QUERY_CREATE_INDEX_RESERVATIONS_TIME,
+    ),
+    # 4: index for filtering and sorting by how long machines are held
+    (
+        _QUERY_CREATE_INDEX_MACHINES_START,
+    ),
+    # 5: users waiting for reserved machines, in arrival order
+    (
+        _QUERY_CREATE_WAITERS,
+        _QUERY_CREATE_INDEX_WAITERS_USER,
+    ),
+    # 6: when reservations expire, NULL for never
+    (
+        _QUERY_ADD_COLUMN_EXPIRES,
+    ),
+]
 
 
 #
 # CODE
 #
+class _Rollback(Exception):
+    """
+    Raised inside a transaction to undo it without reporting an error
+    """
+    pass
+
+# _Rollback
+
+
 class DataBase(object):
     """
     This is an entity that handles deals with the database by retrieving and
-    storing data
+    storing data.
+
+    Every reservation and release is also appended to the Reservations table
+    in the same transaction, keeping the history of who used each machine.
+
+    Users may wait for reserved machines in the Waiters table: releasing a
+    machine hands it to the first waiting user allowed to use it, in the same
+    transaction.
+
+    Connections are kept in a pool shared by all threads. The database is
+    opened in WAL mode, so readers never block behind a writer.
     """
 
-    def __init__(self):
+    def __init__(self, path = None, poolSize = 4, timeout = 5.0,
+                 metrics = None):
         """
         Constructor
 
+        @type  path: basestring
+        @param path: path to the database file, mussum.db in the plugin
+                     directory if not passed
+
+        @type  poolSize: int
+        @param poolSize: number of connections kept open
+
+        @type  timeout: float
+        @param timeout: seconds to wait for a free connection or for a lock
+                        held by another writer
+
+        @type  metrics: Metrics
+        @param metrics: where to record query timings, a private one is used
+                        if not passed
+
         @rtype: None
         @returns: nothing
         """
+        # no path passed: use the default one
+        if path == None:
+            path = _PATH_DB
+
+        self.__path = path
+        self.__timeout = timeout
+
+        # no metrics passed: keep them private
+        if metrics == None:
+            metrics = Metrics()
+
+        self.__metrics = metrics
+
         # connect to database
-        self.__conn = sqlite3.connect(_PATH_DB, check_same_thread = False)
+        self.__pool = Queue.Queue(poolSize)
 
-        # create machines table if it does not exist yet
-        self.__write(_QUERY_CREATE_MACHINES)
+        for i in range(poolSize):
+            self.__pool.put(self.__connect())
+
+        # number of writes done so far, used by callers to detect changes
+        self.__generation = 0
+        self.__generationLock = threading.Lock()
+
+        # create or upgrade tables and indexes
+        self.__migrate()
     # __init__()
 
-    def __select(self, query, params = ()):
+    def __connect(self):
+        """
+        Opens a new connection to the database and sets it up
+
+        @rtype: sqlite3.Connection
+        @returns: new connection
+        """
+        # transactions are handled explicitly by __transaction
+        conn = sqlite3.connect(self.__path, timeout = self.__timeout,
+                               isolation_level = None,
+                               check_same_thread = False)
+
+        # readers work on a snapshot and do not wait for writers; with WAL,
+        # syncing only at checkpoints is still safe against corruption
+        conn.execute(_PRAGMA_JOURNAL_MODE)
+        conn.execute(_PRAGMA_SYNCHRONOUS)
+        conn.execute(_PRAGMA_BUSY_TIMEOUT % int(self.__timeout * 1000))
+
+        return conn
+    # __connect()
+
+    @contextlib.contextmanager
+    def __connection(self):
+        """
+        Takes a connection from the pool for the duration of a with block
+
+        @rtype: sqlite3.Connection
+        @returns: connection to be used inside the block
+        """
+        # wait for a free connection
+        try:
+            conn = self.__pool.get(True, self.__timeout)
+
+        except Queue.Empty:
+            raise sqlite3.OperationalError('no database connection available')
+
+        # give it back to the pool when done
+        try:
+            yield conn
+
+        finally:
+            self.__pool.put(conn)
+    # __connection()
+
+    @contextlib.contextmanager
+    def __transaction(self, name):
+        """
+        Runs the body of a with block in a write transaction, committing it at
+        the end or rolling it back if an exception is raised
+
+        @type  name: basestring
+        @param name: name the transaction timing is recorded under
+
+        @rtype: sqlite3.Cursor
+        @returns: cursor to be used inside the block
+        """
+        # nested, since Python 2.6 takes a single context per with statement
+        with self.__metrics.timer('query', name):
+            with self.__connection() as conn:
+                c = conn.cursor()
+
+                # take the write lock upfront
+                c.execute('BEGIN IMMEDIATE')
+
+                # commit transaction, undo everything on error
+                try:
+                    yield c
+                    c.execute('COMMIT')
+
+                except:
+                    c.execute('ROLLBACK')
+                    raise
+
+                finally:
+                    c.close()
+
+        # let callers know the data changed
+        with self.__generationLock:
+            self.__generation += 1
+    # __transaction()
+
+    def __migrate(self):
+        """
+        Applies the schema migrations not yet applied to the database
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__transaction('MIGRATE') as c:
+
+            # database is up to date: nothing to do
+            version = c.execute(_PRAGMA_USER_VERSION).fetchone()[0]
+
+            if version >= len(_MIGRATIONS):
+                return
+
+            # apply pending migrations and record the new version
+            for migration in _MIGRATIONS[version:]:
+                for query in migration:
+                    c.execute(query)
+
+            c.execute(_PRAGMA_SET_USER_VERSION % len(_MIGRATIONS))
+    # __migrate()
+
+    def __select(self, query, params = (), name = None):
         """
         Executes the passed SELECT query and returns the resulting rows
 
@@ -81,16 +332,23 @@ class DataBase(object):
         @type  params: tuple
         @param params: parameters for the SELECT query
 
+        @type  name: basestring
+        @param name: query name used in metrics, needed for queries built at
+                     run time
+
         @rtype: list
         @returns: query resulting rows
         """
-        # get cursor to execute operations
-        c = self.__conn.cursor()
+        with self.__metrics.timer('query', name or _QUERY_NAMES[query]):
+            with self.__connection() as conn:
 
-        # execute the query
-        result = c.execute(query, params)
-        rows = result.fetchall()
-        c.close()
+                # get cursor to execute operations
+                c = conn.cursor()
+
+                # execute the query
+                result = c.execute(query, params)
+                rows = result.fetchall()
+                c.close()
 
         # return the results
         return rows
@@ -106,21 +364,39 @@ class DataBase(object):
         @type  params: tuple
         @param params: parameters for the SQL query
 
-        @rtype: None
-        @returns: nothing
+        @rtype: int
+        @returns: number of rows affected by the query
         """
-        # get cursor to execute operations
-        c = self.__conn.cursor()
-
         # execute the query
-        c.execute(query, params)
-        c.close()
+        with self.__transaction(_QUERY_NAMES[query]) as c:
+            c.execute(query, params)
+            count = c.rowcount
 
-        # commit transaction
-        self.__conn.commit()
+        # return how many rows were affected
+        return count
     # __write()
 
-    def add(self, name, ip, id, group):
+    def __writeMany(self, query, paramsList):
+        """
+        Executes the passed SQL query once for each set of parameters in a
+        single transaction and commits to DB at the end. If any execution
+        fails, the whole transaction is rolled back.
+
+        @type  query: basestring
+        @param query: SQL query to be executed
+
+        @type  paramsList: list
+        @param paramsList: list of parameter tuples for the SQL query
+
+        @rtype: None
+        @returns: nothing
+        """
+        # execute the query for all params
+        with self.__transaction(_QUERY_NAMES[query] + '_MANY') as c:
+            c.executemany(query, paramsList)
+    # __writeMany()
+
+    def add(self, name, ip, id, group, start = None):
         """
         Adds a machine with the passed name and other info
 
@@ -136,16 +412,48 @@ class DataBase(object):
         @type  group: basestring
         @param group: group the machine belongs to
 
+        @type  start: int
+        @param start: time the machine became available, defaults to now
+
         @rtype: None
         @returns: noting
         """
-        # build params: machine name, ip, id and current time
-        params = (name, ip, id, group, int(time.time()))
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
+
+        # build params: machine name, ip, id, group and start time
+        params = (name, ip, id, group, start)
 
         # execute the update query
         self.__write(_QUERY_ADD, params)
     # add()
 
+    def addMany(self, machines, start = None):
+        """
+        Adds all the passed machines in a single transaction
+
+        @type  machines: list
+        @param machines: list of (name, ip, id, group) tuples
+
+        @type  start: int
+        @param start: time the machines became available, defaults to now
+
+        @rtype: None
+        @returns: nothing
+        """
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
+
+        # build params: all machines get the same start time
+        params = [(name, ip, id, group, start)
+                  for name, ip, id, group in machines]
+
+        # execute the insert query for all machines
+        self.__writeMany(_QUERY_ADD, params)
+    # addMany()
+
     def associate(self, user, group):
         """
         Associates the passed user to the passed group
@@ -162,6 +470,165 @@ class DataBase(object):
         self.__write(_QUERY_ASSOCIATE, (user, group))
     # associate()
 
+    def deleteHistory(self, before):
+        """
+        Deletes the reservation history older than the passed time
+
+        @type  before: int
+        @param before: events before this time are deleted
+
+        @rtype: int
+        @returns: number of events deleted
+        """
+        return self.__write(_QUERY_DELETE_HISTORY, (before,))
+    # deleteHistory()
+
+    def dequeueMany(self, names, user):
+        """
+        Removes the passed user from the queues of the passed machines, in a
+        single transaction
+
+        @type  names: list
+        @param names: machine names
+
+        @type  user: basestring
+        @param user: user name
+
+        @rtype: list
+        @returns: one bool per machine, True if the user was waiting for it
+        """
+        results = []
+
+        with self.__transaction('DEQUEUE_MANY') as c:
+            for name in names:
+                c.execute(_QUERY_DEQUEUE, (name, user))
+                results.append(c.rowcount == 1)
+
+        return results
+    # dequeueMany()
+
+    def find(self, terms, sort = None, limit = None):
+        """
+        Returns info about the machines matching all the passed filter terms,
+        in the same format returned by getInfo. The terms are compiled to a
+        single parameterized query, so the indexes on group, user and start
+        are used.
+
+        @type  terms: list
+        @param terms: (field, operator, value) tuples, as returned by
+                      filters.parse: name, ip, id, group and user accept =
+                      and != with values that may be glob patterns, state
+                      accepts = and != with free or reserved and held accepts
+                      > and < with a number of seconds
+
+        @type  sort: tuple
+        @param sort: field to sort by and whether in descending order, by
+                     default machines are sorted by name
+
+        @type  limit: int
+        @param limit: most machines returned, None for all
+
+        @rtype: list
+        @returns: info about the matching machines
+        """
+        conditions = []
+        params = []
+        now = int(time.time())
+
+        for field, operator, value in terms:
+
+            # state: whether there is a user
+            if field == 'state':
+                free = (value == 'free') == (operator == '=')
+                conditions.append(free and 'user IS NULL' or
+                                  'user IS NOT NULL')
+                continue
+
+            column = _FIND_COLUMNS[field]
+
+            # held for longer (>) or shorter (<) than some seconds: state
+            # changed before or after that long ago
+            if field == 'held':
+                conditions.append('%s%s?' % (column,
+                                  operator == '>' and '<' or '>'))
+                params.append(now - value)
+                continue
+
+            # other fields: exact value or glob pattern, machines without
+            # value only match !=
+            compare = '%s=?'
+
+            if _GLOB.search(value) != None:
+                compare = '%s GLOB ?'
+
+            if operator == '=':
+                conditions.append(compare % column)
+            else:
+                conditions.append('(%s IS NULL OR NOT %s)' %
+                                  (column, compare % column))
+
+            params.append(value)
+
+        # filtered and sorted from the whole table, timed apart from getAll
+        query = _QUERY_GET_ALL
+
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        # sort: held is the time since start, so its order is reversed
+        key, descending = sort or ('name', False)
+
+        if key == 'held':
+            descending = not descending
+
+        query += ' ORDER BY %s %s' % (_FIND_COLUMNS[key],
+                                      descending and 'DESC' or 'ASC')
+
+        if key != 'name':
+            query += ', name ASC'
+
+        if limit != None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        # execute select query
+        rows = self.__select(query, tuple(params), 'FIND')
+
+        # return info
+        return [{
+            'name': r[0],
+            'ip': r[1],
+            'id': r[2],
+            'group': r[3],
+            'user': r[4],
+            'start': r[5],
+            'expires': r[6],
+        } for r in rows]
+    # find()
+
+    def getAll(self):
+        """
+        Returns info about all registered machines, in the same format
+        returned by getInfo
+
+        @rtype: list
+        @returns: info about all registered machines
+        """
+        # execute select query
+        rows = self.__select(_QUERY_GET_ALL)
+
+        # return info
+        return [{
+            'name': r[0],
+            'ip': r[1],
+            'id': r[2],
+            'group': r[3],
+            'user': r[4],
+            'start': r[5],
+            'expires': r[6],
+        } for r in rows]
+    # getAll()
+
     def getAvailable(self):
         """
         Returns the names of all currently reserved machines
@@ -194,6 +661,45 @@ class DataBase(object):
         return [r[0] for r in rows]
     # getByUser()
 
+    def getGeneration(self):
+        """
+        Returns a counter which is incremented on every write done to the
+        database, so callers can tell whether data changed since they last
+        read it
+
+        @rtype: int
+        @returns: current write generation
+        """
+        return self.__generation
+    # getGeneration()
+
+    def getHistory(self, key, since):
+        """
+        Returns the reservation history of the machine or user with the passed
+        name since the passed time, oldest first
+
+        @type  key: basestring
+        @param key: machine or user name
+
+        @type  since: int
+        @param since: only events at or after this time are returned
+
+        @rtype: list
+        @returns: list of dicts with the name, user, action ('reserve' or
+                  'release') and time of each event
+        """
+        # execute select query
+        rows = self.__select(_QUERY_GET_HISTORY, (key, since, key, since))
+
+        # return events
+        return [{
+            'name': r[2],
+            'user': r[3],
+            'action': r[4],
+            'time': r[0],
+        } for r in rows]
+    # getHistory()
+
     def getInfo(self, name):
         """
         Returns info about the machine with the passed name
@@ -219,6 +725,7 @@ class DataBase(object):
             'group': rows[0][3],
             'user': rows[0][4],
             'start': rows[0][5],
+            'expires': rows[0][6],
         }
     # getInfo()
 
@@ -281,6 +788,128 @@ class DataBase(object):
         return [r[0] for r in rows]
     # getUsersByGroup()
 
+    def getWaiters(self, name):
+        """
+        Returns the users waiting for the machine with the passed name, first
+        come first
+
+        @type  name: basestring
+        @param name: machine name
+
+        @rtype: list
+        @returns: user names
+        """
+        # execute select query
+        rows = self.__select(_QUERY_GET_WAITERS, (name,))
+
+        # return users
+        return [r[0] for r in rows]
+    # getWaiters()
+
+    def getWaiting(self, user):
+        """
+        Returns the machines the passed user is waiting for, oldest first
+
+        @type  user: basestring
+        @param user: user name
+
+        @rtype: list
+        @returns: machine names
+        """
+        # execute select query
+        rows = self.__select(_QUERY_GET_WAITING, (user,))
+
+        # return names
+        return [r[0] for r in rows]
+    # getWaiting()
+
+    def reconcile(self, added, changed, removed, start = None):
+        """
+        Adds, updates and removes the passed machines in a single transaction.
+        Reservations are left untouched: only the description of changed
+        machines is updated and reserved machines are never removed.
+
+        @type  added: list
+        @param added: (name, ip, id, group) tuples of machines to be added
+
+        @type  changed: list
+        @param changed: (name, ip, id, group) tuples of machines to be updated
+
+        @type  removed: list
+        @param removed: names of machines to be removed
+
+        @type  start: int
+        @param start: time the added machines became available, defaults to
+                      now
+
+        @rtype: None
+        @returns: nothing
+        """
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
+
+        # apply all changes at once
+        with self.__transaction('RECONCILE') as c:
+            c.executemany(_QUERY_ADD, [(name, ip, id, group, start)
+                                       for name, ip, id, group in added])
+            c.executemany(_QUERY_UPDATE_INFO, [(ip, id, group, name)
+                                               for name, ip, id, group
+                                               in changed])
+            c.executemany(_QUERY_REMOVE_IF_FREE, [(name,) for name in removed])
+
+            if len(removed) > 0:
+                c.execute(_QUERY_DELETE_ORPHAN_WAITERS)
+    # reconcile()
+
+    def releaseMany(self, names, start = None, expires = None):
+        """
+        Sets all the machines with the passed names as reserved for no one, in
+        a single transaction
+
+        @type  names: list
+        @param names: machine names
+
+        @type  start: int
+        @param start: time the machines became available, defaults to now
+
+        @type  expires: dict
+        @param expires: when the reservation of each machine handed to a
+                        waiting user expires, never for machines not in it
+
+        @rtype: dict
+        @retruns: machines handed to waiting users, mapped to those users
+        """
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
+
+        # log and release all machines
+        handed = {}
+
+        with self.__transaction('RELEASE_MANY') as c:
+            c.executemany(_QUERY_LOG_RELEASE, [(start, name) for name in names])
+            c.executemany(_QUERY_RESERVE, [(None, start, None, name)
+                                           for name in names])
+
+            # hand each machine to the first waiting user allowed to use it
+            for name in names:
+                c.execute(_QUERY_GET_WAITERS, (name,))
+                end = (expires or {}).get(name)
+
+                for user in [r[0] for r in c.fetchall()]:
+                    c.execute(_QUERY_RESERVE_IF_FREE, (user, start, end, name,
+                                                       user))
+
+                    if c.rowcount == 1:
+                        c.execute(_QUERY_LOG_RESERVE, (name, user, start))
+                        c.execute(_QUERY_DEQUEUE, (name, user))
+                        handed[name] = user
+                        break
+
+        return handed
+    # releaseMany()
+
     def remove(self, name):
         """
         Removes the machine with the passed name
@@ -291,10 +920,14 @@ class DataBase(object):
         @rtype: None
         @retruns: nothing
         """
-        self.__write(_QUERY_REMOVE, (name,))
+        # log the end of the current reservation, if any, and remove
+        with self.__transaction('REMOVE') as c:
+            c.execute(_QUERY_LOG_RELEASE, (int(time.time()), name))
+            c.execute(_QUERY_REMOVE, (name,))
+            c.execute(_QUERY_DELETE_ORPHAN_WAITERS)
     # remove()
 
-    def reserve(self, name, user):
+    def reserve(self, name, user, start = None, expires = None):
         """
         Sets the machine with the passed name as reserved for the passed user.
         If user is passed as None, the effect is to set the machine as reserved
@@ -306,16 +939,113 @@ class DataBase(object):
         @type  user: basestring or None
         @param user: user the machine is to be reserved for
 
+        @type  start: int
+        @param start: time the reservation starts, defaults to now
+
+        @type  expires: int
+        @param expires: time the reservation expires, None for never
+
         @rtype: None
         @retruns: nothing
         """
-        # build params: user, current time, machine name
-        params = (user, int(time.time()), name)
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
 
-        # execute the update query
-        self.__write(_QUERY_RESERVE, params)
+        # log the end of the current reservation, if any, and the new one
+        with self.__transaction('RESERVE') as c:
+            c.execute(_QUERY_LOG_RELEASE, (start, name))
+            c.execute(_QUERY_RESERVE, (user, start, expires, name))
+
+            if user != None:
+                c.execute(_QUERY_LOG_RESERVE, (name, user, start))
     # reserve()
 
+    def reserveIfFree(self, name, user, start = None):
+        """
+        Sets the machine with the passed name as reserved for the passed user,
+        but only if it is currently available and the user is allowed to use
+        the machine group. Checking and reserving are done by a single
+        statement, so two users can never get the same machine.
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  user: basestring
+        @param user: user the machine is to be reserved for
+
+        @type  start: int
+        @param start: time the reservation starts, defaults to now
+
+        @rtype: bool
+        @returns: True if the machine was reserved, False otherwise
+        """
+        return self.reserveManyIfFree([name], user, start)[0]
+    # reserveIfFree()
+
+    def reserveManyIfFree(self, names, user, start = None, atomic = False,
+                          expires = None):
+        """
+        Does the same as reserveIfFree for all the passed machines, in a single
+        transaction
+
+        @type  names: list
+        @param names: machine names
+
+        @type  user: basestring
+        @param user: user the machines are to be reserved for
+
+        @type  start: int
+        @param start: time the reservations start, defaults to now
+
+        @type  atomic: bool
+        @param atomic: if True, no machine is reserved unless all of them are
+
+        @type  expires: dict
+        @param expires: when the reservation of each machine expires, never
+                        for machines not in it
+
+        @rtype: list
+        @returns: one bool per machine, True if the conditional update applied
+                  to it (all changes are undone when atomic is set and any of
+                  them is False)
+        """
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
+
+        # no expiry passed: reservations never expire
+        if expires == None:
+            expires = {}
+
+        # try to reserve every machine
+        results = []
+
+        try:
+            with self.__transaction('RESERVE_IF_FREE_MANY') as c:
+                for name in names:
+                    c.execute(_QUERY_RESERVE_IF_FREE, (user, start,
+                                                       expires.get(name), name,
+                                                       user))
+
+                    # not reserved: nothing to log
+                    if c.rowcount != 1:
+                        results.append(False)
+                        continue
+
+                    c.execute(_QUERY_LOG_RESERVE, (name, user, start))
+                    results.append(True)
+
+                # all or nothing requested and something failed: undo
+                if atomic and False in results:
+                    raise _Rollback()
+
+        except _Rollback:
+            pass
+
+        return results
+    # reserveManyIfFree()
+
     def unassociate(self, user, group):
         """
         Unassociates the passed user from the passed group
@@ -332,6 +1062,39 @@ class DataBase(object):
         self.__write(_QUERY_UNASSOCIATE, (user, group))
     # unassociate()
 
+    def waitMany(self, names, user, start = None):
+        """
+        Queues the passed user for each of the passed machines which is
+        reserved by someone else and whose group the user is allowed to use,
+        in a single transaction. Users already queued keep their place.
+
+        @type  names: list
+        @param names: machine names
+
+        @type  user: basestring
+        @param user: user name
+
+        @type  start: int
+        @param start: time the user started waiting, defaults to now
+
+        @rtype: list
+        @returns: one bool per machine, True if the user is queued for it
+        """
+        # no start time passed: use current time
+        if start == None:
+            start = int(time.time())
+
+        results = []
+
+        with self.__transaction('ENQUEUE_MANY') as c:
+            for name in names:
+                c.execute(_QUERY_ENQUEUE, (user, start, name, user, user))
+                c.execute(_QUERY_IS_WAITING, (name, user))
+                results.append(c.fetchone() != None)
+
+        return results
+    # waitMany()
+
 # DataBase
 
 
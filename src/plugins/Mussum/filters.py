@@ -0,0 +1,156 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+import re
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+# fields filter terms may use and the operators each accepts
+FIELDS = {
+    'group': ('=', '!='),
+    'held': ('>', '<'),
+    'id': ('=', '!='),
+    'ip': ('=', '!='),
+    'name': ('=', '!='),
+    'state': ('=', '!='),
+    'user': ('=', '!='),
+}
+
+# fields results may be sorted by
+SORT_KEYS = ('group', 'held', 'id', 'ip', 'name', 'user')
+
+# machine states, also accepted alone as words
+STATES = ('free', 'reserved')
+
+# <field><operator><value>, != must be tried before =
+TERM = re.compile('^([a-z]+)(!=|=|>|<)(.*)$')
+
+
+#
+# CODE
+#
+def isSimple(query):
+    """
+    Tells whether the passed query only selects by state and name pattern,
+    which the in-memory index answers without the database
+
+    @type  query: dict
+    @param query: query, as returned by parse
+
+    @rtype: bool
+    @returns: True if the query is simple, False otherwise
+    """
+    fields = [(field, operator) for field, operator, value in
+              query['terms']]
+
+    return query['sort'] == None and query['limit'] == None and \
+           len(fields) == len(set(fields)) and \
+           set(fields) <= set([('state', '='), ('name', '=')])
+# isSimple()
+
+def parse(args, parseTime):
+    """
+    Parses the passed show arguments into a query. Arguments are filter
+    terms such as group=pp, user!=bob, state=free, held>2d or ip=9.8.*, in
+    which values may be glob patterns, plus sort=<field> (sort=-<field> for
+    descending order) and limit=<count>. The words all, free and reserved
+    and bare names or glob patterns are also accepted, as in show free
+    lpar1*. All terms must match.
+
+    @type  args: list
+    @param args: show arguments
+
+    @type  parseTime: callable
+    @param parseTime: parses held values (e.g. 2d) into seconds, returning
+                      None if they are not valid
+
+    @rtype: dict
+    @returns: terms, as (field, operator, value) tuples, sort, as a (field,
+              descending) tuple or None, and limit, as a number or None
+
+    @raise ValueError: if an argument is not valid
+    """
+    query = {'terms': [], 'sort': None, 'limit': None}
+
+    for arg in args:
+        match = TERM.match(arg)
+
+        # bare word: all, a state or a name
+        if match == None:
+            if arg in STATES:
+                query['terms'].append(('state', '=', arg))
+            elif arg != 'all':
+                query['terms'].append(('name', '=', arg))
+            continue
+
+        field, operator, value = match.groups()
+
+        if value == '':
+            raise ValueError('missing value in %s' % arg)
+
+        # sort key: optionally descending
+        if field == 'sort' and operator == '=':
+            key = value.lstrip('-')
+
+            if key not in SORT_KEYS:
+                raise ValueError('cannot sort by %s, use one of %s' %
+                                 (key, ', '.join(SORT_KEYS)))
+
+            query['sort'] = (key, value.startswith('-'))
+            continue
+
+        # limit: positive number
+        if field == 'limit' and operator == '=':
+            if not value.isdigit() or int(value) == 0:
+                raise ValueError('limit must be a positive number')
+
+            query['limit'] = int(value)
+            continue
+
+        # filter term: check field, operator and value
+        if field not in FIELDS:
+            raise ValueError('unknown field %s, use one of %s' %
+                             (field, ', '.join(sorted(FIELDS))))
+
+        if operator not in FIELDS[field]:
+            raise ValueError('%s only accepts %s' %
+                             (field, ' or '.join(FIELDS[field])))
+
+        if field == 'state' and value not in STATES:
+            raise ValueError('state must be free or reserved')
+
+        if field == 'held':
+            value = parseTime(value)
+
+            if value == None:
+                raise ValueError('held must be a time such as 30m, 12h or 3d')
+
+        query['terms'].append((field, operator, value))
+
+    return query
+# parse()
+
+
@@ -0,0 +1,198 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+import heapq
+import itertools
+import threading
+import time
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+DEFAULT_WARNING = 900
+
+
+#
+# CODE
+#
+class LeaseTimer(object):
+    """
+    This tells when reservation leases are about to expire and when they
+    expire. Deadlines are kept in a heap and its thread sleeps until the
+    earliest one, so no table is ever scanned and nothing runs while no
+    deadline is due.
+
+    Deadlines are never removed: a lease which was released or renewed
+    leaves its old deadlines behind, and the callback must check the lease
+    still stands when they fire.
+    """
+
+    def __init__(self, callback, warning = DEFAULT_WARNING):
+        """
+        Constructor
+
+        @type  callback: callable
+        @param callback: called as callback(kind, name, user, expires) from
+                         the timer thread, kind being 'warn' or 'expire'
+
+        @type  warning: int
+        @param warning: seconds before expiry the warning is due, 0 for no
+                        warning
+
+        @rtype: None
+        @returns: nothing
+        """
+        self.warning = warning
+
+        self.__callback = callback
+        self.__condition = threading.Condition()
+        self.__deadlines = []
+        self.__sequence = itertools.count()
+        self.__stopped = False
+
+        self.__thread = threading.Thread(target = self.__run,
+                                         name = 'MussumLeaseTimer')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+    # __init__()
+
+    def __push(self, deadline, kind, name, user, expires):
+        """
+        Adds a deadline to the heap, waking the thread if it became the
+        earliest one. Must be called with the lock held.
+
+        @type  deadline: float
+        @param deadline: when the callback is due, as returned by time()
+
+        @type  kind: basestring
+        @param kind: 'warn' or 'expire'
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  user: basestring
+        @param user: user holding the machine
+
+        @type  expires: int
+        @param expires: when the lease expires
+
+        @rtype: None
+        @returns: nothing
+        """
+        # the sequence keeps deadlines at the same time in arrival order
+        heapq.heappush(self.__deadlines, (deadline, self.__sequence.next(),
+                                          kind, name, user, expires))
+
+        if self.__deadlines[0][0] == deadline:
+            self.__condition.notify()
+    # __push()
+
+    def __run(self):
+        """
+        Waits for each deadline in turn and calls the callback for it, until
+        stopped
+
+        @rtype: None
+        @returns: nothing
+        """
+        while True:
+            with self.__condition:
+
+                # sleep until the earliest deadline, or until one is added
+                while not self.__stopped and (len(self.__deadlines) == 0 or
+                                              time.time() <
+                                              self.__deadlines[0][0]):
+                    timeout = None
+
+                    if len(self.__deadlines) > 0:
+                        timeout = self.__deadlines[0][0] - time.time()
+
+                    self.__condition.wait(timeout)
+
+                if self.__stopped:
+                    return
+
+                deadline, sequence, kind, name, user, expires = \
+                    heapq.heappop(self.__deadlines)
+
+            self.__callback(kind, name, user, expires)
+    # __run()
+
+    def pending(self):
+        """
+        Returns how many deadlines are yet to fire
+
+        @rtype: int
+        @returns: number of deadlines
+        """
+        with self.__condition:
+            return len(self.__deadlines)
+    # pending()
+
+    def put(self, name, user, expires):
+        """
+        Schedules the warning and the expiry of the lease of the passed
+        machine. A warning already due is skipped; an expiry already due
+        fires at once.
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  user: basestring
+        @param user: user holding the machine
+
+        @type  expires: int
+        @param expires: when the lease expires, as returned by time()
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__condition:
+            warn = expires - self.warning
+
+            if self.warning > 0 and warn > time.time():
+                self.__push(warn, 'warn', name, user, expires)
+
+            self.__push(expires, 'expire', name, user, expires)
+    # put()
+
+    def stop(self):
+        """
+        Stops the timer, discarding the pending deadlines
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__condition:
+            self.__stopped = True
+            del self.__deadlines[:]
+            self.__condition.notify()
+
+        self.__thread.join()
+    # stop()
+
+# LeaseTimer
+
+
@@ -24,25 +24,392 @@
 #
 from db import DataBase
 
+import bisect
+import fnmatch
+import namelist
+import re
+import threading
+import time
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+# machine description fields, in the order of the (name, ip, id, group) tuples
+FIELDS = ('ip', 'id', 'group')
+
+# glob pattern special characters
+GLOB = re.compile('[*?[]')
+
 
 #
 # CODE
 #
+def _normalize(value):
+    """
+    Returns the passed field value as text, so values read from the database
+    (e.g. 2) compare equal to the same values read elsewhere (e.g. '2')
+
+    @type  value: object
+    @param value: field value
+
+    @rtype: unicode or None
+    @returns: value as text, None if it is None
+    """
+    if value == None:
+        return None
+
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+
+    return unicode(value)
+# _normalize()
+
+def isPattern(text):
+    """
+    Tells whether the passed text is a glob pattern, e.g. lpar1* or
+    vios[1-4], rather than a machine name
+
+    @type  text: basestring
+    @param text: text to be checked
+
+    @rtype: bool
+    @returns: True if it is a pattern, False otherwise
+    """
+    return GLOB.search(text) != None
+# isPattern()
+
+
 class MachineManager(object):
     """
-    This represents an entity which manages a set machines available to be used
+    This represents an entity which manages a set machines available to be used.
+
+    An in-memory index of all machines is kept and updated on every write, so
+    reads never need to reach the database. The index records the database
+    write generation it reflects and is reloaded whenever they differ. Names
+    are also kept sorted, so glob patterns only look at the names starting
+    with their literal prefix.
+
+    Users may queue for reserved machines. Released machines are handed to
+    the first user waiting for them, who is told through the listener.
+
+    Reservations may expire. Expiry is driven from outside (see LeaseTimer),
+    through expire, which releases the machine the same way release does.
     """
 
-    def __init__(self):
+    def __init__(self, db = None, listener = None, lease = None):
         """
         Constructor. Initializes the list of machines.
 
+        @type  db: DataBase
+        @param db: database to store machines in, a default one is opened if
+                   not passed
+
+        @type  listener: callable
+        @param listener: if passed, called as listener('handoff', name, user)
+                         after a released machine is handed to a waiting user,
+                         outside of any lock
+
+        @type  lease: callable
+        @param lease: if passed, called with the info of a machine being
+                      reserved, returns for how many seconds the reservation
+                      lasts by default, None for ever
+
         @rtype: None
         @returns: nothing
         """
-        self.__db = DataBase()
+        # no database passed: open the default one
+        if db == None:
+            db = DataBase()
+
+        self.__db = db
+        self.__listener = listener
+        self.__lease = lease
+
+        # writes hold this lock while changing the database and the index, so
+        # the index always reflects the order writes reached the database
+        self.__lock = threading.RLock()
+
+        # the index itself is guarded by a short lock, held to read it or to
+        # apply a write to it but never across database queries, so reads
+        # never wait for a write transaction
+        self.__indexLock = threading.Lock()
+
+        # load index from the database
+        self.reload()
     # __init__()
 
+    def __indexPut(self, info):
+        """
+        Adds the passed machine info to the in-memory index, replacing any
+        info already indexed for the same machine. Must be called with the
+        index lock held.
+
+        @type  info: dict
+        @param info: machine info, as returned by getInfo
+
+        @rtype: None
+        @returns: nothing
+        """
+        # remove old entry, if any, keeping its place in the sorted names
+        name = info['name']
+
+        if name in self.__machines:
+            self.__indexRemove(name, False)
+
+        elif self.__names != None:
+            bisect.insort(self.__names, name)
+
+        # index by name
+        self.__machines[name] = info
+
+        # index by state/user
+        user = info['user']
+
+        if user == None:
+            self.__free.add(name)
+        else:
+            self.__byUser.setdefault(user, set()).add(name)
+
+        # index by group
+        group = info['group']
+
+        if group != None:
+            self.__byGroup.setdefault(group, set()).add(name)
+    # __indexPut()
+
+    def __indexRemove(self, name, unsort = True):
+        """
+        Removes the machine with the passed name from the in-memory index.
+        Must be called with the index lock held.
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  unsort: bool
+        @param unsort: if False, the name is kept in the sorted names
+
+        @rtype: None
+        @returns: nothing
+        """
+        # machine not indexed: nothing to do
+        info = self.__machines.pop(name, None)
+
+        if info == None:
+            return
+
+        # remove from sorted names
+        if unsort and self.__names != None:
+            i = bisect.bisect_left(self.__names, name)
+            del self.__names[i]
+
+        # remove from state/user index
+        self.__free.discard(name)
+        self.__discard(self.__byUser, info['user'], name)
+
+        # remove from group index
+        self.__discard(self.__byGroup, info['group'], name)
+    # __indexRemove()
+
+    def __discard(self, index, key, name):
+        """
+        Removes the passed name from the set mapped by key in the passed index,
+        dropping the key when its set becomes empty
+
+        @type  index: dict
+        @param index: mapping of keys to sets of machine names
+
+        @type  key: basestring
+        @param key: key whose set contains the name
+
+        @type  name: basestring
+        @param name: machine name
+
+        @rtype: None
+        @returns: nothing
+        """
+        names = index.get(key, None)
+
+        if names == None:
+            return
+
+        names.discard(name)
+
+        if len(names) == 0:
+            del index[key]
+    # __discard()
+
+    def __expiry(self, names, start, duration = None):
+        """
+        Returns when reservations of the passed machines made at the passed
+        time expire
+
+        @type  names: list
+        @param names: names of indexed machines
+
+        @type  start: int
+        @param start: time the reservations start
+
+        @type  duration: int
+        @param duration: seconds the reservations last, by default the lease
+                         given for each machine
+
+        @rtype: dict
+        @returns: mapping of names to expiry times, machines whose
+                  reservations never expire are left out
+        """
+        expires = {}
+
+        for name in names:
+            length = duration
+
+            if length == None and self.__lease != None:
+                length = self.__lease(self.__machines[name])
+
+            if length != None:
+                expires[name] = start + length
+
+        return expires
+    # __expiry()
+
+    def __failure(self, name):
+        """
+        Refreshes the index entry for the passed machine from the database and
+        tells why it could not be reserved, since the index may have missed an
+        external change
+
+        @type  name: basestring
+        @param name: machine name
+
+        @rtype: int
+        @returns: 1 - machine does not exist
+                  2 - machine is already reserved
+                  3 - user has no permissions
+        """
+        info = self.__db.getInfo(name)
+
+        # machine does not exist: error
+        if len(info) == 0:
+            with self.__indexLock:
+                self.__indexRemove(name)
+
+            return 1
+
+        with self.__indexLock:
+            self.__indexPut(info)
+
+        # machine is already reserved: error
+        if info['user'] != None:
+            return 2
+
+        # user has no permissions: error
+        return 3
+    # __failure()
+
+    def __notify(self, event, handed):
+        """
+        Tells the listener, if any, about each of the passed machines
+
+        @type  event: basestring
+        @param event: event name
+
+        @type  handed: dict
+        @param handed: mapping of machine names to the users they concern
+
+        @rtype: None
+        @returns: nothing
+        """
+        if self.__listener == None:
+            return
+
+        for name in namelist.naturalSorted(handed):
+            self.__listener(event, name, handed[name])
+    # __notify()
+
+    def __release(self, names):
+        """
+        Releases the passed machines, handing them to waiting users, and
+        updates the index. Must be called with the lock held.
+
+        @type  names: list
+        @param names: names of indexed machines, without repetitions
+
+        @rtype: dict
+        @returns: machines handed to waiting users, mapped to those users
+        """
+        start = int(time.time())
+        expires = self.__expiry(names, start)
+        handed = self.__db.releaseMany(names, start, expires)
+
+        with self.__indexLock:
+            for name in names:
+                user = handed.get(name)
+                end = None
+
+                if user != None:
+                    end = expires.get(name)
+
+                info = dict(self.__machines[name], user = user, start = start,
+                            expires = end)
+                self.__indexPut(info)
+
+        self.__generation = self.__db.getGeneration()
+
+        return handed
+    # __release()
+
+    def __refresh(self):
+        """
+        Syncs the in-memory index before a read, unless a write is in progress:
+        the write syncs the index itself, and meanwhile reads are served from
+        the index as the last finished write left it
+
+        @rtype: None
+        @returns: nothing
+        """
+        if not self.__lock.acquire(False):
+            return
+
+        try:
+            self.__sync()
+
+        finally:
+            self.__lock.release()
+    # __refresh()
+
+    def __sync(self):
+        """
+        Reloads the in-memory index if the database was written behind it.
+        Must be called with the lock held.
+
+        @rtype: None
+        @returns: nothing
+        """
+        if self.__generation != self.__db.getGeneration():
+            self.reload()
+    # __sync()
+
+    def __unique(self, names):
+        """
+        Returns the passed names without repetitions, keeping their order
+
+        @type  names: list
+        @param names: machine names
+
+        @rtype: list
+        @returns: names without repetitions
+        """
+        seen = set()
+        unique = []
+
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                unique.append(name)
+
+        return unique
+    # __unique()
+
     def add(self, name, ip = None, id = None, group = None):
         """
         Adds a machine with the passed name
@@ -63,17 +430,230 @@ class MachineManager(object):
         @retruns: 0 - success
                   1 - machine already exists
         """
-        # machine already exists: error
-        if name in self.__db.getMachines():
-            return 1
+        with self.__lock:
+            self.__sync()
+
+            # machine already exists: error
+            if name in self.__machines:
+                return 1
 
-        # add machine
-        self.__db.add(name, ip, id, group)
+            # add machine
+            start = int(time.time())
+            self.__db.add(name, ip, id, group, start)
+
+            with self.__indexLock:
+                self.__indexPut({
+                    'name': name,
+                    'ip': ip,
+                    'id': id,
+                    'group': group,
+                    'user': None,
+                    'start': start,
+                    'expires': None,
+                })
+
+            self.__generation = self.__db.getGeneration()
 
         # success
         return 0
     # add()
 
+    def addMany(self, machines):
+        """
+        Adds all the passed machines at once. Machines which already exist (or
+        appear more than once in the passed list) are not added.
+
+        @type  machines: list
+        @param machines: list of (name, ip, id, group) tuples
+
+        @rtype: list
+        @returns: list of (name, status) tuples, where status is:
+                  0 - success
+                  1 - machine already exists
+        """
+        with self.__lock:
+            self.__sync()
+
+            # split machines into new and already existing ones
+            results = []
+            new = {}
+
+            for machine in machines:
+                name = machine[0]
+
+                # machine already exists: error
+                if name in self.__machines or name in new:
+                    results.append((name, 1))
+                    continue
+
+                # machine is new: add it
+                new[name] = machine
+                results.append((name, 0))
+
+            # no new machines: nothing else to do
+            if len(new) == 0:
+                return results
+
+            # add all new machines at once
+            start = int(time.time())
+            self.__db.addMany(new.values(), start)
+
+            with self.__indexLock:
+                for name, ip, id, group in new.values():
+                    self.__indexPut({
+                        'name': name,
+                        'ip': ip,
+                        'id': id,
+                        'group': group,
+                        'user': None,
+                        'start': start,
+                        'expires': None,
+                    })
+
+            self.__generation = self.__db.getGeneration()
+
+        # return per machine results
+        return results
+    # addMany()
+
+    def compactHistory(self, before):
+        """
+        Deletes the reservation history older than the passed time
+
+        @type  before: int
+        @param before: events before this time are deleted
+
+        @rtype: int
+        @returns: number of events deleted
+        """
+        with self.__lock:
+            self.__sync()
+
+            count = self.__db.deleteHistory(before)
+            self.__generation = self.__db.getGeneration()
+
+        return count
+    # compactHistory()
+
+    def expand(self, names, accept = None):
+        """
+        Returns the passed machine names with the glob patterns among them
+        replaced by the names they match. Patterns matching nothing are kept,
+        so they can be reported as not found.
+
+        @type  names: list
+        @param names: machine names and glob patterns
+
+        @type  accept: callable
+        @param accept: see match
+
+        @rtype: list
+        @returns: machine names
+        """
+        expanded = []
+
+        for name in names:
+            matched = isPattern(name) and self.match(name, accept)
+            expanded.extend(matched or [name])
+
+        return expanded
+    # expand()
+
+    def expire(self, name, expires):
+        """
+        Releases the machine with the passed name if its reservation expired
+        at the passed time, like release does. Nothing is done if the machine
+        was released, reserved again or its reservation renewed since.
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  expires: int
+        @param expires: expiry time of the reservation to end
+
+        @rtype: bool
+        @returns: True if the machine was released, False otherwise
+        """
+        with self.__lock:
+            self.__sync()
+
+            # reservation already ended, changed or not due yet: nothing to do
+            info = self.__machines.get(name, None)
+
+            if info == None or info['user'] == None or \
+               info['expires'] != expires or expires > time.time():
+                return False
+
+            handed = self.__release([name])
+
+        # tell the new holder
+        self.__notify('handoff', handed)
+
+        return True
+    # expire()
+
+    def find(self, terms, sort = None, limit = None):
+        """
+        Returns info about the machines matching all the passed filter terms,
+        queried from the database, see DataBase.find
+
+        @type  terms: list
+        @param terms: (field, operator, value) tuples, as returned by
+                      filters.parse
+
+        @type  sort: tuple
+        @param sort: field to sort by and whether in descending order
+
+        @type  limit: int
+        @param limit: most machines returned, None for all
+
+        @rtype: list
+        @returns: info about the matching machines
+        """
+        return self.__db.find(terms, sort, limit)
+    # find()
+
+    def getGeneration(self):
+        """
+        Returns the database write generation the in-memory index reflects,
+        see DataBase.getGeneration. Anything built from the machines while it
+        stays the same is still valid. A write in progress is only seen once
+        it is applied to the index too.
+
+        @rtype: int
+        @returns: current write generation
+        """
+        self.__refresh()
+
+        with self.__indexLock:
+            return self.__generation
+    # getGeneration()
+
+    def getHistory(self, key, since = 0):
+        """
+        Returns the reservation history of the machine or user with the passed
+        name since the passed time, oldest first. Each event is returned as a
+        dictionary like this:
+
+            event = {
+                'name': 'machineA',   # machine name
+                'user': 'userX',      # who reserved or released the machine
+                'action': 'reserve',  # 'reserve' or 'release'
+                'time': 1309049448,   # when it happened, as returned by time()
+            }
+
+        @type  key: basestring
+        @param key: machine or user name
+
+        @type  since: int
+        @param since: only events at or after this time are returned
+
+        @rtype: list
+        @returns: reservation events
+        """
+        return self.__db.getHistory(key, since)
+    # getHistory()
+
     def getInfo(self, name):
         """
         Returns info about the machine with the passed name, or None if the
@@ -86,7 +666,9 @@ class MachineManager(object):
                 'group': 'groupA'     # group the machine belongs to
                 'user': 'userX',      # who is using the machine, or None
                 'start': 1309049448,  # when machine became reserved or
-            }                         # available, as returned by time()
+                                      # available, as returned by time()
+                'expires': None,      # when the reservation expires, or
+            }                         # None if it never does
 
         @type  name: basestring
         @param name: machine name
@@ -94,16 +676,101 @@ class MachineManager(object):
         @rtype: dict or None
         @returns: info about the machine, None if it does not exist
         """
-        # machine does not exist: error
-        info = self.__db.getInfo(name)
+        self.__refresh()
 
-        if len(info) == 0:
-            return None
+        with self.__indexLock:
+            # machine does not exist: error
+            info = self.__machines.get(name, None)
+
+            if info == None:
+                return None
 
-        # exists: return info
-        return info
+            # exists: return a copy of the info
+            return dict(info)
     # getInfo()
 
+    def getInfoMany(self, names):
+        """
+        Returns info about all the machines with the passed names, as returned
+        by getInfo, taken from a single consistent view of the machines
+
+        @type  names: list
+        @param names: machine names
+
+        @rtype: list
+        @returns: list of (name, info) tuples, info being None for machines
+                  that do not exist
+        """
+        self.__refresh()
+
+        with self.__indexLock:
+            results = []
+
+            for name in names:
+                info = self.__machines.get(name, None)
+
+                if info != None:
+                    info = dict(info)
+
+                results.append((name, info))
+
+            return results
+    # getInfoMany()
+
+    def getWaiters(self, name):
+        """
+        Returns the users waiting for the machine with the passed name, in the
+        order they will get it
+
+        @type  name: basestring
+        @param name: machine name
+
+        @rtype: list
+        @returns: user names
+        """
+        return self.__db.getWaiters(name)
+    # getWaiters()
+
+    def getWaiting(self, user):
+        """
+        Returns the machines the passed user is waiting for, oldest first
+
+        @type  user: basestring
+        @param user: user name
+
+        @rtype: list
+        @returns: machine names
+        """
+        return self.__db.getWaiting(user)
+    # getWaiting()
+
+    def leaveMany(self, names, user):
+        """
+        Removes the passed user from the queues of all the machines with the
+        passed names, in a single transaction
+
+        @type  names: list
+        @param names: machine names
+
+        @type  user: basestring
+        @param user: user name
+
+        @rtype: list
+        @retruns: list of (name, status) tuples, where status is:
+                  0 - success
+                  1 - user is not waiting for the machine
+        """
+        names = self.__unique(names)
+
+        with self.__lock:
+            self.__sync()
+
+            left = self.__db.dequeueMany(names, user)
+            self.__generation = self.__db.getGeneration()
+
+        return [(name, int(not success)) for name, success in zip(names, left)]
+    # leaveMany()
+
     def listAvailable(self):
         """
         Returns the names of all machines that are currently available
@@ -111,9 +778,28 @@ class MachineManager(object):
         @rtype: list
         @retruns: names of all machines that are currently available
         """
-        return self.__db.getAvailable()
+        self.__refresh()
+
+        with self.__indexLock:
+            return namelist.naturalSorted(self.__free)
     # listAvailable()
 
+    def listByGroup(self, group):
+        """
+        Returns the names of all machines that belong to the passed group
+
+        @type  group: basestring
+        @param group: group name
+
+        @rtype: list
+        @retruns: names of all machines that belong to the group
+        """
+        self.__refresh()
+
+        with self.__indexLock:
+            return namelist.naturalSorted(self.__byGroup.get(group, ()))
+    # listByGroup()
+
     def listByUser(self, user):
         """
         Returns the names of all machines that are currently reserved
@@ -121,9 +807,28 @@ class MachineManager(object):
         @rtype: list
         @retruns: names of all machines that are currently reserved
         """
-        return self.__db.getByUser(user)
+        self.__refresh()
+
+        with self.__indexLock:
+            return namelist.naturalSorted(self.__byUser.get(user, ()))
     # listByUser()
 
+    def listLeases(self):
+        """
+        Returns the reservations which expire, soonest first
+
+        @rtype: list
+        @returns: list of (name, user, expires) tuples
+        """
+        self.__refresh()
+
+        with self.__indexLock:
+            return sorted([(info['name'], info['user'], info['expires'])
+                           for info in self.__machines.itervalues()
+                           if info['expires'] != None],
+                          key = lambda lease: lease[2])
+    # listLeases()
+
     def listMachines(self):
         """
         Returns the names of all machines contained in this manager
@@ -131,7 +836,10 @@ class MachineManager(object):
         @rtype: list
         @retruns: names of all machines contained in this manager
         """
-        return self.__db.getMachines()
+        self.__refresh()
+
+        with self.__indexLock:
+            return namelist.naturalSorted(self.__machines)
     # listMachines()
 
     def listReserved(self):
@@ -141,7 +849,12 @@ class MachineManager(object):
         @rtype: list
         @retruns: names of all machines that are currently reserved
         """
-        return self.__db.getReserved()
+        self.__refresh()
+
+        with self.__indexLock:
+            return namelist.naturalSorted([name for names in
+                                           self.__byUser.values()
+                                           for name in names])
     # listReserved()
 
     def listUsers(self):
@@ -151,12 +864,55 @@ class MachineManager(object):
         @rtype: list
         @retruns: users which currently have reserved machines
         """
-        return self.__db.getUsers()
+        self.__refresh()
+
+        with self.__indexLock:
+            return namelist.naturalSorted(self.__byUser)
     # listUsers()
 
+    def match(self, pattern, accept = None):
+        """
+        Returns the names of all machines matching the passed glob pattern, in
+        which * matches any text, ? any character and [...] any of the
+        characters listed. Only the names starting with the text before the
+        first special character are looked at.
+
+        @type  pattern: basestring
+        @param pattern: glob pattern, e.g. lpar1* or vios[1-4]
+
+        @type  accept: callable
+        @param accept: if passed, called with the info of each matching
+                       machine, which is only returned if it returns True
+
+        @rtype: list
+        @returns: names of the matching machines, in natural order
+        """
+        prefix = GLOB.split(pattern, 1)[0]
+        matched = []
+
+        self.__refresh()
+
+        with self.__indexLock:
+            # walk the names starting with the prefix
+            i = bisect.bisect_left(self.__names, prefix)
+
+            while i < len(self.__names) and \
+                  self.__names[i].startswith(prefix):
+                name = self.__names[i]
+                i += 1
+
+                if not fnmatch.fnmatchcase(name, pattern):
+                    continue
+
+                if accept == None or accept(self.__machines[name]):
+                    matched.append(name)
+
+        return namelist.naturalSorted(matched)
+    # match()
+
     def release(self, name):
         """
-        Adds a machine with the passed name
+        Sets the machine with the passed name as available
 
         @type  name: basestring
         @param name: machine name
@@ -165,16 +921,215 @@ class MachineManager(object):
         @retruns: 0 - success
                   1 - machine does not exist
         """
-        # machine does not exist: error
-        if name not in self.__db.getMachines():
-            return 1
+        return self.releaseMany([name])[0][1]
+    # release()
 
-        # release machine
-        self.__db.reserve(name, None)
+    def reconcile(self, machines, dryRun = False, maxRemoved = None):
+        """
+        Makes the registered machines match the passed ones: machines not
+        registered yet are added, registered machines whose description
+        differs are updated and registered machines not passed are removed,
+        all in a single transaction. Reservations are never disturbed, so
+        reserved machines are kept even when not passed. If a machine is
+        passed more than once, only its first occurrence is considered.
 
-        # success
-        return 0
-    # release()
+        A truncated or empty list would remove most machines, so removals can
+        be limited: when no machine is passed, or more than the passed
+        fraction of the registered machines would be removed, nothing is
+        removed and the machines are reported as withheld instead.
+
+        The differences found are returned like this:
+
+            diff = {
+                'added': ['machineA'],                # new machines
+                'changed': [('machineB', ['ip'])],    # updated fields
+                'removed': ['machineC'],              # removed machines
+                'kept': ['machineD'],                 # reserved, not removed
+                'withheld': ['machineE'],             # over the limit, not
+            }                                         # removed
+
+        @type  machines: list
+        @param machines: list of (name, ip, id, group) tuples
+
+        @type  dryRun: bool
+        @param dryRun: if True, only find the differences, change nothing
+
+        @type  maxRemoved: float
+        @param maxRemoved: most machines removed at once, as a fraction of the
+                           registered ones, None for no limit
+
+        @rtype: dict
+        @returns: differences between registered and passed machines
+        """
+        with self.__lock:
+            self.__sync()
+
+            # compare passed machines to the registered ones
+            wanted = set()
+            added = []
+            changed = []
+            diff = {'added': [], 'changed': [], 'removed': [], 'kept': [],
+                    'withheld': []}
+
+            for machine in machines:
+                name = machine[0]
+
+                # repeated machine: ignore
+                if name in wanted:
+                    continue
+
+                wanted.add(name)
+
+                # machine not registered: add it
+                info = self.__machines.get(name, None)
+
+                if info == None:
+                    added.append(machine)
+                    diff['added'].append(name)
+                    continue
+
+                # description differs: update it
+                fields = [field for field, value in zip(FIELDS, machine[1:])
+                          if _normalize(info[field]) != _normalize(value)]
+
+                if len(fields) > 0:
+                    changed.append(machine)
+                    diff['changed'].append((name, fields))
+
+            # registered machines not passed: remove them unless reserved
+            for name, info in self.__machines.iteritems():
+                if name in wanted:
+                    continue
+
+                if info['user'] == None:
+                    diff['removed'].append(name)
+                else:
+                    diff['kept'].append(name)
+
+            for key in ('added', 'removed', 'kept'):
+                diff[key] = namelist.naturalSorted(diff[key])
+
+            # nothing passed or too many removals: the list is likely
+            # incomplete, do not remove anything
+            if maxRemoved != None and len(diff['removed']) > 0 and \
+               (len(wanted) == 0 or
+                len(diff['removed']) > maxRemoved * len(self.__machines)):
+                diff['withheld'] = diff['removed']
+                diff['removed'] = []
+
+            diff['changed'].sort(key = lambda entry:
+                                 namelist.naturalKey(entry[0]))
+
+            # preview only or nothing to change: done
+            if dryRun or (len(added) == 0 and len(changed) == 0 and
+                          len(diff['removed']) == 0):
+                return diff
+
+            # apply differences
+            start = int(time.time())
+            self.__db.reconcile(added, changed, diff['removed'], start)
+
+            with self.__indexLock:
+                for name, ip, id, group in added:
+                    self.__indexPut({
+                        'name': name,
+                        'ip': ip,
+                        'id': id,
+                        'group': group,
+                        'user': None,
+                        'start': start,
+                        'expires': None,
+                    })
+
+                for name, ip, id, group in changed:
+                    info = dict(self.__machines[name], ip = ip, id = id,
+                                group = group)
+                    self.__indexPut(info)
+
+                for name in diff['removed']:
+                    self.__indexRemove(name)
+
+            self.__generation = self.__db.getGeneration()
+
+        return diff
+    # reconcile()
+
+    def releaseMany(self, names):
+        """
+        Sets all the machines with the passed names as available, in a single
+        transaction. Machines with users waiting for them are reserved for the
+        first of those users allowed to use them instead.
+
+        @type  names: list
+        @param names: machine names
+
+        @rtype: list
+        @retruns: list of (name, status) tuples, where status is:
+                  0 - success
+                  1 - machine does not exist
+        """
+        with self.__lock:
+            self.__sync()
+
+            # split machines into existing and unknown ones
+            results = []
+            released = []
+
+            for name in self.__unique(names):
+
+                # machine does not exist: error
+                if name not in self.__machines:
+                    results.append((name, 1))
+                    continue
+
+                released.append(name)
+                results.append((name, 0))
+
+            # no machine to release: nothing else to do
+            if len(released) == 0:
+                return results
+
+            # release machines
+            handed = self.__release(released)
+
+        # tell the new holders
+        self.__notify('handoff', handed)
+
+        # return per machine results
+        return results
+    # releaseMany()
+
+    def reload(self):
+        """
+        Discards the in-memory index and loads it again from the database. This
+        must be called if the database file is changed by someone else.
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__lock:
+
+            # read the generation first: a write racing with the load only
+            # causes another reload
+            generation = self.__db.getGeneration()
+            machines = self.__db.getAll()
+
+            with self.__indexLock:
+                self.__machines = {}
+                self.__free = set()
+                self.__byUser = {}
+                self.__byGroup = {}
+
+                # names are sorted once at the end instead of one by one
+                self.__names = None
+
+                for info in machines:
+                    self.__indexPut(info)
+
+                self.__names = sorted(self.__machines)
+
+            self.__generation = generation
+    # reload()
 
     def remove(self, name):
         """
@@ -187,17 +1142,40 @@ class MachineManager(object):
         @retruns: 0 - success
                   1 - machine does not exist
         """
-        # machine does not exist: error
-        if name not in self.__db.getMachines():
-            return 1
+        with self.__lock:
+            self.__sync()
+
+            # machine does not exist: error
+            if name not in self.__machines:
+                return 1
+
+            # remove machine
+            self.__db.remove(name)
+
+            with self.__indexLock:
+                self.__indexRemove(name)
 
-        # remove machine
-        self.__db.remove(name)
+            self.__generation = self.__db.getGeneration()
 
         # success
         return 0
     # remove()
 
+    def reservationsByUser(self):
+        """
+        Returns the names of the machines reserved by each user which currently
+        has reserved machines, all at once
+
+        @rtype: dict
+        @returns: mapping of users to the names of the machines they reserved
+        """
+        self.__refresh()
+
+        with self.__indexLock:
+            return dict([(user, namelist.naturalSorted(names))
+                         for user, names in self.__byUser.iteritems()])
+    # reservationsByUser()
+
     def reserve(self, name, user):
         """
         Sets the machine with the passed as reserved for the passed user
@@ -214,28 +1192,135 @@ class MachineManager(object):
                   2 - machine is already reserved
                   3 - user has no permissions
         """
-        # machine does not exist: error
-        info = self.__db.getInfo(name)
+        return self.reserveMany([name], user)[0][1]
+    # reserve()
 
-        if len(info) == 0:
-            return 1
+    def reserveMany(self, names, user, atomic = False, wait = False,
+                    duration = None):
+        """
+        Sets all the machines with the passed names as reserved for the passed
+        user, in a single transaction
 
-        # machine is already reserved: error
-        if info['user'] != None:
-            return 2
+        @type  names: list
+        @param names: machine names
 
-        # user has no permissions: error
-        group = info['group']
+        @type  user: basestring
+        @param user: user the machines are to be reserved for
 
-        if group != None and user not in self.__db.getUsersByGroup(group):
-            return 3
+        @type  atomic: bool
+        @param atomic: if True, no machine is reserved unless all of them can be
 
-        # reserve machine
-        self.__db.reserve(name, user)
+        @type  wait: bool
+        @param wait: if True, the user is queued for the machines reserved by
+                     someone else, getting them when they are released
 
-        # success
-        return 0
-    # reserve()
+        @type  duration: int
+        @param duration: seconds the reservations last, by default the lease
+                         given for each machine
+
+        @rtype: list
+        @retruns: list of (name, status) tuples, where status is:
+                  0 - success
+                  1 - machine does not exist
+                  2 - machine is already reserved
+                  3 - user has no permissions
+                  4 - not reserved because another machine failed (atomic)
+                  5 - machine is reserved, user queued for it
+        """
+        with self.__lock:
+            self.__sync()
+
+            # check what is already known to fail from the index
+            status = {}
+            candidates = []
+
+            for name in self.__unique(names):
+                info = self.__machines.get(name, None)
+
+                # machine does not exist: error
+                if info == None:
+                    status[name] = 1
+
+                # machine is already reserved: error
+                elif info['user'] != None:
+                    status[name] = 2
+
+                else:
+                    candidates.append(name)
+
+            # all or nothing requested and something already failed: stop
+            if atomic and len(status) > 0:
+                candidates = []
+
+            # try to reserve the remaining machines
+            start = int(time.time())
+            expires = self.__expiry(candidates, start, duration)
+            reserved = []
+
+            if len(candidates) > 0:
+                reserved = self.__db.reserveManyIfFree(candidates, user, start,
+                                                       atomic, expires)
+
+            applied = atomic == False or False not in reserved
+
+            failed = []
+
+            with self.__indexLock:
+                for name, success in zip(candidates, reserved):
+
+                    # not reserved: find out why below
+                    if not success:
+                        failed.append(name)
+
+                    # reserved but undone since another machine failed
+                    elif not applied:
+                        status[name] = 4
+
+                    # machine reserved: update index
+                    else:
+                        info = dict(self.__machines[name], user = user,
+                                    start = start, expires = expires.get(name))
+                        self.__indexPut(info)
+                        status[name] = 0
+
+            # failures are looked up in the database, out of the index lock
+            for name in failed:
+                status[name] = self.__failure(name)
+
+            # reserved by someone else but the user has no permissions for
+            # the group: that is the error to report, and no queue to join
+            busy = [name for name in self.__unique(names)
+                    if status.get(name) == 2]
+            allowed = {}
+
+            for name in busy:
+                group = self.__machines[name]['group']
+
+                if group == None:
+                    continue
+
+                if group not in allowed:
+                    allowed[group] = user in self.__db.getUsersByGroup(group)
+
+                if not allowed[group]:
+                    status[name] = 3
+
+            # queue the user for the machines reserved by someone else
+            busy = [name for name in busy if status[name] == 2]
+
+            if wait and len(busy) > 0:
+                queued = self.__db.waitMany(busy, user, start)
+
+                for name, success in zip(busy, queued):
+                    if success:
+                        status[name] = 5
+
+            self.__generation = self.__db.getGeneration()
+
+            # machines not tried because of the all or nothing mode
+            return [(name, status.get(name, 4))
+                    for name in self.__unique(names)]
+    # reserveMany()
 
 # MachineManager
 
@@ -0,0 +1,268 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+import contextlib
+import json
+import threading
+import time
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0, float('inf'))
+
+
+#
+# CODE
+#
+class Metrics(object):
+    """
+    This collects call counts, errors and latency histograms of named
+    operations, grouped by kind (e.g. commands and database queries). It is
+    thread safe and cheap enough to be used around every call.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+
+        @rtype: None
+        @returns: nothing
+        """
+        self.__lock = threading.Lock()
+
+        # kind -> name -> [count, errors, total time, bucket counts]
+        self.__data = {}
+    # __init__()
+
+    def record(self, kind, name, latency, error = False):
+        """
+        Records one call of the passed operation
+
+        @type  kind: basestring
+        @param kind: kind of operation (e.g. 'command', 'query')
+
+        @type  name: basestring
+        @param name: operation name
+
+        @type  latency: float
+        @param latency: how long the call took, in seconds
+
+        @type  error: bool
+        @param error: True if the call failed
+
+        @rtype: None
+        @returns: nothing
+        """
+        # find the bucket
+        bucket = 0
+
+        while latency > BUCKETS[bucket]:
+            bucket += 1
+
+        # update the operation entry
+        with self.__lock:
+            entry = self.__data.setdefault(kind, {}).get(name, None)
+
+            if entry == None:
+                entry = [0, 0, 0.0, [0] * len(BUCKETS)]
+                self.__data[kind][name] = entry
+
+            entry[0] += 1
+            entry[1] += int(error)
+            entry[2] += latency
+            entry[3][bucket] += 1
+    # record()
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        """
+        Records the time spent in the body of a with block as one call of the
+        passed operation, failed if the block raises an exception
+
+        @type  kind: basestring
+        @param kind: kind of operation (e.g. 'command', 'query')
+
+        @type  name: basestring
+        @param name: operation name
+
+        @rtype: None
+        @returns: nothing
+        """
+        start = time.time()
+
+        try:
+            yield
+
+        except:
+            self.record(kind, name, time.time() - start, True)
+            raise
+
+        self.record(kind, name, time.time() - start)
+    # timer()
+
+    def reset(self):
+        """
+        Discards everything recorded so far
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__lock:
+            self.__data = {}
+    # reset()
+
+    def snapshot(self):
+        """
+        Returns a copy of everything recorded so far, like this:
+
+            snapshot = {
+                'command': {                    # kind of operation
+                    'show': {                   # operation name
+                        'count': 12,            # number of calls
+                        'errors': 0,            # number of failed calls
+                        'sum': 0.031,           # total time, in seconds
+                        'buckets': [3, 8, ...], # calls per BUCKETS entry
+                    },
+                },
+            }
+
+        @rtype: dict
+        @returns: recorded metrics
+        """
+        snapshot = {}
+
+        with self.__lock:
+            for kind, operations in self.__data.iteritems():
+                snapshot[kind] = {}
+
+                for name, entry in operations.iteritems():
+                    snapshot[kind][name] = {
+                        'count': entry[0],
+                        'errors': entry[1],
+                        'sum': entry[2],
+                        'buckets': list(entry[3]),
+                    }
+
+        return snapshot
+    # snapshot()
+
+    def toJson(self):
+        """
+        Returns everything recorded so far as a JSON document
+
+        @rtype: basestring
+        @returns: JSON document, with the format returned by snapshot plus the
+                  bucket bounds
+        """
+        return json.dumps({
+            'time': int(time.time()),
+            'bounds': [str(b) for b in BUCKETS],
+            'metrics': self.snapshot(),
+        }, indent = 2, sort_keys = True)
+    # toJson()
+
+    def toPrometheus(self, prefix = 'mussum'):
+        """
+        Returns everything recorded so far in the Prometheus text exposition
+        format: one histogram and one error counter per kind of operation,
+        labeled by operation name
+
+        @type  prefix: basestring
+        @param prefix: prefix of the metric names
+
+        @rtype: basestring
+        @returns: metrics as text
+        """
+        lines = []
+
+        for kind, operations in sorted(self.snapshot().iteritems()):
+            metric = '%s_%s_seconds' % (prefix, kind)
+            errors = '%s_%s_errors_total' % (prefix, kind)
+
+            # latency histogram, buckets are cumulative
+            lines.append('# TYPE %s histogram' % metric)
+
+            for name, stats in sorted(operations.iteritems()):
+                count = 0
+
+                for bound, value in zip(BUCKETS, stats['buckets']):
+                    count += value
+                    le = bound == float('inf') and '+Inf' or repr(bound)
+                    lines.append('%s_bucket{name="%s",le="%s"} %d' %
+                                 (metric, name, le, count))
+
+                lines.append('%s_sum{name="%s"} %r' % (metric, name,
+                             stats['sum']))
+                lines.append('%s_count{name="%s"} %d' % (metric, name,
+                             stats['count']))
+
+            # error counter
+            lines.append('# TYPE %s counter' % errors)
+
+            for name, stats in sorted(operations.iteritems()):
+                lines.append('%s{name="%s"} %d' % (errors, name,
+                             stats['errors']))
+
+        return '\n'.join(lines) + '\n'
+    # toPrometheus()
+
+# Metrics
+
+
+def percentile(stats, percent):
+    """
+    Estimates the passed percentile of an operation latency from its
+    histogram, as the upper bound of the bucket where it falls
+
+    @type  stats: dict
+    @param stats: operation metrics, as returned in Metrics.snapshot
+
+    @type  percent: int
+    @param percent: percentile, from 1 to 100
+
+    @rtype: float
+    @returns: latency upper bound in seconds, 0 if nothing was recorded
+    """
+    # nothing recorded: no latency
+    if stats['count'] == 0:
+        return 0.0
+
+    # find the bucket where the percentile falls
+    rank = stats['count'] * percent / 100.0
+    count = 0
+
+    for bound, value in zip(BUCKETS, stats['buckets']):
+        count += value
+
+        if count >= rank:
+            return bound
+
+    return BUCKETS[-1]
+# percentile()
+
+
@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+import re
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+# runs shorter than this are listed name by name
+MIN_RANGE = 3
+
+# splits names into text and numbers, for natural ordering
+NUMBERS = re.compile('([0-9]+)')
+
+# name ending in a number, e.g. lpar01
+NUMBERED = re.compile('^(.*?)([0-9]+)$')
+
+
+#
+# CODE
+#
+def _closeRun(run):
+    """
+    Returns the entries for the passed run of consecutive names: a range if
+    it is long enough, or each name otherwise
+
+    @type  run: list
+    @param run: names and their prefix and number text
+
+    @rtype: list
+    @returns: entries
+    """
+    if len(run) < MIN_RANGE:
+        return [name for name, numbered in run]
+
+    return ['%s-%s' % (run[0][0], run[-1][0])]
+# _closeRun()
+
+def _isNext(previous, current):
+    """
+    Tells whether the passed numbered names are consecutive in a range, e.g.
+    lpar09 and lpar10 or vios9 and vios10, but not lpar9 and lpar010
+
+    @type  previous: tuple
+    @param previous: prefix and number text of the previous name
+
+    @type  current: tuple
+    @param current: prefix and number text of the current name
+
+    @rtype: bool
+    @returns: True if the names are consecutive, False otherwise
+    """
+    if previous[0] != current[0] or \
+       int(current[1]) != int(previous[1]) + 1:
+        return False
+
+    # same width, or no padding in either
+    return len(current[1]) == len(previous[1]) or \
+           (previous[1][0] != '0' and current[1][0] != '0')
+# _isNext()
+
+def compress(names):
+    """
+    Sorts the passed names in natural order and collapses runs of
+    consecutive numbered names into ranges, e.g. lpar01, lpar02, lpar03 and
+    vios1 become lpar01-lpar03 and vios1
+
+    @type  names: iterable
+    @param names: machine names
+
+    @rtype: list
+    @returns: names and ranges, in natural order
+    """
+    entries = []
+    run = []
+
+    for name in naturalSorted(names):
+        match = NUMBERED.match(name)
+        numbered = match and match.groups()
+
+        # name continues the current run: extend it
+        if numbered and run and _isNext(run[-1][1], numbered):
+            run.append((name, numbered))
+            continue
+
+        # otherwise, close the current run and start another
+        entries.extend(_closeRun(run))
+        run = numbered and [(name, numbered)] or []
+
+        if not numbered:
+            entries.append(name)
+
+    entries.extend(_closeRun(run))
+
+    return entries
+# compress()
+
+def naturalKey(name):
+    """
+    Returns the key that sorts the passed name in natural order, in which
+    numbers are compared by value, e.g. lpar2 before lpar10
+
+    @type  name: basestring
+    @param name: machine name
+
+    @rtype: tuple
+    @returns: sort key
+    """
+    parts = NUMBERS.split(name)
+
+    # numbers are at odd positions
+    for i in range(1, len(parts), 2):
+        parts[i] = int(parts[i])
+
+    # names equal by value (e.g. lpar1 and lpar01) are still ordered
+    return parts, name
+# naturalKey()
+
+def naturalSorted(names):
+    """
+    Returns the passed names sorted in natural order
+
+    @type  names: iterable
+    @param names: machine names
+
+    @rtype: list
+    @returns: sorted names
+    """
+    return sorted(names, key = naturalKey)
+# naturalSorted()
+
+
@@ -22,17 +22,66 @@
 #
 # IMPORTS
 #
+from db import DataBase
+from leasetimer import LeaseTimer
 from machinemanager import MachineManager
+from metrics import Metrics
+from replyqueue import ReplyQueue
+from workerpool import WorkerPool
 from supybot.commands import *
 
-import readwiki
+import filters
+import metrics
+import namelist
+import random
+import re
+import replyqueue
+import sources
 import supybot.callbacks as callbacks
+import supybot.ircdb as ircdb
+import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.plugins as plugins
+import supybot.schedule as schedule
 import supybot.utils as utils
+import supybot.world as world
+import threading
 import time
 
 
+#
+# CONSTANTS AND DEFINITIONS
+#
+DEFAULT_HISTORY_PERIOD = 7 * 86400
+HISTORY_ACTIONS = {
+    'reserve': 'reserved',
+    'release': 'released',
+}
+HISTORY_EVENT = 'MussumCompactHistory'
+INFO_HEADERS = ('Name', 'Ip', 'Id', 'Group', 'Status', 'User')
+INFO_SEPARATOR = ' | '
+RESPONSE_CACHE_SIZE = 256
+SHOW_TITLES = {
+    None: 'Registered machines',
+    'free': 'Available machines',
+    'reserved': 'Reserved machines',
+}
+SYNC_EVENT = 'MussumSync'
+SYNC_RETRY = 60
+TIME_INTERVAL = re.compile('^(\d+)([smhdw])$')
+TIME_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+}
+
+# commands which write to the database, run apart from the ones which only
+# read so slow writes never hold reads back
+WRITE_COMMANDS = ('add', 'free', 'queue', 'reserve', 'update')
+
+
 #
 # CODE
 #
@@ -41,7 +90,7 @@ class Mussum(callbacks.Plugin):
     Add the help for "@plugin help Mussum" here
     This should describe *how* to use this plugin.
     """
-    threaded = True
+    threaded = False
 
     def __init__(self, irc):
         """
@@ -51,19 +100,268 @@ class Mussum(callbacks.Plugin):
         callbacks.Plugin.__init__(self, irc)
 
         # initialize internal state
-        self.__manager = MachineManager()
+        self.__metrics = Metrics()
+
+        # network each user last reserved from, so they are only told about
+        # their reservations and queues there
+        self.__networks = {}
+
+        db = DataBase(self.registryValue('database.path') or None,
+                      poolSize = self.registryValue('database.poolSize'),
+                      timeout = self.registryValue('database.timeout'),
+                      metrics = self.__metrics)
+        self.__manager = MachineManager(db, self.__handoff,
+                                        self.__leaseLength)
+
+        # expire reservations from a timer which sleeps until the next
+        # deadline, starting with the ones left from before a restart
+        self.__leases = LeaseTimer(self.__leaseEvent,
+                                   self.registryValue('leases.warning'))
+
+        for name, user, expires in self.__manager.listLeases():
+            self.__leases.put(name, user, expires)
+
+        # replies to show and users, valid while the database generation they
+        # were built at is the current one
+        self.__responses = {}
+        self.__responsesGeneration = None
+        self.__responsesLock = threading.Lock()
+
+        # commands run on bounded pools instead of a thread each, reads and
+        # writes apart
+        queueSize = self.registryValue('workers.queueSize')
+        self.__readers = WorkerPool('MussumReads',
+                                    self.registryValue('workers.reads'),
+                                    queueSize, self.__metrics)
+        self.__writers = WorkerPool('MussumWrites',
+                                    self.registryValue('workers.writes'),
+                                    queueSize, self.__metrics)
+
+        # bulk output is paced apart from interactive replies
+        self.__replies = ReplyQueue(self.registryValue('replies.rate'),
+                                    self.registryValue('replies.limit'))
+
+        # delete old reservation history once a day
+        schedule.addPeriodicEvent(self.__compactHistory, 86400,
+                                  name=HISTORY_EVENT)
+
+        # update machines from the inventory sources in background, one
+        # update at a time
+        self.__sources = {}
+        self.__syncLock = threading.Lock()
+        self.__syncFailures = 0
+        self.__stopping = False
+        self.__scheduleSync()
     # __init__()
 
-    def __formatList(self, entries):
+    def __backgroundSync(self):
         """
-        Formats the passed list of entries and returns it as a string
+        Updates the machines from the inventory sources, posts a summary to the
+        configured channels if anything changed and schedules the next update.
+        Runs in its own thread.
+
+        @rtype: None
+        @returns: nothing
+        """
+        # an update is already in progress: try again later
+        if not self.__syncLock.acquire(False):
+            self.__scheduleSync()
+            return
+
+        try:
+            diff = self.__syncMachines(
+                       timeout = self.registryValue('sync.timeout'))
+            self.__syncFailures = 0
+
+        except Exception, e:
+            self.log.warning('Mussum: background update failed: %s', e)
+            self.__syncFailures += 1
+            diff = None
+
+        finally:
+            self.__syncLock.release()
+
+        # plugin being unloaded: stop
+        if self.__stopping:
+            return
+
+        self.__scheduleSync()
+
+        # nothing changed: nothing to report
+        if diff == None or len(diff['added']) + len(diff['changed']) + \
+           len(diff['removed']) + len(diff['withheld']) == 0:
+            return
+
+        # removals withheld: warn, they need someone to check the inventory
+        if len(diff['withheld']) > 0:
+            self.log.warning('Mussum: background update withheld the '
+                             'removal of %s machines', len(diff['withheld']))
+
+        # post summary to the configured channels the bot is in
+        text = 'Machines updated from inventory: %s' % self.__formatDiff(diff)
+
+        for irc in world.ircs:
+            for channel in self.registryValue('sync.channels'):
+                if channel in irc.state.channels:
+                    irc.queueMsg(ircmsgs.privmsg(channel, text))
+    # __backgroundSync()
+
+    def __bulkReply(self, irc, target, lines, coalesce = True):
+        """
+        Queues the passed lines to be sent to the passed target at the
+        configured pace, behind any interactive reply
+
+        @type  irc: supybot.callbacks.NestedCommandsIrcProxy
+        @param irc: where the command came from
+
+        @type  target: basestring
+        @param target: nick or channel
+
+        @type  lines: list
+        @param lines: lines to send
+
+        @type  coalesce: bool
+        @param coalesce: if False, each line is sent in its own message
+
+        @rtype: None
+        @returns: nothing
+        """
+        # settings may have changed since the last reply
+        self.__replies.rate = self.registryValue('replies.rate')
+        self.__replies.limit = self.registryValue('replies.limit')
+        self.__replies.put(irc.getRealIrc(), target, lines, coalesce)
+    # __bulkReply()
+
+    def __cacheResponse(self, key, generation, text):
+        """
+        Keeps the passed reply to be reused until the database is written
+
+        @type  key: tuple
+        @param key: command name and arguments
+
+        @type  generation: int
+        @param generation: database generation read before building the reply
+
+        @type  text: basestring
+        @param text: reply
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__responsesLock:
+
+            # database written while the reply was built: it may be stale
+            if generation < self.__responsesGeneration:
+                return
+
+            # database written since the replies kept were built: drop them
+            if generation != self.__responsesGeneration or \
+               len(self.__responses) >= RESPONSE_CACHE_SIZE:
+                self.__responses = {}
+                self.__responsesGeneration = generation
+
+            self.__responses[key] = text
+    # __cacheResponse()
+
+    def __cachedResponse(self, key, generation):
+        """
+        Returns the reply kept for the passed command and arguments, if the
+        database was not written since it was built
+
+        @type  key: tuple
+        @param key: command name and arguments
+
+        @type  generation: int
+        @param generation: current database generation
+
+        @rtype: basestring or None
+        @returns: reply, None if there is none for the current generation
+        """
+        with self.__responsesLock:
+            if generation != self.__responsesGeneration:
+                return None
+
+            return self.__responses.get(key, None)
+    # __cachedResponse()
+
+    def __compactHistory(self):
+        """
+        Deletes the reservation history older than the configured retention
+
+        @rtype: None
+        @returns: nothing
+        """
+        # history is to be kept forever: nothing to do
+        retention = self.registryValue('history.retention')
+
+        if retention == 0:
+            return
+
+        # delete old history
+        self.__manager.compactHistory(int(time.time()) - retention * 86400)
+    # __compactHistory()
+
+    def __formatDiff(self, diff):
+        """
+        Formats the counts of the passed machine differences as a string
+
+        @type  diff: dict
+        @param diff: differences, as returned by MachineManager.reconcile
+
+        @rtype: basestring
+        @returns: formatted string
+        """
+        text = '%s added, %s changed, %s removed, %s kept as reserved' % (
+               len(diff['added']), len(diff['changed']), len(diff['removed']),
+               len(diff['kept']))
+
+        # removals refused since the inventory looks incomplete
+        if len(diff['withheld']) > 0:
+            text += '; %s not removed since the inventory looks incomplete, ' \
+                    'run update --force to remove them' % \
+                    len(diff['withheld'])
+
+        return text
+    # __formatDiff()
+
+    def __formatField(self, field, info):
+        """
+        Formats the passed field of the passed machine info as a string
+
+        @type  field: basestring
+        @param field: field name, as accepted by filters.parse
+
+        @type  info: dict
+        @param info: machine info, as returned by MachineManager.getInfo
+
+        @rtype: basestring
+        @returns: formatted string
+        """
+        # held: how long the machine is in the current state
+        if field == 'held':
+            return self.__formatTime(int(time.time()) - info['start'])
+
+        return '%s' % info[field]
+    # __formatField()
+
+    def __formatList(self, entries, compress = True):
+        """
+        Formats the passed list of machine names and returns it as a string,
+        in natural order and with consecutive names collapsed into ranges,
+        e.g. 'lpar01-lpar40 and vios1'
 
         @type  entries: list
         @param entries: list to be formatted
 
+        @type  compress: bool
+        @param compress: if False, entries are kept as passed, in their order
+
         @rtype: basestring
         @returns: formatted string
         """
+        if compress:
+            entries = namelist.compress(entries)
+
         # no entries: return 'no machines'
         if len(entries) == 0:
             return 'no machines'
@@ -103,6 +401,569 @@ class Mussum(callbacks.Plugin):
         return '%sd' % (interval / 86400)
     # __formatTime()
 
+    def __formatLatency(self, latency):
+        """
+        Formats the passed latency upper bound in milliseconds or seconds
+
+        @type  latency: float
+        @param latency: latency in seconds, as returned by metrics.percentile
+
+        @rtype: basestring
+        @returns: formatted string
+        """
+        # above the last bucket: only its lower bound is known
+        if latency == metrics.BUCKETS[-1]:
+            return '>%gs' % metrics.BUCKETS[-2]
+
+        # less than a second: return as milliseconds
+        if latency < 1:
+            return '<%gms' % (latency * 1000)
+
+        # return as seconds
+        return '<%gs' % latency
+    # __formatLatency()
+
+    def __formatMetrics(self, operations):
+        """
+        Formats the passed operation metrics as a string
+
+        @type  operations: dict
+        @param operations: metrics of operations of a kind, as returned by
+                           Metrics.snapshot
+
+        @rtype: basestring
+        @returns: formatted string
+        """
+        # no operations: return 'none'
+        if len(operations) == 0:
+            return 'none'
+
+        # 'name calls/errors p50 p95 p99' for each operation
+        output = []
+
+        for name, stats in sorted(operations.iteritems()):
+            output.append('%s %s/%s %s %s %s' % (name, stats['count'],
+                          stats['errors'],
+                          self.__formatLatency(metrics.percentile(stats, 50)),
+                          self.__formatLatency(metrics.percentile(stats, 95)),
+                          self.__formatLatency(metrics.percentile(stats, 99))))
+
+        return ', '.join(output)
+    # __formatMetrics()
+
+    def __formatTable(self, headers, rows):
+        """
+        Formats the passed rows in aligned columns under the passed headers.
+        As many rows as fit in replyqueue.LINE_LENGTH are packed side by side
+        in each line, so fewer lines are sent.
+
+        @type  headers: tuple
+        @param headers: column headers
+
+        @type  rows: list
+        @param rows: rows, each a tuple of strings with one per column
+
+        @rtype: list
+        @returns: lines, the first one with the headers
+        """
+        # columns as wide as their widest value
+        widths = [max([len(row[i]) for row in rows] + [len(headers[i])])
+                  for i in range(len(headers))]
+        cells = lambda row: ' '.join([value.ljust(width) for value, width in
+                                      zip(row, widths)])
+
+        # pack as many rows per line as fit, at least one
+        width = len(cells(headers)) + len(INFO_SEPARATOR)
+        perLine = max(1, (replyqueue.LINE_LENGTH + len(INFO_SEPARATOR)) /
+                         width)
+        perLine = min(perLine, len(rows))
+
+        lines = [INFO_SEPARATOR.join([cells(headers)] * perLine).rstrip()]
+
+        for i in range(0, len(rows), perLine):
+            line = INFO_SEPARATOR.join([cells(row) for row in
+                                        rows[i:i + perLine]])
+            lines.append(line.rstrip())
+
+        return lines
+    # __formatTable()
+
+    def __infoCompact(self, irc, msg, names):
+        """
+        Sends the info for the passed machines in aligned columns, as few
+        lines as possible
+
+        @type  irc: supybot.callbacks.NestedCommandsIrcProxy
+        @param irc: where to reply to
+
+        @type  msg: supybot.ircmsgs.IrcMsg
+        @param msg: command message
+
+        @type  names: list
+        @param names: machine names
+
+        @rtype: None
+        @returns: nothing
+        """
+        now = int(time.time())
+        missing = []
+        rows = []
+
+        for machine, info in self.__manager.getInfoMany(names):
+
+            # machine does not exist: report it apart
+            if info == None:
+                missing.append(machine)
+                continue
+
+            # get how long machine is in the current state
+            status = 'available'
+
+            if info['user'] != None:
+                status = 'reserved'
+
+            status += ' (%s)' % self.__formatTime(now - info['start'])
+
+            # missing values are shown as -
+            row = (info['name'], info['ip'], info['id'], info['group'], status,
+                   info['user'])
+            rows.append(tuple([value == None and '-' or unicode(value)
+                               for value in row]))
+
+        if len(missing) > 0:
+            irc.reply('Machines not found: %s' % self.__formatList(missing),
+                      prefixNick=True)
+
+        if len(rows) == 0:
+            return
+
+        # table lines are already packed: each one in its own message
+        self.__bulkReply(irc, msg.nick, self.__formatTable(INFO_HEADERS, rows),
+                         False)
+    # __infoCompact()
+
+    def __infoVerbose(self, irc, msg, names):
+        """
+        Sends the info for the passed machines with each field in its own
+        line. Past replies.limit, only whole machines are sent and the rest
+        are summarized in a single line.
+
+        @type  irc: supybot.callbacks.NestedCommandsIrcProxy
+        @param irc: where to reply to
+
+        @type  msg: supybot.ircmsgs.IrcMsg
+        @param msg: command message
+
+        @type  names: list
+        @param names: machine names
+
+        @rtype: None
+        @returns: nothing
+        """
+        now = int(time.time())
+        blocks = []
+
+        for machine, info in self.__manager.getInfoMany(names):
+
+            # machine does not exist: no info
+            if info == None:
+                irc.reply('Machine %s does not exist' % machine,
+                          prefixNick=True)
+                continue
+
+            # get how long machine is in the current state
+            interval = self.__formatTime(now - info['start'])
+            block = [
+                '# Name   : %s' % info['name'],
+                '# Ip     : %s' % info['ip'],
+                '# Id     : %s' % info['id'],
+                '# Group  : %s' % info['group'],
+            ]
+            blocks.append(block)
+
+            # machine is available: report it
+            if info['user'] == None:
+                block.append('# Status : available (%s)' % interval)
+                continue
+
+            # machine is reserved: also show for whom
+            block.append('# Status : reserved (%s)' % interval)
+            block.append('# User   : %s' % info['user'])
+
+            # reservation expires: also show when
+            if info['expires'] != None:
+                remaining = max(0, info['expires'] - now)
+                block.append('# Expires: in %s' %
+                             self.__formatTime(remaining))
+
+        # too many lines: send whole machines only, leaving a line to tell
+        # how many were left out
+        limit = self.registryValue('replies.limit')
+        output = [line for lines in blocks for line in lines]
+
+        if limit > 0 and len(output) > limit:
+            output = []
+            shown = 0
+
+            while len(output) + len(blocks[shown]) < limit:
+                output.extend(blocks[shown])
+                shown += 1
+
+            output.append('(%s more machines not shown)' %
+                          (len(blocks) - shown))
+
+        self.__bulkReply(irc, msg.nick, output, False)
+    # __infoVerbose()
+
+    def __parseTime(self, text):
+        """
+        Parses a time interval formatted like __formatTime does, also accepting
+        weeks (e.g. 30m, 12h, 3d, 2w)
+
+        @type  text: basestring
+        @param text: time interval to be parsed
+
+        @rtype: int or None
+        @returns: time interval in seconds, None if text is not valid
+        """
+        # invalid interval: error
+        match = TIME_INTERVAL.match(text)
+
+        if match == None:
+            return None
+
+        # convert to seconds
+        return int(match.group(1)) * TIME_UNITS[match.group(2)]
+    # __parseTime()
+
+    def __runCommand(self, command, irc, msg, args, kwargs):
+        """
+        Runs the passed command on a worker thread through supybot's usual
+        handling: capabilities are checked, invalid arguments get the usage
+        and errors are logged and replied to
+
+        @rtype: None
+        @returns: nothing
+        """
+        callbacks.Plugin._callCommand(self, command, irc, msg, *args, **kwargs)
+    # __runCommand()
+
+    def __scheduleSync(self):
+        """
+        Schedules the next background update, if enabled. After failures, the
+        update is retried sooner, doubling the wait after each one.
+
+        @rtype: None
+        @returns: nothing
+        """
+        # background updates disabled or plugin being unloaded: nothing to do
+        interval = self.registryValue('sync.interval')
+
+        if interval == 0 or self.__stopping:
+            return
+
+        # get how long to wait
+        delay = interval
+
+        if self.__syncFailures > 0:
+            delay = min(SYNC_RETRY * 2 ** (self.__syncFailures - 1), interval)
+
+        delay += random.randint(0, self.registryValue('sync.jitter'))
+
+        # start the update in its own thread, so the network does not block
+        # the bot
+        def start():
+            thread = threading.Thread(target = self.__backgroundSync,
+                                      name = SYNC_EVENT)
+            thread.setDaemon(True)
+            thread.start()
+
+        schedule.addEvent(start, time.time() + delay, name = SYNC_EVENT)
+    # __scheduleSync()
+
+    def __showSimple(self, fields):
+        """
+        Returns the names of the machines in the passed state and matching
+        the passed name pattern, from the in-memory index
+
+        @type  fields: dict
+        @param fields: state (free or reserved) and name pattern, both
+                       optional
+
+        @rtype: list
+        @returns: machine names
+        """
+        state = fields.get('state', None)
+        accept = None
+
+        if state == 'free':
+            accept = lambda info: info['user'] == None
+        elif state == 'reserved':
+            accept = lambda info: info['user'] != None
+
+        # pattern passed: list only the machines matching it
+        if 'name' in fields:
+            return self.__manager.match(fields['name'], accept)
+
+        if state == 'free':
+            return self.__manager.listAvailable()
+
+        if state == 'reserved':
+            return self.__manager.listReserved()
+
+        return self.__manager.listMachines()
+    # __showSimple()
+
+    def __syncMachines(self, force = False, dryRun = False, timeout = None):
+        """
+        Makes the registered machines match the ones listed in the inventory
+        sources, if they changed since the last update. Unless forced, no
+        machine is removed if the sources list none, or if more than the
+        sync.maxRemoved fraction of the registered machines would be.
+
+        @type  force: bool
+        @param force: if True, process the machines even if they did not change
+                      and remove all the machines no longer listed
+
+        @type  dryRun: bool
+        @param dryRun: if True, only find the differences, change nothing
+
+        @type  timeout: float
+        @param timeout: seconds to wait for each source, None waits forever
+
+        @rtype: dict or None
+        @returns: differences, as returned by MachineManager.reconcile, or None
+                  if the machines did not change
+        """
+        # machines did not change: nothing to do (a preview is never saved as
+        # the last update, so it always gets all machines)
+        inventory = self.__getSources()
+        table, snapshots = sources.fetchAll(inventory,
+                                            self.registryValue('sync.workers'),
+                                            timeout, force or dryRun)
+
+        if table == None:
+            sources.saveAll(inventory, snapshots)
+            return None
+
+        # get machines from table
+        machines = []
+
+        for machine in table:
+
+            # machine without name: ignore
+            name = machine.get('name', None)
+
+            if name == None:
+                continue
+
+            # get machine info
+            ip = machine.get('ip', None)
+            id = machine.get('id', None)
+            group = machine.get('group', None)
+
+            machines.append((name, ip, id, group))
+
+        # apply the differences at once
+        maxRemoved = None
+
+        if not force:
+            maxRemoved = self.registryValue('sync.maxRemoved')
+
+        diff = self.__manager.reconcile(machines, dryRun, maxRemoved)
+
+        # sources only remember what they listed once it is applied, so an
+        # update which failed or withheld removals is tried again next time
+        if not dryRun and len(diff['withheld']) == 0:
+            sources.saveAll(inventory, snapshots)
+
+        return diff
+    # __syncMachines()
+
+    def __getSources(self):
+        """
+        Returns the configured inventory sources. Sources are kept between
+        calls, so they remember what they fetched last.
+
+        @rtype: list
+        @returns: inventory sources, in order of precedence
+        """
+        specs = self.registryValue('sync.sources')
+
+        # create sources not created yet and forget the ones not configured
+        # anymore
+        self.__sources = dict([(spec, self.__sources.get(spec, None) or
+                                sources.createSource(spec))
+                               for spec in specs])
+
+        return [self.__sources[spec] for spec in specs]
+    # __getSources()
+
+    def __groupByStatus(self, results):
+        """
+        Groups the machine names in the passed results by their status
+
+        @type  results: list
+        @param results: list of (name, status) tuples
+
+        @rtype: dict
+        @returns: mapping of status to the names with that status, in order
+        """
+        groups = {}
+
+        for name, status in results:
+            groups.setdefault(status, []).append(name)
+
+        return groups
+    # __groupByStatus()
+
+    def __handoff(self, event, name, user):
+        """
+        Tells the user a released machine was handed to that it is now
+        reserved for them
+
+        @type  event: basestring
+        @param event: manager event, only 'handoff' is handled
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  user: basestring
+        @param user: user the machine is now reserved for
+
+        @rtype: None
+        @returns: nothing
+        """
+        if event != 'handoff':
+            return
+
+        self.__tell(user, 'Machine %s was released and is now reserved for '
+                          'you' % name)
+        self.__watchLeases([name])
+    # __handoff()
+
+    def __leaseEvent(self, kind, name, user, expires):
+        """
+        Warns the holder of a reservation about to expire, or releases it once
+        expired. Runs in the lease timer thread.
+
+        @type  kind: basestring
+        @param kind: 'warn' or 'expire'
+
+        @type  name: basestring
+        @param name: machine name
+
+        @type  user: basestring
+        @param user: user holding the machine
+
+        @type  expires: int
+        @param expires: when the reservation expires
+
+        @rtype: None
+        @returns: nothing
+        """
+        try:
+            # expired: release through the manager, which also hands the
+            # machine to the first waiting user
+            if kind == 'expire':
+                if self.__manager.expire(name, expires):
+                    self.__tell(user, 'Your reservation of %s expired and the '
+                                      'machine was released' % name)
+                return
+
+            # reservation ended or changed since: nothing to warn about
+            info = self.__manager.getInfo(name)
+
+            if info == None or info['user'] != user or \
+               info['expires'] != expires:
+                return
+
+            self.__tell(user, 'Your reservation of %s expires in %s' %
+                        (name, self.__formatTime(expires - int(time.time()))))
+
+        # the timer thread must survive
+        except Exception:
+            self.log.exception('Mussum: lease %s of %s failed', kind, name)
+    # __leaseEvent()
+
+    def __leaseLength(self, info):
+        """
+        Returns for how long reservations of the passed machine last when the
+        reserve command does not tell
+
+        @type  info: dict
+        @param info: machine info
+
+        @rtype: int or None
+        @returns: lease length in seconds, None if reservations never expire
+        """
+        length = self.registryValue('leases.default')
+
+        # group has its own lease length: use it
+        for entry in self.registryValue('leases.groups'):
+            group, separator, groupLength = entry.partition(':')
+
+            if group == info['group']:
+                length = groupLength
+                break
+
+        # empty, zero or invalid length: never expire
+        return self.__parseTime(length) or None
+    # __leaseLength()
+
+    def __tell(self, user, text):
+        """
+        Sends the passed text to the passed user in private, on the network
+        the user last reserved from
+
+        @type  user: basestring
+        @param user: nick
+
+        @type  text: basestring
+        @param text: message text
+
+        @rtype: None
+        @returns: nothing
+        """
+        network = self.__networks.get(user, None)
+
+        # network unknown, e.g. reserved before a restart: only guess it when
+        # the bot is on a single one
+        if network == None and len(world.ircs) == 1:
+            network = world.ircs[0].network
+
+        for irc in world.ircs:
+            if irc.network == network:
+                irc.queueMsg(ircmsgs.privmsg(user, text))
+                return
+
+        self.log.info('Mussum: no network known to tell %s: %s', user, text)
+    # __tell()
+
+    def __watchLeases(self, names):
+        """
+        Schedules the expiry of the reservations of the passed machines
+
+        @type  names: list
+        @param names: machine names
+
+        @rtype: list
+        @returns: expiry times of the reservations which expire
+        """
+        # settings may have changed since the last reservation
+        self.__leases.warning = self.registryValue('leases.warning')
+        expiries = []
+
+        for name, info in self.__manager.getInfoMany(names):
+            if info == None or info['expires'] == None:
+                continue
+
+            self.__leases.put(name, info['user'], info['expires'])
+            expiries.append(info['expires'])
+
+        return expiries
+    # __watchLeases()
+
     def add(self, irc, msg, args):
         """
         Adds the machines whose names are passed as args
@@ -114,17 +975,48 @@ class Mussum(callbacks.Plugin):
             return
 
         # add machines
-        for arg in args:
+        results = self.__manager.addMany([(arg, None, None, None)
+                                          for arg in args])
 
-            # error adding machine: report it
-            if self.__manager.add(arg) != 0:
-                irc.reply('Machine %s already exists' % arg, prefixNick=False)
-                continue
+        # report which machines were added and which already existed
+        added = [name for name, status in results if status == 0]
+        existing = [name for name, status in results if status == 1]
+
+        if len(added) > 0:
+            irc.reply('Machines added: %s' % self.__formatList(added),
+                      prefixNick=False)
 
-            # success: report it
-            irc.reply('Machine %s added' % arg, prefixNick=False)
+        if len(existing) > 0:
+            irc.reply('Machines already existing: %s' %
+                      self.__formatList(existing), prefixNick=False)
     # add()
 
+    def _callCommand(self, command, irc, msg, *args, **kwargs):
+        """
+        Queues the passed command to run on the reads or writes worker pool,
+        replying at once if too many commands are waiting
+        """
+        pool = self.__readers
+
+        if command[0] in WRITE_COMMANDS:
+            pool = self.__writers
+
+        # too many commands waiting: ask to retry instead of piling up
+        if not pool.submit(self.__runCommand, command, irc, msg, args,
+                           kwargs):
+            irc.reply('Busy, retry in a moment', prefixNick=True)
+    # _callCommand()
+
+    def callCommand(self, command, irc, msg, *args, **kwargs):
+        """
+        Runs the passed command, recording how long it took and whether it
+        failed
+        """
+        with self.__metrics.timer('command', ' '.join(command)):
+            callbacks.Plugin.callCommand(self, command, irc, msg, *args,
+                                         **kwargs)
+    # callCommand()
+
     def cerveja(self, irc, msg, args):
         """
         Checks to see if the bot is alive.
@@ -134,7 +1026,9 @@ class Mussum(callbacks.Plugin):
 
     def free(self, irc, msg, args):
         """
-        Releases the machine whose name is passed as argument
+        Releases the machines whose names are passed as arguments. Glob
+        patterns, such as lpar1* or vios[1-4], match the machines reserved by
+        the caller.
         """
         # no arg passed: show how to use
         if len(args) == 0:
@@ -143,181 +1037,454 @@ class Mussum(callbacks.Plugin):
             return
 
         # free machines
-        for machine in args:
-
-            # machine released: done
-            status = self.__manager.release(machine)
+        machines = self.__manager.expand(args,
+                                         lambda info: info['user'] == msg.nick)
+        results = self.__groupByStatus(self.__manager.releaseMany(machines))
 
-            if status == 0:
-                irc.reply('Machine %s has been released' % machine,
-                          prefixNick=False)
-                continue
+        # report released machines
+        if 0 in results:
+            irc.reply('Machines released: %s' % self.__formatList(results[0]),
+                      prefixNick=False)
 
-            # machine does not exist: error
-            if status == 1:
-                irc.reply('Machine %s does not exist' % machine,
-                          prefixNick=True)
-                continue
+        # machines do not exist: error
+        if 1 in results:
+            irc.reply('Machines not found: %s' % self.__formatList(results[1]),
+                      prefixNick=True)
     # free()
 
+    def die(self):
+        """
+        Stops the periodic events scheduled by this plugin, the command
+        workers, the sending of bulk output and the expiry of reservations
+        """
+        self.__stopping = True
+        self.__readers.stop()
+        self.__writers.stop()
+        self.__replies.stop()
+        self.__leases.stop()
+        schedule.removeEvent(HISTORY_EVENT)
+
+        # background update may be running instead of scheduled
+        try:
+            schedule.removeEvent(SYNC_EVENT)
+
+        except KeyError:
+            pass
+
+        callbacks.Plugin.die(self)
+    # die()
+
+    def history(self, irc, msg, args):
+        """
+        Shows who reserved and released the machine, or which machines the
+        user reserved and released, whose name is passed as argument since the
+        passed time ago (e.g. 12h, 3d, 2w), by default in the last week
+        """
+        # wrong number of args passed: show how to use
+        if len(args) not in (1, 2):
+            irc.reply('Usage: history <machine | user> [<since>]',
+                      prefixNick=True)
+            return
+
+        # get period to show
+        period = DEFAULT_HISTORY_PERIOD
+
+        if len(args) == 2:
+            period = self.__parseTime(args[1])
+
+        # invalid period: show how to use
+        if period == None:
+            irc.reply('Usage: history <machine | user> [<since>]',
+                      prefixNick=True)
+            return
+
+        # no history found: report it
+        now = int(time.time())
+        events = self.__manager.getHistory(args[0], now - period)
+
+        if len(events) == 0:
+            irc.reply('No reservations for %s in the last %s' %
+                      (args[0], self.__formatTime(period)), prefixNick=True)
+            return
+
+        # show events
+        output = []
+
+        for event in events:
+            output.append('%s %s %s %s ago' % (event['user'],
+                          HISTORY_ACTIONS[event['action']], event['name'],
+                          self.__formatTime(now - event['time'])))
+
+        irc.reply('History of %s: %s' % (args[0], ', '.join(output)),
+                  prefixNick=False)
+    # history()
+
     def info(self, irc, msg, args):
         """
-        Shows info for the machine whose name is passed as argument
+        Shows info for the machines whose names or glob patterns (such as
+        lpar1* or vios[1-4]) are passed as arguments, one row per machine in
+        aligned columns. With --verbose, shows each field in its own line.
         """
         # no arg passed: show how to use
-        if len(args) == 0:
-            irc.reply('Usage: info <machine 1> [... <machine N>]',
+        verbose = '--verbose' in args
+        names = self.__manager.expand([arg for arg in args
+                                       if arg != '--verbose'])
+
+        if len(names) == 0:
+            irc.reply('Usage: info [--verbose] <machine 1> [... <machine N>]',
                       prefixNick=True)
             return
 
         # tell the user to see the info in pvt
         irc.reply('pvt', prefixNick=True)
 
-        # show machines
-        for machine in args:
+        # compact: one row per machine, several per line
+        if not verbose:
+            self.__infoCompact(irc, msg, names)
+            return
 
-            # machine does not exist: no info
-            info = self.__manager.getInfo(machine)
+        # verbose: one line per field
+        self.__infoVerbose(irc, msg, names)
+    # info()
 
-            if info == None:
-                irc.reply('Machine %s does not exist' % machine,
+    def queue(self, irc, msg, args):
+        """
+        Shows the machines the caller is waiting for or, if a machine name is
+        passed, the users waiting for it. With leave, removes the caller from
+        the queues of the passed machines.
+        """
+        user = msg.nick
+
+        # no arg passed: show the caller's queues
+        if len(args) == 0:
+            machines = self.__manager.getWaiting(user)
+
+            if len(machines) == 0:
+                irc.reply('You are not waiting for any machine',
                           prefixNick=True)
-                continue
+                return
 
-            # get how long machine is in the current state
-            interval = self.__formatTime(int(time.time()) - info['start'])
+            irc.reply('Waiting for: %s' % self.__formatList(machines),
+                      prefixNick=True)
+            return
 
-            # send info
-            irc.reply('# Name   : %s' % info['name'], private=True)
-            irc.reply('# Ip     : %s' % info['ip'], private=True)
-            irc.reply('# Id     : %s' % info['id'], private=True)
-            irc.reply('# Group  : %s' % info['group'], private=True)
+        # leave requested: remove the caller from the queues
+        if args[0] == 'leave':
+            if len(args) == 1:
+                irc.reply('Usage: queue [<machine> | leave <machine 1> [... '
+                          '<machine N>]]', prefixNick=True)
+                return
 
-            # machine is available: report it
-            if info['user'] == None:
-                irc.reply('# Status : available (%s)' % interval, private=True)
-                continue
+            machines = self.__manager.expand(args[1:])
+            results = self.__manager.leaveMany(machines, user)
+            results = self.__groupByStatus(results)
 
-            # machine is reserved: also show for whom
-            irc.reply('# Status : reserved (%s)' % interval, private=True)
-            irc.reply('# User   : %s' % info['user'], private=True)
-    # info()
+            if 0 in results:
+                irc.reply('Left queues: %s' % self.__formatList(results[0]),
+                          prefixNick=True)
+
+            if 1 in results:
+                irc.reply('Not waiting for: %s' %
+                          self.__formatList(results[1]), prefixNick=True)
+            return
+
+        # machine passed: show who is waiting for it
+        if len(args) > 1:
+            irc.reply('Usage: queue [<machine> | leave <machine 1> [... '
+                      '<machine N>]]', prefixNick=True)
+            return
+
+        users = self.__manager.getWaiters(args[0])
+
+        if len(users) == 0:
+            irc.reply('Nobody is waiting for %s' % args[0], prefixNick=True)
+            return
+
+        # users shown in the order they get the machine
+        irc.reply('Waiting for %s: %s' %
+                  (args[0], self.__formatList(users, False)), prefixNick=False)
+    # queue()
 
     def reserve(self, irc, msg, args):
         """
-        Reserves the machine whose name is passed as argument
+        Reserves the machines whose names are passed as arguments. Glob
+        patterns, such as lpar1* or vios[1-4], match the available machines.
+        With --all, no machine is reserved unless all of them can be. With
+        --wait, the caller is queued for the machines reserved by someone
+        else and gets them as soon as they are released. Ending with for and
+        a time (e.g. for 8h) sets when the reservations expire, instead of
+        the configured default.
         """
-        # no arg passed: show how to use
-        if len(args) == 0:
-            irc.reply('Usage: reserve <machine 1> [... <machine N>]',
-                      prefixNick=True)
+        usage = 'Usage: reserve [--all | --wait] <machine 1> [... ' \
+                '<machine N>] [for <time>]'
+
+        # options requested: remove them from machines list
+        atomic = '--all' in args
+        wait = '--wait' in args
+        names = [arg for arg in args if arg not in ('--all', '--wait')]
+
+        # lease length requested: remove it too
+        duration = None
+
+        if len(names) > 1 and names[-2] == 'for':
+            duration = self.__parseTime(names[-1])
+            names = names[:-2]
+
+            # invalid length: show how to use
+            if not duration:
+                irc.reply(usage, prefixNick=True)
+                return
+
+        # waiting: patterns also match reserved machines
+        accept = lambda info: info['user'] == None
+
+        if wait:
+            accept = None
+
+        machines = self.__manager.expand(names, accept)
+
+        # no machine passed or options combined: show how to use
+        if len(machines) == 0 or (atomic and wait):
+            irc.reply(usage, prefixNick=True)
             return
 
-        # get machine and reserver name
-        for machine in args:
-            user = msg.nick
+        # reserve machines, remembering where to tell the user about them
+        user = msg.nick
+        self.__networks[user] = irc.network
+        results = self.__manager.reserveMany(machines, user, atomic, wait,
+                                             duration)
+        results = self.__groupByStatus(results)
 
-            # machine reserved: done
-            status = self.__manager.reserve(machine, user)
+        # report reserved machines and when the first of them expires
+        if 0 in results:
+            text = 'Machines reserved for %s: %s' % \
+                   (user, self.__formatList(results[0]))
+            expiries = self.__watchLeases(results[0])
 
-            if status == 0:
-                irc.reply('Machine %s has been reserved for %s' % (machine,
-                          user), prefixNick=False)
-                continue
+            if len(expiries) > 0:
+                which = len(expiries) < len(results[0]) and 'some ' or ''
+                text += ' (%sexpire in %s)' % (which, self.__formatTime(
+                        min(expiries) - int(time.time())))
 
-            # machine does not exist: error
-            if status == 1:
-                irc.reply('Machine %s does not exist' % machine,
-                          prefixNick=True)
-                continue
+            irc.reply(text, prefixNick=False)
 
-            # machine already reserved: error
-            if status == 2:
-                irc.reply('Machine %s is already reserved' % machine,
-                          prefixNick=True)
-                continue
+        # machines do not exist: error
+        if 1 in results:
+            irc.reply('Machines not found: %s' % self.__formatList(results[1]),
+                      prefixNick=True)
 
-            # user has no permissions: error
-            if status == 3:
-                irc.reply('User %s has no permissions to reserve machine %s' %
-                          (user, machine), prefixNick=True)
-                continue
+        # machines already reserved: error
+        if 2 in results:
+            irc.reply('Machines already reserved: %s' %
+                      self.__formatList(results[2]), prefixNick=True)
+
+        # user has no permissions: error
+        if 3 in results:
+            irc.reply('User %s has no permissions to reserve: %s' %
+                      (user, self.__formatList(results[3])), prefixNick=True)
+
+        # not reserved because of the others: report it
+        if 4 in results:
+            irc.reply('Machines not reserved since not all could be: %s' %
+                      self.__formatList(results[4]), prefixNick=True)
+
+        # queued for reserved machines: report it
+        if 5 in results:
+            irc.reply('Machines reserved by others, %s queued for: %s' %
+                      (user, self.__formatList(results[5])), prefixNick=False)
     # reserve()
 
     def show(self, irc, msg, args):
         """
-        List the machines depending on the passed argument: all, reserved, free
+        List the machines matching the passed filter terms, such as all, free,
+        reserved, lpar1*, group=pp, user=bob, state=free, held>2d or
+        ip=9.8.*, optionally sorted (sort=held, sort=-name) and limited
+        (limit=10). Values may be glob patterns and all terms must match.
         """
         # no arg passed: show how to use
         if len(args) == 0:
-            irc.reply('Usage: show (all | reserved | free)', prefixNick=True)
+            irc.reply('Usage: show [all | free | reserved] [<pattern>] '
+                      '[<field>=<value> ...] [held>2d] [sort=[-]<field>] '
+                      '[limit=<count>]', prefixNick=True)
             return
 
-        # all: list all machines
-        arg = args[0]
+        # invalid filter: error
+        try:
+            query = filters.parse(args, self.__parseTime)
 
-        if arg == 'all':
-            machines = self.__formatList(self.__manager.listMachines())
-            irc.reply('Registered machines: %s' % machines, prefixNick=True)
+        except ValueError, e:
+            irc.reply('Invalid filter: %s' % e, prefixNick=True)
             return
 
-        # reserved: list only reserved machines
-        if arg == 'reserved':
-            machines = self.__formatList(self.__manager.listReserved())
-            irc.reply('Reserved machines: %s' % machines, prefixNick=True)
+        # reply built since the last write: reuse it
+        key = ('show',) + tuple(args)
+        generation = self.__manager.getGeneration()
+        text = self.__cachedResponse(key, generation)
+
+        if text != None:
+            irc.reply(text, prefixNick=True)
             return
 
-        # free: list only available machines
-        if arg == 'free':
-            machines = self.__formatList(self.__manager.listAvailable())
-            irc.reply('Available machines: %s' % machines, prefixNick=True)
+        # only state and name: answer from the in-memory index
+        if filters.isSimple(query):
+            fields = dict([(field, value) for field, operator, value in
+                           query['terms']])
+            machines = self.__showSimple(fields)
+            text = '%s: %s' % (SHOW_TITLES[fields.get('state', None)],
+                               self.__formatList(machines))
+            self.__cacheResponse(key, generation, text)
+            irc.reply(text, prefixNick=True)
             return
 
-        # invalid arg: show how to use
-        irc.reply('Usage: show (all | reserved | free)', prefixNick=True)
+        # query database, showing the sort field next to each name
+        found = self.__manager.find(query['terms'], query['sort'],
+                                    query['limit'])
+        sortKey = (query['sort'] or ('name',))[0]
+
+        if sortKey == 'name' or len(found) == 0:
+            output = self.__formatList([info['name'] for info in found])
+        else:
+            output = ', '.join(['%s (%s)' % (info['name'],
+                                self.__formatField(sortKey, info))
+                                for info in found])
+
+        text = 'Machines matching %s: %s' % (' '.join(args), output)
+
+        # held depends on the current time, not only on the database
+        fields = [field for field, operator, value in query['terms']]
+
+        if 'held' not in fields and sortKey != 'held':
+            self.__cacheResponse(key, generation, text)
+
+        irc.reply(text, prefixNick=True)
     # show()
 
+    def stats(self, irc, msg, args):
+        """
+        Shows calls/errors and p50, p95 and p99 latencies of the commands and
+        database queries. With 'export', writes them to the configured metrics
+        file instead; with 'reset', discards them. Admins only.
+        """
+        # user is not an admin: error
+        if not ircdb.checkCapability(msg.prefix, 'admin'):
+            irc.errorNoCapability('admin')
+            return
+
+        # no arg passed: show metrics
+        if len(args) == 0:
+            snapshot = self.__metrics.snapshot()
+            irc.reply('Commands: %s' %
+                      self.__formatMetrics(snapshot.get('command', {})),
+                      prefixNick=False)
+            irc.reply('Queries: %s' %
+                      self.__formatMetrics(snapshot.get('query', {})),
+                      prefixNick=False)
+            irc.reply('Queue waits (calls/busy): %s' %
+                      self.__formatMetrics(snapshot.get('queue', {})),
+                      prefixNick=False)
+            return
+
+        # reset: discard metrics
+        if args == ['reset']:
+            self.__metrics.reset()
+            irc.reply('Stats reset', prefixNick=True)
+            return
+
+        # invalid arg: show how to use
+        if args != ['export']:
+            irc.reply('Usage: stats [export | reset]', prefixNick=True)
+            return
+
+        # export: no file configured, error
+        path = self.registryValue('metrics.file')
+
+        if path == '':
+            irc.reply('No metrics file configured', prefixNick=True)
+            return
+
+        # write metrics in the configured format
+        if self.registryValue('metrics.format') == 'json':
+            data = self.__metrics.toJson()
+        else:
+            data = self.__metrics.toPrometheus()
+
+        output = open(path, 'w')
+        output.write(data)
+        output.close()
+
+        irc.reply('Stats exported to %s' % path, prefixNick=True)
+    # stats()
+
     def update(self, irc, msg, args):
         """
-        List the machines reserved by user
+        Makes the registered machines match the ones listed in the inventory
+        sources (by default, the wiki machines table): new machines are added,
+        changed ones are updated and the ones no longer listed are removed,
+        unless reserved. Machines are only processed if they changed since the
+        last update, unless --force is passed. Removals are refused when the
+        sources list no machine or too many would go, also unless --force is
+        passed. With --dry-run, only shows what would change.
         """
-        # tell the use machines are being retrieved from wiki
-        irc.reply('Retrieving machines table from wiki', prefixNick=False)
-        
-        # retrieve machines from wiki
-        for machine in readwiki.parseMachinesTable():
-        
-            # machine without name: ignore
-            name = machine.get('name', None)
-            
-            if name == None:
-                continue
+        # invalid arg: show how to use
+        options = set(args)
 
-            # get machine info
-            ip = machine.get('ip', None)
-            id = machine.get('id', None)
-            group = machine.get('group', None)
-        
-            # error adding machine: report it
-            if self.__manager.add(name, ip, id, group) != 0:
-                irc.reply('Machine %s already exists' % name, prefixNick=False)
-                continue
+        if len(options - set(['--dry-run', '--force'])) > 0:
+            irc.reply('Usage: update [--dry-run] [--force]', prefixNick=True)
+            return
+
+        # another update in progress: error
+        if not self.__syncLock.acquire(False):
+            irc.reply('Machines are already being updated, try again later',
+                      prefixNick=True)
+            return
+
+        # tell the use machines are being retrieved
+        irc.reply('Retrieving machines from inventory', prefixNick=False)
+
+        try:
+            diff = self.__syncMachines('--force' in options,
+                                       '--dry-run' in options,
+                                       self.registryValue('sync.timeout'))
 
-            # success: report it
-            irc.reply('Machine %s added' % name, prefixNick=False)
+        finally:
+            self.__syncLock.release()
+
+        # table did not change: nothing to do
+        if diff == None:
+            irc.reply('Machines table unchanged', prefixNick=False)
+            return
+
+        # report a summary instead of one line per machine
+        if '--dry-run' in options:
+            irc.reply('Machines table preview: %s' % self.__formatDiff(diff),
+                      prefixNick=False)
+        else:
+            irc.reply('Machines table updated: %s' % self.__formatDiff(diff),
+                      prefixNick=False)
     # update()
 
     def users(self, irc, msg, args):
         """
         List the machines reserved by user
         """
+        # reply built since the last write: reuse it
+        generation = self.__manager.getGeneration()
+        text = self.__cachedResponse(('users',), generation)
+
+        if text != None:
+            irc.reply(text, prefixNick=False)
+            return
+
         output = []
+        reservations = self.__manager.reservationsByUser()
 
-        for user in self.__manager.listUsers():
-            machines = self.__formatList(self.__manager.listByUser(user))
+        for user in sorted(reservations):
+            machines = self.__formatList(reservations[user])
             output.append('%s - %s' % (user, machines))
 
-        irc.reply('Machines by user: %s' % ' * '.join(output), prefixNick=False)
+        text = 'Machines by user: %s' % ' * '.join(output)
+        self.__cacheResponse(('users',), generation, text)
+        irc.reply(text, prefixNick=False)
     # users()
 
 Class = Mussum
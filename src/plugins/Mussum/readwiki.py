@@ -22,40 +22,347 @@
 #
 # IMPORTS
 #
+import hashlib
+import json
+import os
 import re
 import urllib2
+import zlib
 
 
 #
 # CONTANTS AND DEFINITIONS
 #
-ENTRY = re.compile('(<.*>)*(.*)')
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+CHUNK_SIZE = 65536
 MACHINES_URL = 'https://ltc3.linux.ibm.com/wiki/LTCBrazil/UPP/Machines?action=raw'
+SEPARATOR = '||'
+
+# attribute blocks at the start of a cell, such as <bgcolor="#ff0000"> or
+# <-2>, and the blanks around them. A > inside quotes does not end a block and
+# << opens a macro, not a block. Quoted and unquoted runs alternate, each
+# starting with a character the other cannot, so it never backtracks.
+ATTRIBUTES = re.compile(r'''[ \t]*(?:<(?!<)[^>"']*(?:(?:"[^"]*"|'[^']*')'''
+                        r'''[^>"']*)*>[ \t]*)*''')
+
+# markup which may hold separators that do not end a cell, by opening token
+MARKUP = {
+    '{{{': '}}}',
+    '[[': ']]',
+    '<<': '>>',
+}
+
+# finds the next separator or markup opening token, its alternatives are
+# literals so it never backtracks
+TOKEN = re.compile(r'\|\||\{\{\{|\[\[|<<')
 
 
 #
 # CODE
 #
-def getMachinesPage():
+def _cachePaths(url, cacheDir):
     """
-    Downloads the machines wiki page and returns its lines as an array
+    Returns the paths of the files where the passed page is cached
 
-    @rtype: list
-    @returns: lines of the machines wiki page
+    @type  url: basestring
+    @param url: page URL
+
+    @type  cacheDir: basestring
+    @param cacheDir: cache directory
+
+    @rtype: tuple
+    @returns: paths of the raw page and of its metadata
+    """
+    key = hashlib.sha1(url).hexdigest()
+    base = os.path.join(cacheDir, key)
+
+    return base + '.page', base + '.json'
+# _cachePaths()
+
+def _readChunks(stream, encoding):
+    """
+    Reads the passed HTTP response body in chunks as they arrive, decoding
+    them if they are gzip compressed
+
+    @type  stream: file
+    @param stream: HTTP response
+
+    @type  encoding: basestring or None
+    @param encoding: value of the Content-Encoding header
+
+    @rtype: generator
+    @returns: decoded chunks of the body
     """
-    # download the page
-    stream = urllib2.urlopen(MACHINES_URL)
-    data = stream.read()
-    stream.close()
+    decompressor = None
+
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+        if decompressor != None:
+            chunk = decompressor.decompress(chunk)
+
+        yield chunk
+
+    if decompressor != None:
+        yield decompressor.flush()
+# _readChunks()
+
+def _saveLines(lines, output):
+    """
+    Writes the passed lines to the passed file as they are consumed
+
+    @type  lines: iterable
+    @param lines: lines without line breaks
+
+    @type  output: file
+    @param output: file to write the lines to
+
+    @rtype: generator
+    @returns: the same lines
+    """
+    for line in lines:
+        output.write(line + '\n')
+        yield line
+# _saveLines()
+
+def fetchMachines(url = MACHINES_URL, cacheDir = CACHE_DIR, timeout = None,
+                  force = False):
+    """
+    Downloads the passed machines wiki page, if it changed since the last
+    saved download, and returns the machines in its tables.
+
+    The page is requested conditionally, using the ETag and Last-Modified
+    values of the last saved download, and gzip compressed. If the server
+    reports the page did not change, or the machines parsed are the same as
+    last saved, no machines are returned so the caller can skip any work.
+
+    Nothing is taken as the last download here: the page is kept apart and
+    its metadata returned, to be passed to saveMachines once the machines
+    were applied. Otherwise a failed update would never be fetched again.
+
+    @type  url: basestring
+    @param url: page URL
+
+    @type  cacheDir: basestring
+    @param cacheDir: directory where the page is cached
+
+    @type  timeout: float
+    @param timeout: seconds to wait for the server, None waits forever
 
-    # split into lines and return
-    return data.splitlines()
+    @type  force: bool
+    @param force: if True, always download and return the machines
+
+    @rtype: tuple
+    @returns: mappings of table headers to columns, one per machine, or None
+              if they did not change, and the metadata of the download, or
+              None if there is nothing to save
+    """
+    pagePath, metaPath = _cachePaths(url, cacheDir)
+
+    # read what is known about the last saved download
+    meta = {}
+
+    if not force and os.path.exists(pagePath) and os.path.exists(metaPath):
+        metaFile = open(metaPath)
+        meta = json.load(metaFile)
+        metaFile.close()
+
+    # request the page only if changed, compressed
+    request = urllib2.Request(url)
+    request.add_header('Accept-Encoding', 'gzip')
+
+    if meta.get('etag', None) != None:
+        request.add_header('If-None-Match', meta['etag'])
+
+    if meta.get('modified', None) != None:
+        request.add_header('If-Modified-Since', meta['modified'])
+
+    try:
+        stream = urllib2.urlopen(request, timeout = timeout)
+
+    # page not modified: nothing to do
+    except urllib2.HTTPError, e:
+        if e.code == 304:
+            return None, None
+
+        raise
+
+    # parse the page as it arrives, keeping it apart until saved
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    pageFile = open(pagePath + '.tmp', 'wb')
+    digest = hashlib.sha1()
+    machines = []
+
+    try:
+        chunks = _readChunks(stream, stream.info().get('Content-Encoding'))
+        lines = _saveLines(iterLines(chunks), pageFile)
+
+        for machine in iterMachinesTable(lines):
+            digest.update(repr(sorted(machine.items())))
+            machines.append(machine)
+
+    finally:
+        stream.close()
+        pageFile.close()
+
+    headers = stream.info()
+    download = {
+        'etag': headers.get('ETag'),
+        'modified': headers.get('Last-Modified'),
+        'hash': digest.hexdigest(),
+    }
+
+    # machines did not change: nothing to do, but the download may still be
+    # saved so the page is not requested whole again
+    if not force and download['hash'] == meta.get('hash', None):
+        return None, download
+
+    return machines, download
+# fetchMachines()
+
+def getMachinesPage():
+    """
+    Opens the machines wiki page and returns it as a stream which yields its
+    lines as they are downloaded
+
+    @rtype: file
+    @returns: stream of the machines wiki page, to be closed by the caller
+    """
+    return urllib2.urlopen(MACHINES_URL)
 # getMachinesPage()
 
+def iterMachines():
+    """
+    Downloads the machines wiki page and yields the machines in its tables one
+    at a time, as soon as their lines arrive
+
+    @rtype: generator
+    @returns: mappings of table headers to columns, one per machine
+    """
+    stream = getMachinesPage()
+
+    try:
+        for machine in iterMachinesTable(stream):
+            yield machine
+
+    finally:
+        stream.close()
+# iterMachines()
+
+def iterLines(chunks):
+    """
+    Splits the passed chunks of text into lines, yielding each line as soon
+    as it is complete
+
+    @type  chunks: iterable
+    @param chunks: chunks of text
+
+    @rtype: generator
+    @returns: lines without line breaks
+    """
+    pending = ''
+
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+
+        for line in lines:
+            yield line
+
+    # last line without line break
+    if pending != '':
+        yield pending
+# iterLines()
+
+def iterMachinesTable(lines):
+    """
+    Parses all tables in the passed wiki page lines and yields their rows one
+    at a time. The first row of each table holds its headers. Each line is
+    looked at only once, so the time taken is linear in the page size.
+
+    @type  lines: iterable
+    @param lines: lines of the wiki page, e.g. a file or a list
+
+    @rtype: generator
+    @returns: mappings of table headers to columns, one per table row
+    """
+    headers = None
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        # not a table row: any current table has ended
+        if line[0:2] != '||':
+            headers = None
+            continue
+
+        # first row of a table: get headers, once for all its rows
+        if headers == None:
+            headers = [(parseCell(cell) or '').lower()
+                       for cell in splitCells(line)]
+            continue
+
+        # map headers to columns
+        yield parseLine(headers, line)
+# iterMachinesTable()
+
+def loadCachedMachines(url = MACHINES_URL, cacheDir = CACHE_DIR):
+    """
+    Returns the machines in the passed wiki page as it was last saved by
+    saveMachines, without accessing the network
+
+    @type  url: basestring
+    @param url: page URL
+
+    @type  cacheDir: basestring
+    @param cacheDir: directory where the page is cached
+
+    @rtype: list or None
+    @returns: mappings of table headers to columns, one per machine, or None
+              if the page is not cached
+    """
+    # page not cached: nothing to load
+    pagePath = _cachePaths(url, cacheDir)[0]
+
+    if not os.path.exists(pagePath):
+        return None
+
+    # parse cached page
+    pageFile = open(pagePath)
+
+    try:
+        return list(iterMachinesTable(pageFile))
+
+    finally:
+        pageFile.close()
+# loadCachedMachines()
+
+def parseCell(cell):
+    """
+    Returns the value of the passed table cell, without the attribute blocks
+    at its start, such as <bgcolor="#ff0000"> or <-2>. Blocks which are
+    never closed are taken as text.
+
+    @type  cell: basestring
+    @param cell: cell text, as returned by splitCells
+
+    @rtype: basestring or None
+    @returns: cell value, or None if the cell is empty
+    """
+    # no attribute blocks: only blanks to strip
+    if '<' not in cell:
+        return cell.strip() or None
+
+    return cell[ATTRIBUTES.match(cell).end():].strip() or None
+# parseCell()
+
 def parseLine(headers, line):
     """
-    Strips the passed line into columns separated by || and returns a dictionary
-    mapping the passed headers to those columns
+    Splits the passed line into columns separated by || and returns a
+    dictionary mapping the passed headers to those columns
 
     @type  headers: list
     @param headers: headers to be used
@@ -66,12 +373,9 @@ def parseLine(headers, line):
     @rtype: dict
     @returns: mapping of headers to columns
     """
-    # split the passed line into columns removing any leading <...> tags
-    columns = []
-    
-    for column in line.split('||')[1:-1]:
-        columns.append(ENTRY.match(column).groups()[1].strip() or None)
-    
+    # split the passed line into columns removing any leading <...> blocks
+    columns = [parseCell(cell) for cell in splitCells(line)]
+
     # map headers to columns and return
     mapping = {}
 
@@ -83,59 +387,110 @@ def parseLine(headers, line):
 
 def parseMachinesTable():
     """
+    Downloads the machines wiki page and returns the machines in its tables
+
+    @rtype: list
+    @returns: mappings of table headers to columns, one per machine
     """
-    # list
-    machines = []
+    return list(iterMachines())
+# parseMachinesTable()
 
-    # ble
-    lines = getMachinesPage()
+def saveMachines(download, url = MACHINES_URL, cacheDir = CACHE_DIR):
+    """
+    Keeps the page downloaded last by fetchMachines as the last download, so
+    the next call only gets it again if it changed
 
-    # ble
-    handler = skipTrash
-    index = 0
+    @type  download: dict
+    @param download: metadata returned by fetchMachines with the page
 
-    while handler != None:
-        handler, index = handler(machines, lines, index)
+    @type  url: basestring
+    @param url: page URL
 
-    # bli
-    return machines
-# parseMachinesTable()
+    @type  cacheDir: basestring
+    @param cacheDir: directory where the page is cached
 
-def parseTable(machines, lines, index):
-    """
+    @rtype: None
+    @returns: nothing
     """
-    # get headers
-    headers = [h.strip().lower() for h in lines[index].split('||')[1:-1]]
-    index += 1
+    pagePath, metaPath = _cachePaths(url, cacheDir)
 
-    # parse lines and map headers to columns
-    for line in lines[index:]:
-        if line[0:2] != '||':
-            return skipTrash, index
+    os.rename(pagePath + '.tmp', pagePath)
+    metaFile = open(metaPath + '.tmp', 'w')
+    json.dump(download, metaFile)
+    metaFile.close()
+    os.rename(metaPath + '.tmp', metaPath)
+# saveMachines()
 
-        # xxx
-        machines.append(parseLine(headers, line))
-        index += 1
+def splitCells(line):
+    """
+    Splits the passed table row into its cells. Separators inside markup,
+    such as {{{a||b}}}, [[link|text]] or <<Macro(a||b)>>, do not end a cell.
+    Text before the first separator and after the last one is not a cell.
 
-    # no more lines: stop state machine
-    return None, -1
-# parseTable()
+    The row is scanned once: markup that is never closed is taken as text,
+    and once a closing token is known to be missing it is not searched for
+    again, so the time taken is linear in the row length. Once no markup
+    left in the row can be closed, the rest is split as plain text.
 
-def skipTrash(machines, lines, index):
-    """
+    @type  line: basestring
+    @param line: table row, e.g. ||lpar1||<:>9.8.7.6||
 
-    @rtype: Array
-    @returns:
+    @rtype: list
+    @returns: cells text, attributes included
     """
-    # iterate over lines until a table header is found
-    for line in lines[index:]:
-        if line[0:2] == '||':
-            return parseTable, index
+    # markup which may still hold separators
+    pending = set([opening for opening in MARKUP if opening in line])
+
+    # no markup: only separators matter
+    if len(pending) == 0:
+        return line.split(SEPARATOR)[1:-1]
+
+    cells = []
+    start = None
+    position = 0
+
+    while True:
+        token = TOKEN.search(line, position)
+
+        # no more separators: text left is not a cell
+        if token == None:
+            break
+
+        position = token.end()
+        opening = token.group()
+
+        # separator: a cell ends (if one started) and another starts
+        if opening == SEPARATOR:
+            if start != None:
+                cells.append(line[start:token.start()])
+
+            start = position
+            continue
+
+        # markup: skip to its end, unless it is never closed
+        if opening not in pending:
+            continue
+
+        end = line.find(MARKUP[opening], position)
+
+        if end != -1:
+            position = end + len(MARKUP[opening])
+            continue
+
+        pending.discard(opening)
+
+        # no markup left to be closed: split the rest as plain text, the
+        # first part ending the current cell if a separator follows
+        if len(pending) == 0:
+            parts = line[position:].split(SEPARATOR)
+
+            if start != None and len(parts) > 1:
+                cells.append(line[start:position] + parts[0])
 
-        index += 1
+            cells.extend(parts[1:-1])
+            break
 
-    # no table header found: stop state machine
-    return None, -1
-# skipTrash()
+    return cells
+# splitCells()
 
 
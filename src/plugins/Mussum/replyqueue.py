@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+import collections
+import supybot.ircmsgs as ircmsgs
+import threading
+import time
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+DEFAULT_LIMIT = 20
+DEFAULT_RATE = 1.0
+SEPARATOR = ' | '
+
+# longest message coalesced lines may add up to, also the width
+# plugin.Mussum packs its info tables to
+LINE_LENGTH = 400
+
+
+#
+# CODE
+#
+class ReplyQueue(object):
+    """
+    This sends bulk output, such as info on many machines, paced at a
+    messages per second budget from its own thread. Interactive replies are
+    sent straight through supybot, so they never wait behind a long dump:
+    bulk messages only reach supybot's own queue one at a time.
+
+    Lines to the same target waiting in the queue are coalesced into fewer
+    messages, and output longer than the limit is cut and summarized.
+    """
+
+    def __init__(self, rate = DEFAULT_RATE, limit = DEFAULT_LIMIT):
+        """
+        Constructor
+
+        @type  rate: float
+        @param rate: messages sent per second
+
+        @type  limit: int
+        @param limit: most lines queued by each call to put, 0 for no limit
+
+        @rtype: None
+        @returns: nothing
+        """
+        self.rate = rate
+        self.limit = limit
+
+        self.__condition = threading.Condition()
+        self.__next = 0
+        self.__pending = collections.deque()
+        self.__stopped = False
+
+        self.__thread = threading.Thread(target = self.__run,
+                                         name = 'MussumReplyQueue')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+    # __init__()
+
+    def __coalesce(self):
+        """
+        Takes the first pending line and the ones after it to the same target
+        which fit in a single message. Must be called with the lock held.
+
+        @rtype: tuple
+        @returns: irc, target and message text
+        """
+        irc, target, text, coalesce = self.__pending.popleft()
+
+        while coalesce and len(self.__pending) > 0:
+            nextIrc, nextTarget, nextText, nextCoalesce = self.__pending[0]
+
+            # another target, line kept apart or message would be too long:
+            # stop
+            if nextIrc is not irc or nextTarget != target or \
+               not nextCoalesce or \
+               len(text) + len(SEPARATOR) + len(nextText) > LINE_LENGTH:
+                break
+
+            text += SEPARATOR + nextText
+            self.__pending.popleft()
+
+        return irc, target, text
+    # __coalesce()
+
+    def __run(self):
+        """
+        Sends the pending lines, at most rate messages per second, until
+        stopped
+
+        @rtype: None
+        @returns: nothing
+        """
+        while True:
+            with self.__condition:
+
+                # wait for lines and for the budget to allow another message
+                while not self.__stopped and (len(self.__pending) == 0 or
+                                              time.time() < self.__next):
+                    timeout = None
+
+                    if len(self.__pending) > 0:
+                        timeout = self.__next - time.time()
+
+                    self.__condition.wait(timeout)
+
+                if self.__stopped:
+                    return
+
+                irc, target, text = self.__coalesce()
+                self.__next = time.time() + 1.0 / self.rate
+
+            irc.queueMsg(ircmsgs.privmsg(target, text))
+    # __run()
+
+    def pending(self):
+        """
+        Returns how many lines are waiting to be sent
+
+        @rtype: int
+        @returns: number of lines
+        """
+        with self.__condition:
+            return len(self.__pending)
+    # pending()
+
+    def put(self, irc, target, lines, coalesce = True):
+        """
+        Queues the passed lines to be sent to the passed target. Past the
+        limit, the remaining lines are replaced by a line telling how many
+        were not shown.
+
+        @type  irc: supybot.irclib.Irc
+        @param irc: network to send the lines to
+
+        @type  target: basestring
+        @param target: nick or channel
+
+        @type  lines: list
+        @param lines: lines to send
+
+        @type  coalesce: bool
+        @param coalesce: if False, each line is sent in its own message
+
+        @rtype: int
+        @returns: number of lines queued
+        """
+        # too many lines: cut and summarize the rest
+        if self.limit > 0 and len(lines) > self.limit:
+            dropped = len(lines) - self.limit + 1
+            lines = lines[:self.limit - 1] + \
+                    ['(%s more lines not shown)' % dropped]
+
+        with self.__condition:
+            for line in lines:
+                self.__pending.append((irc, target, line, coalesce))
+
+            self.__condition.notify()
+
+        return len(lines)
+    # put()
+
+    def stop(self):
+        """
+        Stops sending, discarding the pending lines
+
+        @rtype: None
+        @returns: nothing
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__pending.clear()
+            self.__condition.notify()
+
+        self.__thread.join()
+    # stop()
+
+# ReplyQueue
+
+
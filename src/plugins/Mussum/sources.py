@@ -0,0 +1,498 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+from multiprocessing.pool import ThreadPool
+
+import csv
+import hashlib
+import json
+import readwiki
+import urllib2
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+DEFAULT_WORKERS = 4
+
+
+#
+# CODE
+#
+class InventorySource(object):
+    """
+    This is a place machines are listed in, e.g. a wiki page or a file. Each
+    machine is returned as a mapping of lower case field names ('name', 'ip',
+    'id', 'group', ...) to values.
+
+    Sources remember what they returned last, so they can tell when the
+    machines did not change and be asked for them again without fetching.
+    What fetch returns is only remembered once passed to save, after it was
+    applied, so a failed update is fetched again. Subclasses implement fetch,
+    save and load; SnapshotSource implements them for sources which can only
+    be read whole.
+    """
+
+    def __init__(self, location):
+        """
+        Constructor
+
+        @type  location: basestring
+        @param location: where machines are listed, e.g. an URL or a path
+
+        @rtype: None
+        @returns: nothing
+        """
+        self.location = location
+    # __init__()
+
+    def fetch(self, timeout = None, force = False):
+        """
+        Fetches the machines from the source
+
+        @type  timeout: float
+        @param timeout: seconds to wait for the network, None waits forever
+
+        @type  force: bool
+        @param force: if True, return the machines even if they did not change
+
+        @rtype: tuple
+        @returns: machines, or None if they did not change since last saved,
+                  and the snapshot to pass to save, or None if there is
+                  nothing to save
+        """
+        raise NotImplementedError()
+    # fetch()
+
+    def load(self):
+        """
+        Returns the machines saved last, without fetching them again
+
+        @rtype: list or None
+        @returns: machines, or None if they were never fetched
+        """
+        raise NotImplementedError()
+    # load()
+
+    def save(self, snapshot):
+        """
+        Remembers what was fetched as the last machines, once applied
+
+        @type  snapshot: object
+        @param snapshot: snapshot returned by fetch
+
+        @rtype: None
+        @returns: nothing
+        """
+        raise NotImplementedError()
+    # save()
+
+# InventorySource
+
+
+class SnapshotSource(InventorySource):
+    """
+    A source which can only be read whole. Changes are found by comparing a
+    digest of the machines read to the one of the machines saved last, which
+    are kept in memory.
+    """
+
+    def __init__(self, location):
+        """
+        Constructor, see InventorySource
+        """
+        InventorySource.__init__(self, location)
+        self.__machines = None
+        self.__hash = None
+    # __init__()
+
+    def _digest(self, machines):
+        """
+        Returns a digest of the passed machines, the same for the same
+        machines in the same order
+
+        @type  machines: list
+        @param machines: machines
+
+        @rtype: basestring
+        @returns: hex digest
+        """
+        digest = hashlib.sha1()
+
+        for machine in machines:
+            digest.update(repr(sorted(machine.items())))
+
+        return digest.hexdigest()
+    # _digest()
+
+    def _read(self, timeout):
+        """
+        Reads and returns all machines from the source. Subclasses must
+        implement this.
+
+        @type  timeout: float
+        @param timeout: seconds to wait for the network, None waits forever
+
+        @rtype: list
+        @returns: machines
+        """
+        raise NotImplementedError()
+    # _read()
+
+    def fetch(self, timeout = None, force = False):
+        """
+        Reads the machines from the source, see InventorySource.fetch
+        """
+        machines = self._read(timeout)
+        digest = self._digest(machines)
+
+        if digest == self.__hash and not force:
+            return None, None
+
+        return machines, (machines, digest)
+    # fetch()
+
+    def load(self):
+        """
+        Returns the machines saved last, see InventorySource.load
+        """
+        return self.__machines
+    # load()
+
+    def save(self, snapshot):
+        """
+        Remembers the machines fetched, see InventorySource.save
+        """
+        self.__machines, self.__hash = snapshot
+    # save()
+
+# SnapshotSource
+
+
+class WikiSource(InventorySource):
+    """
+    Machines listed in the tables of a MoinMoin wiki page, fetched with
+    readwiki, which keeps the page cached on disk and asks the server whether
+    it changed instead of reading it whole
+    """
+
+    def __init__(self, location, cacheDir = readwiki.CACHE_DIR):
+        """
+        Constructor
+
+        @type  location: basestring
+        @param location: raw wiki page URL
+
+        @type  cacheDir: basestring
+        @param cacheDir: directory where the page is cached
+
+        @rtype: None
+        @returns: nothing
+        """
+        InventorySource.__init__(self, location)
+        self.__cacheDir = cacheDir
+    # __init__()
+
+    def fetch(self, timeout = None, force = False):
+        """
+        Fetches the machines from the source, see InventorySource.fetch
+        """
+        return readwiki.fetchMachines(self.location, self.__cacheDir, timeout,
+                                      force)
+    # fetch()
+
+    def load(self):
+        """
+        Returns the machines saved last, see InventorySource.load
+        """
+        return readwiki.loadCachedMachines(self.location, self.__cacheDir)
+    # load()
+
+    def save(self, snapshot):
+        """
+        Keeps the page fetched as the last one, see InventorySource.save
+        """
+        readwiki.saveMachines(snapshot, self.location, self.__cacheDir)
+    # save()
+
+# WikiSource
+
+
+class CsvSource(SnapshotSource):
+    """
+    Machines listed in a local CSV file, one per row, with a header row
+    naming the fields
+    """
+
+    def _read(self, timeout):
+        """
+        Reads and returns all machines from the file
+        """
+        stream = open(self.location, 'rb')
+
+        try:
+            return [_lower(row) for row in csv.DictReader(stream)]
+
+        finally:
+            stream.close()
+    # _read()
+
+# CsvSource
+
+
+class JsonSource(SnapshotSource):
+    """
+    Machines listed in a local JSON file, as a list of objects or as an
+    object with a 'machines' list
+    """
+
+    def _read(self, timeout):
+        """
+        Reads and returns all machines from the file
+        """
+        stream = open(self.location)
+
+        try:
+            return _machinesFromJson(json.load(stream))
+
+        finally:
+            stream.close()
+    # _read()
+
+# JsonSource
+
+
+class HttpJsonSource(SnapshotSource):
+    """
+    Machines listed in a JSON document served over HTTP, in the same format
+    read by JsonSource
+    """
+
+    def _read(self, timeout):
+        """
+        Downloads and returns all machines from the document
+        """
+        stream = urllib2.urlopen(self.location, timeout = timeout)
+
+        try:
+            return _machinesFromJson(json.load(stream))
+
+        finally:
+            stream.close()
+    # _read()
+
+# HttpJsonSource
+
+
+# source classes by the kind used in source specs
+KINDS = {
+    'wiki': WikiSource,
+    'csv': CsvSource,
+    'json': JsonSource,
+    'http-json': HttpJsonSource,
+}
+
+
+def _lower(machine):
+    """
+    Returns the passed machine with lower case field names and empty values
+    turned into None
+
+    @type  machine: dict
+    @param machine: machine fields
+
+    @rtype: dict
+    @returns: machine fields
+    """
+    fields = {}
+
+    for key, value in machine.iteritems():
+
+        # value without field name (e.g. extra CSV column): ignore
+        if key == None:
+            continue
+
+        # strip text, empty values are missing ones
+        if isinstance(value, basestring):
+            value = value.strip() or None
+
+        fields[key.strip().lower()] = value
+
+    return fields
+# _lower()
+
+def _machinesFromJson(document):
+    """
+    Returns the machines in the passed JSON document
+
+    @type  document: list or dict
+    @param document: list of machines or object with a 'machines' list
+
+    @rtype: list
+    @returns: machines
+    """
+    if isinstance(document, dict):
+        document = document.get('machines', [])
+
+    return [_lower(machine) for machine in document]
+# _machinesFromJson()
+
+def createSource(spec):
+    """
+    Creates the source described by the passed spec, formatted as
+    <kind>:<location>, e.g. 'csv:/srv/machines.csv'. Kinds are wiki, csv,
+    json and http-json.
+
+    @type  spec: basestring
+    @param spec: source spec
+
+    @rtype: InventorySource
+    @returns: new source
+    """
+    kind, separator, location = spec.partition(':')
+
+    # invalid spec: error
+    if separator == '' or kind not in KINDS:
+        raise ValueError('invalid inventory source: %s' % spec)
+
+    return KINDS[kind](location)
+# createSource()
+
+def fetchAll(sources, workers = DEFAULT_WORKERS, timeout = None,
+             force = False):
+    """
+    Fetches the machines from all the passed sources in parallel and merges
+    them. If any source fails, the exception is raised, so a partial list is
+    never taken as the whole inventory. Nothing is remembered by the sources
+    until the snapshots returned are passed to saveAll.
+
+    @type  sources: list
+    @param sources: sources, the first ones taking precedence (see merge)
+
+    @type  workers: int
+    @param workers: maximum number of sources fetched at the same time
+
+    @type  timeout: float
+    @param timeout: seconds to wait for the network, None waits forever
+
+    @type  force: bool
+    @param force: if True, return the machines even if they did not change
+
+    @rtype: tuple
+    @returns: merged machines, or None if no source changed, and the
+              snapshots to pass to saveAll
+    """
+    fetch = lambda source: source.fetch(timeout, force)
+
+    # fetch all sources, in parallel if more than one
+    if len(sources) == 1:
+        results = [fetch(sources[0])]
+
+    else:
+        pool = ThreadPool(min(workers, len(sources)))
+
+        try:
+            results = pool.map(fetch, sources)
+
+        finally:
+            pool.close()
+            pool.join()
+
+    tables = [table for table, snapshot in results]
+    snapshots = [snapshot for table, snapshot in results]
+
+    # no source changed: nothing to do
+    if tables.count(None) == len(tables):
+        return None, snapshots
+
+    # take unchanged machines from the last saved ones
+    for i, source in enumerate(sources):
+        if tables[i] == None:
+            tables[i] = source.load() or []
+
+    return merge(tables), snapshots
+# fetchAll()
+
+def merge(tables):
+    """
+    Merges the passed lists of machines by name. When a machine is listed
+    more than once, each field is taken from the first list where it is not
+    None. Machines without name are ignored.
+
+    @type  tables: list
+    @param tables: lists of machines, in order of precedence
+
+    @rtype: list
+    @returns: merged machines, in the order they first appear
+    """
+    merged = {}
+    order = []
+
+    for table in tables:
+        for machine in table:
+
+            # machine without name: ignore
+            name = machine.get('name', None)
+
+            if name == None:
+                continue
+
+            # first time machine is seen: take it whole
+            if name not in merged:
+                merged[name] = dict(machine)
+                order.append(merged[name])
+                continue
+
+            # already seen: only fill missing fields
+            current = merged[name]
+
+            for key, value in machine.iteritems():
+                if current.get(key, None) == None:
+                    current[key] = value
+
+    return order
+# merge()
+
+def saveAll(sources, snapshots):
+    """
+    Makes the passed sources remember what they fetched, once the machines
+    returned by fetchAll were applied
+
+    @type  sources: list
+    @param sources: sources passed to fetchAll
+
+    @type  snapshots: list
+    @param snapshots: snapshots returned by fetchAll
+
+    @rtype: None
+    @returns: nothing
+    """
+    for source, snapshot in zip(sources, snapshots):
+
+        # nothing new fetched from source: nothing to save
+        if snapshot != None:
+            source.save(snapshot)
+# saveAll()
+
+
@@ -24,11 +24,917 @@
 #
 from supybot.test import *
 
+from db import DataBase
+from machinemanager import MachineManager
+from metrics import Metrics
+
+import BaseHTTPServer
+import plugin
+import cStringIO
+import filters
+import gzip
+import leasetimer
+import namelist
+import os
+import readwiki
+import replyqueue
+import shutil
+import sources
+import sqlite3
+import supybot.schedule as schedule
+import tempfile
+import threading
+import time
+import workerpool
+
 
 #
 # CODE
 #
+class RecordingQueue(object):
+    def __init__(self):
+        self.rate = self.limit = None
+        self.puts = []
+
+    def put(self, irc, target, lines, coalesce=True):
+        self.puts.append((target, lines, coalesce))
+        return len(lines)
+
+    def stop(self):
+        pass
+
+
+def useDataBase(path):
+    conf.supybot.plugins.Mussum.database.path.setValue(path)
+
+
 class MussumTestCase(PluginTestCase):
     plugins = ('Mussum',)
 
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        useDataBase(os.path.join(self.directory, 'mussum.db'))
+        PluginTestCase.setUp(self)
+        self.plugin = self.irc.getCallback('Mussum')
+        self.manager = self.plugin._Mussum__manager
+        self.manager.addMany([('lpar%02d' % i, '9.8.7.%d' % i, None, None)
+                              for i in range(1, 41)])
+
+        # record bulk output instead of sending it
+        self.plugin._Mussum__replies.stop()
+        self.plugin._Mussum__replies = RecordingQueue()
+
+    def tearDown(self):
+        PluginTestCase.tearDown(self)
+        useDataBase('')
+        shutil.rmtree(self.directory, True)
+
+    def bulkReplies(self, count):
+        puts = self.plugin._Mussum__replies.puts
+        deadline = time.time() + 5
+        while len(puts) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return puts
+
+    def testInfoTableIsNotCoalesced(self):
+        self.assertRegexp('info lpar*', 'pvt')
+        puts = self.bulkReplies(1)
+        self.assertEqual(len(puts), 1)
+        target, lines, coalesce = puts[0]
+        self.failIf(coalesce)
+        self.failUnless(lines[0].startswith('Name'), lines[0])
+
+    def testInfoTablePacksRows(self):
+        self.assertRegexp('info lpar*', 'pvt')
+        target, lines, coalesce = self.bulkReplies(1)[0]
+        self.assertEqual(target, self.nick)
+        self.failUnless(len(lines) < 20, lines)
+        for line in lines:
+            self.failUnless(len(line) <= replyqueue.LINE_LENGTH, line)
+
+        # headers repeated over each row packed side by side
+        perLine = lines[0].count('Name')
+        self.failUnless(perLine > 1, lines[0])
+        self.assertEqual(lines[1].count('lpar'), perLine)
+        self.assertEqual(len(lines) - 1, (40 + perLine - 1) / perLine)
+
+    def testVerboseInfoLimitedToWholeMachines(self):
+        self.manager.reserve('lpar02', 'bob')
+        self.assertRegexp('info --verbose lpar*', 'pvt')
+        target, lines, coalesce = self.bulkReplies(1)[0]
+
+        # 5 lines for lpar01, 6 for lpar02 and 5 for lpar03 fit in 20
+        self.assertEqual(len(lines), 17)
+        self.assertEqual([line for line in lines if 'Name' in line],
+                         ['# Name   : lpar01', '# Name   : lpar02',
+                          '# Name   : lpar03'])
+        self.assertEqual(lines[-1], '(37 more machines not shown)')
+
+    def testCommandErrorsReplied(self):
+        def fail(error):
+            def reservationsByUser():
+                raise error
+            self.manager.reservationsByUser = reservationsByUser
+
+        fail(callbacks.Error('database is gone'))
+        self.assertRegexp('users', 'Error: database is gone')
+        fail(callbacks.ArgumentError())
+        self.assertRegexp('users', 'List the machines reserved by user')
+        fail(ValueError())
+        self.assertError('users')
+
+    def testCachedRepliesFollowWrites(self):
+        self.assertNotRegexp('show reserved', 'lpar01')
+        self.assertNotRegexp('users', 'lpar01')
+        self.assertNotError('reserve lpar01')
+        self.assertRegexp('show reserved', 'Reserved machines: lpar01')
+        self.assertRegexp('users', '%s - lpar01' % self.nick)
+        self.assertNotError('free lpar01')
+        self.assertNotRegexp('show reserved', 'lpar01')
+        self.assertNotRegexp('users', 'lpar01')
+
+    def testHeldRepliesNotCached(self):
+        self.assertNotError('reserve lpar01')
+        self.assertRegexp('show held<1d', 'lpar01')
+        self.assertRegexp('show reserved sort=held', 'lpar01')
+        self.assertRegexp('show user=%s' % self.nick, 'lpar01')
+        self.assertEqual(self.plugin._Mussum__responses.keys(),
+                         [('show', 'user=%s' % self.nick)])
+
+    def testQueue(self):
+        self.manager.reserveMany(['lpar01', 'lpar02'], 'ann')
+        self.manager.reserveMany(['lpar01'], 'zed', wait=True)
+        self.assertNotError('reserve --wait lpar01 lpar02')
+        self.assertRegexp('queue', 'Waiting for: lpar01 and lpar02')
+        self.assertRegexp('queue lpar01',
+                          'Waiting for lpar01: zed and %s' % self.nick)
+
+    def testTellOnlyOnReservingNetwork(self):
+        other = FakeIrc()
+        other.network = 'other'
+        world.ircs.append(other)
+        try:
+            # user who never reserved: network unknown, nothing sent
+            self.plugin._Mussum__tell('ann', 'hello')
+            self.assertEqual(other.sent, [])
+            self.assertEqual(self.irc.takeMsg(), None)
+
+            self.assertNotError('reserve lpar01')
+            self.plugin._Mussum__tell(self.nick, 'hello')
+            self.assertEqual(other.sent, [])
+            self.assertEqual(self.irc.takeMsg().args, (self.nick, 'hello'))
+        finally:
+            world.ircs[:] = [irc for irc in world.ircs if irc is not other]
+
+
+class SyncSchedulerTestCase(PluginTestCase):
+    plugins = ('Mussum',)
+    config = {
+        'supybot.plugins.Mussum.sync.interval': 3600,
+        'supybot.plugins.Mussum.sync.jitter': 0,
+        'supybot.plugins.Mussum.sync.sources': ['csv:/nonexistent.csv'],
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        useDataBase(os.path.join(self.directory, 'mussum.db'))
+        PluginTestCase.setUp(self)
+        self.plugin = self.irc.getCallback('Mussum')
+
+    def tearDown(self):
+        PluginTestCase.tearDown(self)
+        useDataBase('')
+        shutil.rmtree(self.directory, True)
+
+    def scheduled(self):
+        return [event[0] - time.time() for event in schedule.schedule.schedule
+                if event[1] == plugin.SYNC_EVENT]
+
+    def testBackoff(self):
+        for failures, delay in ((0, 3600), (1, 60), (2, 120), (5, 960),
+                                (9, 3600)):
+            self.plugin._Mussum__syncFailures = failures
+            self.plugin._Mussum__scheduleSync()
+            left = self.scheduled()
+            self.assertEqual(len(left), 1)
+            self.failUnless(delay - 5 < left[0] <= delay, (failures, left))
+            schedule.removeEvent(plugin.SYNC_EVENT)
+
+    def testFailedUpdateRetriesSooner(self):
+        self.plugin._Mussum__backgroundSync()
+        self.assertEqual(self.plugin._Mussum__syncFailures, 1)
+        self.failUnless(self.scheduled()[0] <= 60)
+
+    def testSingleUpdateInFlight(self):
+        lock = self.plugin._Mussum__syncLock
+        lock.acquire()
+        try:
+            self.assertRegexp('update', 'already being updated')
+
+            # background update skipped, only scheduled again
+            self.plugin._Mussum__backgroundSync()
+            self.assertEqual(self.plugin._Mussum__syncFailures, 0)
+            self.assertEqual(len(self.scheduled()), 1)
+        finally:
+            lock.release()
+
+    def testDieCancelsUpdates(self):
+        self.plugin._Mussum__scheduleSync()
+        self.assertEqual(len(self.scheduled()), 1)
+        self.irc.removeCallback('Mussum')
+        self.plugin.die()
+        self.assertEqual(self.scheduled(), [])
+
+        # an update finishing after die does not schedule another one
+        self.plugin._Mussum__backgroundSync()
+        self.assertEqual(self.scheduled(), [])
+
+
+class WikiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the wiki: serves WikiHandler.page with WikiHandler.etag,
+    honoring If-None-Match and Accept-Encoding: gzip
+    """
+    page = ''
+    etag = None
+    codes = []
+
+    def do_GET(self):
+        # page not modified: say so
+        if self.headers.get('If-None-Match') == WikiHandler.etag:
+            WikiHandler.codes.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        # compress page if accepted
+        body = WikiHandler.page
+        compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+
+        if compressed:
+            buffer = cStringIO.StringIO()
+            stream = gzip.GzipFile(fileobj=buffer, mode='wb')
+            stream.write(body)
+            stream.close()
+            body = buffer.getvalue()
+
+        # send page
+        WikiHandler.codes.append(200)
+        self.send_response(200)
+        self.send_header('ETag', WikiHandler.etag)
+        self.send_header('Content-Length', str(len(body)))
+
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReadWikiTestCase(SupyTestCase):
+    page = 'Machines\n||Name||Ip||Id||Group||\n||lpar1||9.8.7.6||1||pp||\n'
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        WikiHandler.page = self.page
+        WikiHandler.etag = '"1"'
+        WikiHandler.codes = []
+
+        self.cacheDir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), WikiHandler)
+        self.url = 'http://127.0.0.1:%s/Machines' % self.server.server_port
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cacheDir, True)
+        SupyTestCase.tearDown(self)
+
+    def fetch(self, force=False, save=True):
+        machines, download = readwiki.fetchMachines(self.url, self.cacheDir, 5,
+                                                    force)
+        if save and download != None:
+            readwiki.saveMachines(download, self.url, self.cacheDir)
+        return machines
+
+    def testFetchParsesCompressedPage(self):
+        self.assertEqual(self.fetch(), [{'name': 'lpar1', 'ip': '9.8.7.6',
+                                         'id': '1', 'group': 'pp'}])
+
+    def testNotModifiedIsNotParsed(self):
+        self.fetch()
+        self.assertEqual(self.fetch(), None)
+        self.assertEqual(WikiHandler.codes, [200, 304])
+
+    def testSameTableIsUnchanged(self):
+        self.fetch()
+        WikiHandler.etag = '"2"'
+        WikiHandler.page = 'Edited text\n' + self.page
+        self.assertEqual(self.fetch(), None)
+        self.assertEqual(WikiHandler.codes, [200, 200])
+
+    def testChangedTableIsReturned(self):
+        self.fetch()
+        WikiHandler.etag = '"2"'
+        WikiHandler.page = self.page + '||lpar2||9.8.7.5||2||pp||\n'
+        self.assertEqual(len(self.fetch()), 2)
+        self.assertEqual(len(readwiki.loadCachedMachines(self.url,
+                                                         self.cacheDir)), 2)
+
+    def testUnsavedChangeIsFetchedAgain(self):
+        self.fetch()
+        WikiHandler.etag = '"2"'
+        WikiHandler.page = self.page + '||lpar2||9.8.7.5||2||pp||\n'
+        self.assertEqual(len(self.fetch(save=False)), 2)
+        self.assertEqual(len(readwiki.loadCachedMachines(self.url,
+                                                         self.cacheDir)), 1)
+        self.assertEqual(len(self.fetch()), 2)
+        self.assertEqual(self.fetch(), None)
+        self.assertEqual(WikiHandler.codes, [200, 200, 200, 304])
+
+    def testForceIgnoresCache(self):
+        self.fetch()
+        self.assertEqual(len(self.fetch(force=True)), 1)
+        self.assertEqual(WikiHandler.codes, [200, 200])
+
+
+class SourcesTestCase(SupyTestCase):
+    csv = 'Name,IP,Group\nlpar1,9.8.7.6,pp\nlpar2,,\n'
+    json = '{"machines": [{"name": "lpar1", "ip": "9.8.7.1", "id": 1}]}'
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+        SupyTestCase.tearDown(self)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        stream = open(path, 'w')
+        stream.write(content)
+        stream.close()
+        return path
+
+    def testCsvSource(self):
+        source = sources.createSource('csv:' + self.write('m.csv', self.csv))
+        machines, snapshot = source.fetch()
+        self.assertEqual(machines, [
+            {'name': 'lpar1', 'ip': '9.8.7.6', 'group': 'pp'},
+            {'name': 'lpar2', 'ip': None, 'group': None}])
+
+        # only unchanged once saved
+        self.assertEqual(len(source.fetch()[0]), 2)
+        source.save(snapshot)
+        self.assertEqual(source.fetch(), (None, None))
+        self.assertEqual(len(source.fetch(force=True)[0]), 2)
+
+    def testInvalidSpec(self):
+        self.assertRaises(ValueError, sources.createSource, 'ftp:/machines')
+        self.assertRaises(ValueError, sources.createSource, 'machines.csv')
+
+    def testMergeFirstSourceWins(self):
+        csv = sources.CsvSource(self.write('m.csv', self.csv))
+        json = sources.JsonSource(self.write('m.json', self.json))
+        machines, snapshots = sources.fetchAll([csv, json])
+        self.assertEqual(machines[0], {'name': 'lpar1', 'ip': '9.8.7.6',
+                                       'id': 1, 'group': 'pp'})
+        self.assertEqual(machines[1]['name'], 'lpar2')
+
+    def testUnchangedSourceIsLoaded(self):
+        csv = sources.CsvSource(self.write('m.csv', self.csv))
+        json = sources.JsonSource(self.write('m.json', self.json))
+        machines, snapshots = sources.fetchAll([csv, json])
+        sources.saveAll([csv, json], snapshots)
+        self.assertEqual(sources.fetchAll([csv, json]), (None, [None, None]))
+
+        self.write('m.json', '[{"name": "lpar3"}]')
+        machines, snapshots = sources.fetchAll([csv, json])
+        self.assertEqual([m['name'] for m in machines],
+                         ['lpar1', 'lpar2', 'lpar3'])
+
+    def testFailedFetchIsNotSaved(self):
+        csv = sources.CsvSource(self.write('m.csv', self.csv))
+        json = sources.JsonSource(self.write('m.json', self.json))
+        sources.saveAll([csv, json], sources.fetchAll([csv, json])[1])
+
+        # edit one source while the other is broken, then fix it
+        self.write('m.csv', self.csv + 'lpar3,,\n')
+        self.write('m.json', '{')
+        self.assertRaises(ValueError, sources.fetchAll, [csv, json])
+        self.write('m.json', self.json)
+        machines, snapshots = sources.fetchAll([csv, json])
+        self.assertEqual([m['name'] for m in machines],
+                         ['lpar1', 'lpar2', 'lpar3'])
+
+    def testHttpJsonSource(self):
+        WikiHandler.page = self.json
+        WikiHandler.etag = '"1"'
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), WikiHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        try:
+            source = sources.createSource('http-json:http://127.0.0.1:%s/m' %
+                                          server.server_port)
+            self.assertEqual(source.fetch(5)[0], [{'name': 'lpar1',
+                                                   'ip': '9.8.7.1', 'id': 1}])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TokenizerTestCase(SupyTestCase):
+    def assertFast(self, line):
+        start = time.time()
+        readwiki.parseLine(['name'], line)
+        self.failUnless(time.time() - start < 1.0, 'slow: %r' % line[:20])
+
+    def testSplitCells(self):
+        self.assertEqual(readwiki.splitCells('text||a|| b ||||'),
+                         ['a', ' b ', ''])
+        self.assertEqual(readwiki.splitCells('||x'), [])
+
+    def testSeparatorInsideMarkup(self):
+        self.assertEqual(readwiki.splitCells('||{{{a||b}}}||[[P|t]]||'
+                                             '<<M(a||b)>>||'),
+                         ['{{{a||b}}}', '[[P|t]]', '<<M(a||b)>>'])
+
+    def testUnclosedMarkupIsText(self):
+        self.assertEqual(readwiki.splitCells('||{{{a||b||'),
+                         ['{{{a', 'b'])
+        self.assertEqual(readwiki.splitCells('||{{{a||b}}}||{{{c||d||e'),
+                         ['{{{a||b}}}', '{{{c', 'd'])
+        self.assertEqual(readwiki.splitCells('||a<<{{{'), [])
+
+    def testCellAttributes(self):
+        self.assertEqual(readwiki.parseCell('<bgcolor="#f>f"><-2> a<b>c '),
+                         'a<b>c')
+        self.assertEqual(readwiki.parseCell(' <:> <|2> '), None)
+        self.assertEqual(readwiki.parseCell('<<BR>>'), '<<BR>>')
+        self.assertEqual(readwiki.parseCell('< 5'), '< 5')
+        self.assertEqual(readwiki.parseCell("<a='>'> b"), 'b')
+        self.assertEqual(readwiki.parseCell('<a="> b'), '<a="> b')
+
+    def testHeaderAttributes(self):
+        lines = ['||<tablewidth="100%">Name||<:>IP||', '||lpar1||9.8.7.6||']
+        self.assertEqual(list(readwiki.iterMachinesTable(lines)),
+                         [{'name': 'lpar1', 'ip': '9.8.7.6'}])
+
+    def testPathologicalRows(self):
+        for cell in ('<' * 100000, '<a>' * 100000, '<"' * 100000,
+                     '{{{[[<<' * 30000, '[[||' * 50000, '||' * 100000):
+            self.assertFast('||' + cell + '||')
+
+
+class NameListTestCase(SupyTestCase):
+    def testNaturalOrder(self):
+        self.assertEqual(namelist.naturalSorted(['lpar10', 'vios1', 'lpar9']),
+                         ['lpar9', 'lpar10', 'vios1'])
+
+    def testRanges(self):
+        names = ['lpar%02d' % i for i in range(1, 41)] + \
+                ['vios%d' % i for i in range(1, 5)]
+        self.assertEqual(namelist.compress(names),
+                         ['lpar01-lpar40', 'vios1-vios4'])
+
+    def testShortRunsAndGaps(self):
+        self.assertEqual(namelist.compress(['a2', 'a1', 'b', 'c1', 'c2',
+                                            'c3', 'c5', 'v9', 'v10', 'v11']),
+                         ['a1', 'a2', 'b', 'c1-c3', 'c5', 'v9-v11'])
+
+    def testPaddingMustMatch(self):
+        self.assertEqual(namelist.compress(['l9', 'l010', 'l011']),
+                         ['l9', 'l010', 'l011'])
+
+
+class FakeIrc(object):
+    def __init__(self):
+        self.sent = []
+
+    def queueMsg(self, msg):
+        self.sent.append((time.time(), msg.args[0], msg.args[1]))
+
+
+class ReplyQueueTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.irc = FakeIrc()
+        self.queue = replyqueue.ReplyQueue(rate=20, limit=5)
+
+    def tearDown(self):
+        self.queue.stop()
+        SupyTestCase.tearDown(self)
+
+    def waitSent(self, count):
+        deadline = time.time() + 5
+        while len(self.irc.sent) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def testCoalesceAndLimit(self):
+        self.assertEqual(self.queue.put(self.irc, 'nick', ['a'] * 8), 5)
+        self.waitSent(1)
+        time.sleep(0.1)
+        self.assertEqual([text for t, target, text in self.irc.sent],
+                         ['a | a | a | a | (4 more lines not shown)'])
+
+    def testLinesKeptApart(self):
+        self.queue.put(self.irc, 'nick', ['a', 'b'], coalesce=False)
+        self.queue.put(self.irc, 'nick', ['c', 'd'])
+        self.waitSent(3)
+        time.sleep(0.1)
+        self.assertEqual([text for t, target, text in self.irc.sent],
+                         ['a', 'b', 'c | d'])
+
+    def testPaced(self):
+        self.queue.put(self.irc, 'nick', ['x' * 300] * 3)
+        self.queue.put(self.irc, '#chan', ['y'])
+        self.waitSent(4)
+        self.assertEqual([target for t, target, text in self.irc.sent],
+                         ['nick', 'nick', 'nick', '#chan'])
+        self.failUnless(self.irc.sent[-1][0] - self.irc.sent[0][0] >= 0.14)
+
+
+class MachineManagerTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.db = DataBase(os.path.join(self.directory, 'mussum.db'))
+        self.events = []
+        self.manager = MachineManager(self.db,
+                                      lambda *event: self.events.append(event))
+        self.manager.addMany([('lpar%02d' % i, None, None, None)
+                              for i in range(1, 41)] +
+                             [('vios%d' % i, None, None, None)
+                              for i in range(1, 5)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+        SupyTestCase.tearDown(self)
+
+    def testMatch(self):
+        self.assertEqual(self.manager.match('vios[2-3]'), ['vios2', 'vios3'])
+        self.assertEqual(len(self.manager.match('lpar1*')), 10)
+        self.assertEqual(self.manager.match('*9'), ['lpar09', 'lpar19',
+                                                    'lpar29', 'lpar39'])
+        self.assertEqual(self.manager.match('x*'), [])
+
+    def testMatchFollowsWrites(self):
+        self.manager.remove('lpar10')
+        self.manager.add('lpar1a')
+        self.failUnless('lpar1a' in self.manager.match('lpar1?'))
+        self.failIf('lpar10' in self.manager.match('lpar1*'))
+
+    def find(self, *args):
+        query = filters.parse(args, lambda text: text == '2d' and 172800)
+        return [info['name'] for info in self.manager.find(query['terms'],
+                                                           query['sort'],
+                                                           query['limit'])]
+
+    def testFind(self):
+        self.manager.reserveMany(['lpar05', 'lpar06'], 'bob')
+        self.db.reserve('lpar07', 'ann', int(time.time()) - 259200)
+        self.assertEqual(self.find('reserved', 'lpar0*'),
+                         ['lpar05', 'lpar06', 'lpar07'])
+        self.assertEqual(self.find('user!=bob', 'state=reserved'), ['lpar07'])
+        self.assertEqual(self.find('held>2d', 'state=reserved'), ['lpar07'])
+        self.assertEqual(self.find('state=reserved', 'sort=-user', 'limit=2'),
+                         ['lpar05', 'lpar06'])
+        self.assertEqual(self.find('vios*', 'sort=-name'), ['vios4', 'vios3',
+                                                            'vios2', 'vios1'])
+
+    def testInvalidFilters(self):
+        for args in (['color=red'], ['held=2d'], ['held>soon'], ['sort=x'],
+                     ['limit=0'], ['state=busy'], ['user=']):
+            self.assertRaises(ValueError, filters.parse, args, lambda t: None)
+
+    def testExpand(self):
+        self.manager.reserve('lpar11', 'bob')
+        free = lambda info: info['user'] == None
+        self.assertEqual(self.manager.expand(['lpar1[0-2]', 'x*', 'vios1'],
+                                             free),
+                         ['lpar10', 'lpar12', 'x*', 'vios1'])
+
+    def testReconcile(self):
+        self.manager.reserve('lpar02', 'bob')
+        machines = [('lpar01', '9.8.7.1', 2, 'pp'), ('new1', None, None, None)]
+        machines += [('lpar%02d' % i, None, None, None) for i in range(3, 41)]
+        machines += [('lpar01', 'ignored', None, None)]
+
+        # preview changes nothing
+        diff = self.manager.reconcile(machines, True)
+        self.assertEqual(diff, {'added': ['new1'],
+                                'changed': [('lpar01', ['ip', 'id', 'group'])],
+                                'removed': ['vios1', 'vios2', 'vios3',
+                                            'vios4'],
+                                'kept': ['lpar02'], 'withheld': []})
+        self.assertEqual(self.manager.getInfo('new1'), None)
+        self.assertEqual(self.manager.getInfo('lpar01')['ip'], None)
+
+        self.assertEqual(self.manager.reconcile(machines), diff)
+        self.assertEqual(self.manager.getInfo('lpar01')['ip'], '9.8.7.1')
+        self.assertEqual(self.db.getInfo('new1')['name'], 'new1')
+        self.assertEqual(self.manager.match('vios*'), [])
+        self.assertEqual(self.manager.getInfo('lpar02')['user'], 'bob')
+
+        # ids read back from the database compare equal to the same ids as
+        # text
+        machines[0] = ('lpar01', '9.8.7.1', '2', 'pp')
+        diff = self.manager.reconcile(machines)
+        self.assertEqual(diff['changed'], [])
+
+    def testReconcileWithholdsRemovals(self):
+        # empty inventory: nothing removed
+        diff = self.manager.reconcile([], maxRemoved = 0.1)
+        self.assertEqual(diff['removed'], [])
+        self.assertEqual(len(diff['withheld']), 44)
+        self.assertEqual(len(self.manager.listMachines()), 44)
+
+        # truncated inventory: over the limit, nothing removed, but new
+        # machines still added
+        machines = [('lpar%02d' % i, None, None, None) for i in range(1, 31)]
+        diff = self.manager.reconcile(machines + [('new1', None, None, None)],
+                                      maxRemoved = 0.1)
+        self.assertEqual(diff['added'], ['new1'])
+        self.assertEqual(len(diff['withheld']), 14)
+        self.assertEqual(len(self.manager.listMachines()), 45)
+
+        # within the limit or unlimited: removed
+        machines = [('lpar%02d' % i, None, None, None) for i in range(1, 41)]
+        diff = self.manager.reconcile(machines + [('new1', None, None, None)],
+                                      maxRemoved = 0.1)
+        self.assertEqual(diff['removed'], ['vios1', 'vios2', 'vios3',
+                                           'vios4'])
+        diff = self.manager.reconcile(machines[:30])
+        self.assertEqual(len(diff['removed']), 11)
+        self.assertEqual(len(self.manager.listMachines()), 30)
+
+    def testAtomicReserveRollsBack(self):
+        self.manager.add('blade1', group = 'pp')
+        results = self.manager.reserveMany(['lpar01', 'blade1', 'lpar02'],
+                                           'bob', atomic = True)
+        self.assertEqual(results, [('lpar01', 4), ('blade1', 3),
+                                   ('lpar02', 4)])
+        for name in ('lpar01', 'blade1', 'lpar02'):
+            self.assertEqual(self.db.getInfo(name)['user'], None)
+            self.assertEqual(self.manager.getInfo(name)['user'], None)
+        self.assertEqual(self.db.getHistory('bob', 0), [])
+
+    def testConcurrentReservesGetOneWinner(self):
+        # each user goes through its own connections and manager, racing on
+        # the same row
+        path = os.path.join(self.directory, 'mussum.db')
+        managers = [MachineManager(DataBase(path)) for i in range(8)]
+        go = threading.Event()
+        results = {}
+
+        def reserve(i):
+            go.wait()
+            results[i] = managers[i].reserve('vios1', 'user%d' % i)
+
+        threads = [threading.Thread(target = reserve, args = (i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        go.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results.values()), [0] + [2] * 7)
+        winner = [i for i in results if results[i] == 0][0]
+        self.assertEqual(self.db.getInfo('vios1')['user'], 'user%d' % winner)
+        self.assertEqual(len(self.db.getHistory('vios1', 0)), 1)
+
+    def testReadsDoNotWaitForWrites(self):
+        # hold the database write lock so the reservation below waits for it
+        conn = sqlite3.connect(os.path.join(self.directory, 'mussum.db'))
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        writer = threading.Thread(target = self.manager.reserve,
+                                  args = ('lpar01', 'bob'))
+        writer.start()
+        time.sleep(0.2)
+
+        start = time.time()
+        self.assertEqual(self.manager.getInfo('lpar01')['user'], None)
+        self.failUnless('lpar02' in self.manager.listAvailable())
+        self.failUnless(time.time() - start < 0.5)
+
+        conn.execute('ROLLBACK')
+        writer.join()
+        conn.close()
+        self.assertEqual(self.manager.getInfo('lpar01')['user'], 'bob')
+
+    def testGenerationFollowsIndex(self):
+        # read from another thread while the reservation is committed but
+        # not applied to the index yet
+        seen = []
+        reserveManyIfFree = self.db.reserveManyIfFree
+
+        def read():
+            seen.append((self.manager.getGeneration(),
+                         self.manager.listReserved()))
+
+        def hook(*args):
+            results = reserveManyIfFree(*args)
+            reader = threading.Thread(target = read)
+            reader.start()
+            reader.join()
+            return results
+
+        before = self.manager.getGeneration()
+        self.db.reserveManyIfFree = hook
+        self.manager.reserve('lpar01', 'bob')
+        self.assertEqual(seen, [(before, [])])
+        self.failUnless(self.manager.getGeneration() > before)
+        self.assertEqual(self.manager.listReserved(), ['lpar01'])
+
+    def testHandoff(self):
+        self.manager.reserve('lpar01', 'bob')
+        self.assertEqual(self.manager.reserveMany(['lpar01', 'lpar02'], 'ann',
+                                                  wait = True),
+                         [('lpar01', 5), ('lpar02', 0)])
+        self.manager.reserveMany(['lpar01'], 'cid', wait = True)
+        self.manager.reserveMany(['lpar01'], 'ann', wait = True)
+        self.assertEqual(self.manager.getWaiters('lpar01'), ['ann', 'cid'])
+
+        self.manager.release('lpar01')
+        self.assertEqual(self.manager.getInfo('lpar01')['user'], 'ann')
+        self.assertEqual(self.events, [('handoff', 'lpar01', 'ann')])
+        self.assertEqual(self.manager.getWaiters('lpar01'), ['cid'])
+
+    def testHandoffSkipsUsersWithoutPermissions(self):
+        self.manager.add('blade1', group = 'pp')
+        self.db.associate('bob', 'pp')
+        self.db.associate('cid', 'pp')
+        self.manager.reserve('blade1', 'bob')
+        self.assertEqual(self.manager.reserveMany(['blade1', 'lpar01'], 'ann',
+                                                  wait = True),
+                         [('blade1', 3), ('lpar01', 0)])
+        self.assertEqual(self.manager.getWaiters('blade1'), [])
+        self.manager.reserveMany(['blade1'], 'cid', wait = True)
+        self.manager.release('blade1')
+        self.assertEqual(self.manager.getInfo('blade1')['user'], 'cid')
+
+    def testQueueSurvivesRestart(self):
+        self.manager.reserve('vios1', 'bob')
+        self.manager.reserveMany(['vios1'], 'ann', wait = True)
+        manager = MachineManager(DataBase(os.path.join(self.directory,
+                                                       'mussum.db')))
+        self.assertEqual(manager.getWaiting('ann'), ['vios1'])
+        manager.release('vios1')
+        self.assertEqual(manager.getInfo('vios1')['user'], 'ann')
+
+    def testLeaveQueue(self):
+        self.manager.reserveMany(['vios1', 'vios2'], 'bob')
+        self.manager.reserveMany(['vios1', 'vios2'], 'ann', wait = True)
+        self.assertEqual(self.manager.leaveMany(['vios1', 'vios3'], 'ann'),
+                         [('vios1', 0), ('vios3', 1)])
+        self.manager.releaseMany(['vios1', 'vios2'])
+        self.assertEqual(self.manager.listByUser('ann'), ['vios2'])
+
+    def testExpire(self):
+        self.manager.reserveMany(['vios1'], 'bob', duration = 3600)
+        self.manager.reserveMany(['vios1'], 'ann', wait = True)
+        expires = self.manager.getInfo('vios1')['expires']
+        self.assertEqual(self.manager.listLeases(), [('vios1', 'bob',
+                                                      expires)])
+
+        # not due yet, then due
+        self.failIf(self.manager.expire('vios1', expires))
+        self.db.reserve('vios1', 'bob', expires - 7200, expires - 3600)
+        self.manager.reload()
+        self.failIf(self.manager.expire('vios1', expires))
+        self.failUnless(self.manager.expire('vios1', expires - 3600))
+        self.assertEqual(self.manager.getInfo('vios1')['user'], 'ann')
+        self.assertEqual(self.events, [('handoff', 'vios1', 'ann')])
+        self.assertEqual(self.manager.listLeases(), [])
+
+    def testDefaultLease(self):
+        manager = MachineManager(self.db, lease = lambda info:
+                                 info['name'] == 'vios2' and 60 or None)
+        manager.reserveMany(['vios1', 'vios2'], 'bob')
+        self.assertEqual(manager.getInfo('vios1')['expires'], None)
+        self.failIf(manager.getInfo('vios2')['expires'] == None)
+        manager.release('vios2')
+        self.assertEqual(manager.listLeases(), [])
+
+
+class DataBaseTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.metrics = Metrics()
+        self.db = DataBase(os.path.join(self.directory, 'mussum.db'),
+                           metrics=self.metrics)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+        SupyTestCase.tearDown(self)
+
+    def testQueriesTimedByName(self):
+        self.db.getAll()
+        self.db.find([('user', '=', 'bob')], None, None)
+        queries = self.metrics.snapshot()['query']
+        self.assertEqual(queries['GET_ALL']['count'], 1)
+        self.assertEqual(queries['FIND']['count'], 1)
+
+
+class MigrationTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mussum.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+        SupyTestCase.tearDown(self)
+
+    def testUpgradesBaselineSchema(self):
+        # schema as created before migrations existed: user_version 0 and
+        # only the Machines table
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE Machines (name VARCHAR PRIMARY KEY, '
+                     'ip CHAR(15), id SMALLINT, grp VARCHAR, user VARCHAR, '
+                     'start INT)')
+        conn.execute("INSERT INTO Machines VALUES "
+                     "('lpar1', '9.8.7.6', 1, 'pp', 'bob', 100)")
+        conn.commit()
+        conn.close()
+
+        db = DataBase(self.path)
+        info = db.getInfo('lpar1')
+        self.assertEqual((info['user'], info['start'], info['expires']),
+                         ('bob', 100, None))
+
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], 6)
+        names = set([r[0] for r in conn.execute('SELECT name FROM '
+                                                'sqlite_master')])
+        for name in ('Permissions', 'Reservations', 'Waiters',
+                     'MachinesUser', 'MachinesGroup', 'MachinesStart',
+                     'PermissionsGroup', 'ReservationsName',
+                     'ReservationsUser', 'ReservationsTime', 'WaitersUser'):
+            self.failUnless(name in names, name)
+        columns = [r[1] for r in conn.execute('PRAGMA table_info(Machines)')]
+        self.failUnless('expires' in columns)
+        conn.close()
+
+        # opening again applies nothing twice
+        DataBase(self.path).reserve('lpar1', None)
+        self.assertEqual(DataBase(self.path).getInfo('lpar1')['user'], None)
+
+
+class LeaseTimerTestCase(SupyTestCase):
+    def testFiresInDeadlineOrder(self):
+        fired = []
+        timer = leasetimer.LeaseTimer(lambda *event: fired.append(event), 0.1)
+        now = time.time()
+        timer.put('vios2', 'ann', now + 0.3)
+        timer.put('vios1', 'bob', now + 0.15)
+        time.sleep(0.5)
+        timer.stop()
+        self.assertEqual([event[:2] for event in fired],
+                         [('warn', 'vios1'), ('expire', 'vios1'),
+                          ('warn', 'vios2'), ('expire', 'vios2')])
+
+    def testSkipsWarningAlreadyDue(self):
+        fired = []
+        timer = leasetimer.LeaseTimer(lambda *event: fired.append(event), 60)
+        timer.put('vios1', 'bob', time.time() - 1)
+        time.sleep(0.1)
+        timer.stop()
+        self.assertEqual([event[0] for event in fired], ['expire'])
+
+
+class WorkerPoolTestCase(SupyTestCase):
+    def testRunsTasks(self):
+        pool = workerpool.WorkerPool('test', 2, 8)
+        done = []
+        for i in range(5):
+            self.failUnless(pool.submit(done.append, i))
+        pool.stop()
+        self.assertEqual(sorted(done), range(5))
+
+    def testRejectsWhenFull(self):
+        release = threading.Event()
+        pool = workerpool.WorkerPool('test', 1, 2)
+        self.failUnless(pool.submit(release.wait))
+        time.sleep(0.1)
+        self.failUnless(pool.submit(time.sleep, 0))
+        self.failUnless(pool.submit(time.sleep, 0))
+        self.failIf(pool.submit(time.sleep, 0))
+        release.set()
+        pool.stop()
+
+
 
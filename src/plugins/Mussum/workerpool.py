@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2011, Rodrigo Dias Cruz
+# All rights reserved.
+#
+# This file is part of Mussum IRC-Bot.
+#
+# Mussum IRC-Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Mussum IRC-Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Mussum IRC-Bot. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# IMPORTS
+#
+import Queue
+import threading
+import time
+
+
+#
+# CONSTANTS AND DEFINITIONS
+#
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_WORKERS = 4
+
+
+#
+# CODE
+#
+class WorkerPool(object):
+    """
+    This runs tasks on a fixed number of threads. Tasks wait in a bounded
+    queue, so a burst of them is either served by the same few threads or
+    rejected at once, instead of starting a thread per task.
+    """
+
+    def __init__(self, name, workers = DEFAULT_WORKERS,
+                 queueSize = DEFAULT_QUEUE_SIZE, metrics = None):
+        """
+        Constructor. Starts the worker threads.
+
+        @type  name: basestring
+        @param name: pool name, used in thread names and metrics
+
+        @type  workers: int
+        @param workers: number of threads
+
+        @type  queueSize: int
+        @param queueSize: most tasks waiting for a thread, further ones are
+                          rejected
+
+        @type  metrics: Metrics
+        @param metrics: where to record how long tasks waited, as the
+                        'queue' kind, rejected tasks being errors
+
+        @rtype: None
+        @returns: nothing
+        """
+        self.name = name
+        self.__metrics = metrics
+        self.__queue = Queue.Queue(queueSize)
+        self.__threads = []
+
+        for i in range(workers):
+            thread = threading.Thread(target = self.__run,
+                                      name = '%s-%d' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+    # __init__()
+
+    def __run(self):
+        """
+        Runs the queued tasks until a None task is taken
+
+        @rtype: None
+        @returns: nothing
+        """
+        while True:
+            task = self.__queue.get()
+
+            # pool stopped: done
+            if task == None:
+                return
+
+            queued, function, args = task
+
+            if self.__metrics != None:
+                self.__metrics.record('queue', self.name,
+                                      time.time() - queued)
+
+            # tasks handle their own errors, this only keeps the thread alive
+            try:
+                function(*args)
+
+            except Exception:
+                pass
+    # __run()
+
+    def pending(self):
+        """
+        Returns how many tasks are waiting for a thread
+
+        @rtype: int
+        @returns: number of tasks
+        """
+        return self.__queue.qsize()
+    # pending()
+
+    def stop(self):
+        """
+        Stops the threads once the queued tasks are done
+
+        @rtype: None
+        @returns: nothing
+        """
+        for thread in self.__threads:
+            self.__queue.put(None)
+
+        for thread in self.__threads:
+            thread.join()
+    # stop()
+
+    def submit(self, function, *args):
+        """
+        Queues the passed function to be called with the passed arguments by
+        one of the threads
+
+        @type  function: callable
+        @param function: task
+
+        @rtype: bool
+        @returns: True if queued, False if the queue is full
+        """
+        try:
+            self.__queue.put_nowait((time.time(), function, args))
+
+        except Queue.Full:
+            if self.__metrics != None:
+                self.__metrics.record('queue', self.name, 0, True)
+
+            return False
+
+        return True
+    # submit()
+
+# WorkerPool
+
+